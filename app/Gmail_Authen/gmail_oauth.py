@@ -2,51 +2,102 @@
 
 import os
 import pickle                      # ✅ 关键：补上这个 import
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+import threading
 
 # 只读 Gmail 的 scope
 SCOPES = ["https://mail.google.com/"]
 
-def get_gmail_service():
-    """
-    使用本地 token.pickle + credentials.json 获取 Gmail service。
-    只在第一次时会打开浏览器让你授权，之后都复用 token.pickle。
-    """
+_creds = None
+_creds_lock = threading.Lock()
+_local = threading.local()
+_services = []
 
+
+def _token_paths():
     # 以项目根目录为基准，构造相对路径
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     token_path = os.path.join(base_dir, "integration", "token.pickle")
     creds_path = os.path.join(base_dir, "Gmail_Authen", "credentials.json")
+    return token_path, creds_path
+
+
+class GmailAuthRequired(RuntimeError):
+    """没有可用 / 可刷新的 token，需要先在有浏览器的机器上授权一次"""
+
+
+def get_credentials(interactive: bool = False):
+    """
+    使用本地 token.pickle + credentials.json 获取凭证（进程内缓存）。
+    服务里（预热 / 请求 / worker）一律 interactive=False：没有可用或可刷新的 token 直接 GmailAuthRequired，
+    不会在无头服务器上拉起浏览器授权、抱着 _creds_lock 永远等下去。
+    首次授权：python -m app.Gmail_Authen.gmail_oauth（interactive=True，打开浏览器），之后都复用 token.pickle。
+    """
+    global _creds
+
+    with _creds_lock:
+        creds = _creds
+        if creds and creds.valid:
+            return creds
 
-    creds = None
-
-    # 1) 先尝试读取 token.pickle
-    if os.path.exists(token_path):
-        with open(token_path, "rb") as token_file:
-            creds = pickle.load(token_file)
-
-    # 2) 如果没有 token，或者过期，就重新走 OAuth 流程
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            # 过期但有 refresh_token，直接刷新
-            creds.refresh(Request())
-        else:
-            # 没有 token，走完整的浏览器授权流程
-            flow = InstalledAppFlow.from_client_secrets_file(creds_path, SCOPES)
-            creds = flow.run_local_server(port=0)
-
-        # 写回 token.pickle，方便下次直接用
-        with open(token_path, "wb") as token_file:
-            pickle.dump(creds, token_file)
-
-    # 3) 创建 Gmail API 客户端
-    service = build("gmail", "v1", credentials=creds)
+        token_path, creds_path = _token_paths()
+        from google.auth.transport.requests import Request
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        # 1) 先尝试读取 token.pickle
+        if creds is None and os.path.exists(token_path):
+            with open(token_path, "rb") as token_file:
+                creds = pickle.load(token_file)
+
+        # 2) 如果没有 token，或者过期，就重新走 OAuth 流程
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                # 过期但有 refresh_token，直接刷新
+                creds.refresh(Request())
+            elif not interactive:
+                raise GmailAuthRequired(
+                    f"Gmail token 不存在或无法刷新（{token_path}），请先运行 python -m app.Gmail_Authen.gmail_oauth 授权"
+                )
+            else:
+                # 没有 token，走完整的浏览器授权流程
+                flow = InstalledAppFlow.from_client_secrets_file(creds_path, SCOPES)
+                creds = flow.run_local_server(port=0)
+
+            # 写回 token.pickle，方便下次直接用
+            with open(token_path, "wb") as token_file:
+                pickle.dump(creds, token_file)
+
+        _creds = creds
+        return creds
+
+
+def get_gmail_service():
+    """
+    获取 Gmail service。
+    googleapiclient 的 service（底层 httplib2）不是线程安全的，所以每个线程缓存一个。
+    """
+    creds = get_credentials()
+    service = getattr(_local, "service", None)
+    if service is None or getattr(_local, "creds", None) is not creds:
+        # 3) 创建 Gmail API 客户端
+        from googleapiclient.discovery import build
+        service = build("gmail", "v1", credentials=creds)
+        _local.service = service
+        _local.creds = creds
+        _services.append(service)
     return service
 
 
+def close_gmail_services():
+    while _services:
+        srv = _services.pop()
+        try:
+            srv.close()
+        except Exception:
+            pass
+
+
 if __name__ == "__main__":
-    # 单独运行这个文件可以测试是否能正常连接 Gmail
+    # 单独运行这个文件：首次授权（打开浏览器）+ 测试是否能正常连接 Gmail
+    get_credentials(interactive=True)
     srv = get_gmail_service()
     print("Gmail service OK:", srv is not None)
@@ -1,14 +1,16 @@
 
 # app/integration/analyze.py
 import os
-import fitz
-import pandas as pd
-from openai import OpenAI
-from dotenv import load_dotenv
-load_dotenv()  # 加载 .env
+import json
+
+from app.integration.analyze_vision import get_openai_client
+from app.integration.prompt_templates import build_prefixed_messages, extract_usage, get_template
+
 
 def _read_pdf(path: str) -> str:
     """PDF → text"""
+    import fitz
+
     text = ""
     try:
         with fitz.open(path) as pdf:
@@ -21,6 +23,8 @@ def _read_pdf(path: str) -> str:
 
 def _read_excel(path: str) -> str:
     """Excel → 用 pandas 合并所有 sheet → text"""
+    import pandas as pd
+
     text = f"[Excel File: {os.path.basename(path)}]\n\n"
     try:
         xls = pd.ExcelFile(path)
@@ -44,85 +48,45 @@ def extract_file_content(path: str) -> str:
 
 
 def analyze_file(path: str) -> dict:
-    """核心：GPT 按内容自动判断类型 + 抽取所需字段"""
+    """
+    核心：先用本地分类器（doc_classifier.py）定类型，再用该类型的抽取模板让 GPT 只抽字段；
+    本地不确定时才让 GPT 判断类型 + 抽取，GPT 给出的类型存为训练样本
+    """
+    from app.integration.doc_classifier import UNKNOWN, classify, record_sample
 
     text = extract_file_content(path)
     if not text:
         return {"file": path, "doc_type": "unknown", "data": {}}
 
-    client = OpenAI()
-
-    prompt = f"""
-You are an expert customs document analyzer.
-
-Given the following document text, determine its type:
-- bill_of_lading
-- commercial_invoice
-- packing_list
-- arrival_notice
-- or unknown
-
-Then extract ONLY the following JSON fields depending on type:
-
-For bill_of_lading:
-{{
-    "consignee": string or null,
-    "container": string or null,
-    "booking_number": string or null,
-    "packages": string or null
-}}
-
-For commercial_invoice:
-{{
-    "invoice_items": [
-        {{
-            "english_desc": string,
-            "qty": number,
-            "hs_code": string or null,
-            "total_value": number or null
-        }}
-    ],
-    "total_value": number or null
-}}
-
-For packing_list:
-{{
-    "packing_rows": [
-        {{
-            "qty": number,
-            "gross_weight": number,
-            "volume": number or null
-        }}
-    ],
-    "gross_weight_total": number or null
-}}
-
-For arrival_notice:
-{{
-    "firms_code": string or null
-}}
-
-Return JSON:
-{{
-    "doc_type": "...",
-    "data": {{ ... }}
-}}
-
-Document text:
-{text}
-"""
+    local = classify(text)
+    doc_type = local["doc_type"]
+    print(f"[Classify] {os.path.basename(path)} → {doc_type} ({local['confidence']})")
+
+    client = get_openai_client()
+
+    # 静态说明放在 system（固定前缀），文档文本放在 user
+    template = "doc_classify" if doc_type == UNKNOWN else f"doc_extract_{doc_type}"
+    messages = build_prefixed_messages(template, f"Document text:\n{text}")
 
     try:
         resp = client.chat.completions.create(
             model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
+            messages=messages,
             temperature=0,
         )
+        usage = extract_usage(resp)
+        print(
+            f"[OpenAI] {os.path.basename(path)} template={get_template(template).label} "
+            f"prompt={usage['prompt_tokens']} cached={usage['cached_tokens']}"
+        )
         result = resp.choices[0].message.content
-        import json
         clean = result.replace("```json", "").replace("```", "")
         clean = json.loads(clean)
-        return {"file": path, **clean}
     except Exception as e:
         print("❌ GPT解析失败:", path, e)
-        return {"file": path, "doc_type": "unknown", "data": {}}
+        return {"file": path, "doc_type": doc_type, "data": {}, "classifier": local}
+
+    if doc_type == UNKNOWN:
+        record_sample(text, clean.get("doc_type"), "gpt", os.path.basename(path))
+        return {"file": path, **clean, "classifier": local}
+    return {"file": path, "doc_type": doc_type, "data": clean.get("data", clean), "classifier": local}
@@ -0,0 +1,212 @@
+# app/analyze_api.py
+"""
+POST /analyze：直接上传附件走解析流水线（不经过 Gmail）
+
+- multipart 由 Starlette 流式解析到 SpooledTemporaryFile（小文件在内存，大文件落盘），不会整包读入内存
+- 请求体总大小在 receive 层边读边计数，超限立即 413；单文件 / 文件数也有上限
+- 流水线与邮件流程相同：build_file_payloads → GPT → reconcile → map_to_entry_json（可选返回 entry XML）
+- 记账 / 预算归属的客户不信任调用方自报：X-Api-Key 按 ANALYZE_API_KEYS 映射到客户（key 不对 401）；
+  X-Customer 只接受来自 ANALYZE_TRUSTED_PROXIES 的请求（内部网关代填），其他情况按客户端地址
+"""
+
+import asyncio
+import json
+import os
+import re
+import shutil
+import tempfile
+import uuid
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from starlette.datastructures import UploadFile
+
+from app import config
+from app.profiling import profiling_requested, run_profiled
+
+router = APIRouter()
+
+MAX_UPLOAD_FILES = config.getenv_int("MAX_UPLOAD_FILES", 20)
+MAX_UPLOAD_FILE_BYTES = config.getenv_int("MAX_UPLOAD_FILE_BYTES", 25 * 1024 * 1024)
+MAX_UPLOAD_REQUEST_BYTES = config.getenv_int("MAX_UPLOAD_REQUEST_BYTES", 100 * 1024 * 1024)
+COPY_CHUNK = 1024 * 1024
+
+# {"<api key>": "acme.com"}
+ANALYZE_API_KEYS = json.loads(config.getenv("ANALYZE_API_KEYS", "{}") or "{}")
+# 可以代填 X-Customer 的来源地址（逗号分隔）
+ANALYZE_TRUSTED_PROXIES = {
+    h.strip() for h in (config.getenv("ANALYZE_TRUSTED_PROXIES", "") or "").split(",") if h.strip()
+}
+
+ALLOWED_EXTS = {".pdf", ".xls", ".xlsx", ".png", ".jpg", ".jpeg", ".webp", ".tif", ".tiff"}
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+def _limited_request(request: Request, limit: int) -> Request:
+    """包一层 receive，边读边计数，超出 limit 直接中断解析"""
+    received = 0
+    receive = request.receive
+
+    async def limited_receive():
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise _BodyTooLarge()
+        return message
+
+    return Request(request.scope, receive=limited_receive)
+
+
+def _safe_name(name: str) -> str:
+    name = os.path.basename(name or "") or "upload"
+    return re.sub(r"[^\w.\-() ]", "_", name)
+
+
+def _spool_to_disk(upload: UploadFile, dest_dir: str, index: int) -> str:
+    """SpooledTemporaryFile → 临时目录里的真实文件（流水线按路径 / 扩展名处理）"""
+    path = os.path.join(dest_dir, f"{index:02d}_{_safe_name(upload.filename)}")
+    size = 0
+    upload.file.seek(0)
+    with open(path, "wb") as out:
+        while True:
+            chunk = upload.file.read(COPY_CHUNK)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MAX_UPLOAD_FILE_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"文件 {upload.filename} 超过单文件上限 {MAX_UPLOAD_FILE_BYTES} 字节",
+                )
+            out.write(chunk)
+    return path
+
+
+def _customer(request: Request):
+    """上传归属的客户（见模块说明）"""
+    host = request.client.host if request.client else None
+    key = request.headers.get("x-api-key")
+    if key:
+        if key not in ANALYZE_API_KEYS:
+            raise HTTPException(status_code=401, detail="X-Api-Key 无效")
+        return ANALYZE_API_KEYS[key]
+    claimed = request.headers.get("x-customer")
+    if claimed and host in ANALYZE_TRUSTED_PROXIES:
+        return claimed
+    return host
+
+
+def _status(result) -> str:
+    if isinstance(result, dict) and result.get("deferred"):
+        return "DEFERRED"
+    if isinstance(result, dict) and "error" in result:
+        return "ERROR"
+    return "ok"
+
+
+def run_analysis_pipeline(file_paths, include_xml: bool = False, message=None):
+    """与邮件流程相同的解析流水线（同步，放到线程里跑）"""
+    from app.integration.accounting import customer_of, job_scope
+    from app.integration.analyze_vision import analyze_with_vision
+    from app.integration.entry_json_mapping import map_to_entry_json
+    from app.integration.entry_xml_builder import build_entry_upload_xml
+    from app.integration.results_store import get_store
+
+    with job_scope((message or {}).get("id"), customer_of(message)) as job:
+        if job.action == "defer":
+            result = {"error": f"客户 {job.customer} 已超出当日预算，推迟处理", "deferred": True}
+        else:
+            result = analyze_with_vision(file_paths)
+    entry_json = None
+    entry_xml = None
+    # 与邮件流程（post_entry_upload）一致：映射 / 生成 XML 出错记 ERROR，不让异常变成 500
+    entry_error = None
+    if isinstance(result, dict) and "error" not in result:
+        try:
+            entry_json = map_to_entry_json(result)
+            entry_xml = build_entry_upload_xml(entry_json)
+        except Exception as e:
+            entry_error = {"status": "ERROR", "error": f"生成 entry 失败: {e}", "response": None}
+            print("❌", entry_error["error"])
+
+    shipment_id = None
+    try:
+        shipment_id = get_store().save_shipment(message, result, entry_json, entry_xml, entry_error)
+    except Exception as e:
+        print("❌ 结果库写入失败:", e)
+
+    out = {
+        "status": entry_error["status"] if entry_error else _status(result),
+        "shipment_id": shipment_id,
+        "result": result,
+        "entry_json": entry_json,
+        "usage": job.totals(),
+    }
+    if entry_error:
+        out["error"] = entry_error["error"]
+    if include_xml:
+        out["entry_xml"] = entry_xml
+    return out
+
+
+@router.post("/analyze")
+async def analyze_upload(
+    request: Request,
+    include_xml: bool = Query(False, description="同时返回 entryUpload XML"),
+):
+    """
+    multipart/form-data，字段名任意，可多个文件：
+        curl -F files=@bl.pdf -F files=@invoice.xlsx "http://host/analyze?include_xml=true"
+    带 X-Profile: 1 或 ?profile=1（及管理员 X-Profile-Key）时返回值附剖析摘要（见 app/profiling.py）
+    """
+    customer = _customer(request)
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > MAX_UPLOAD_REQUEST_BYTES:
+        raise HTTPException(status_code=413, detail=f"请求体超过上限 {MAX_UPLOAD_REQUEST_BYTES} 字节")
+
+    try:
+        form = await _limited_request(request, MAX_UPLOAD_REQUEST_BYTES).form(
+            max_files=MAX_UPLOAD_FILES, max_fields=50
+        )
+    except _BodyTooLarge:
+        raise HTTPException(status_code=413, detail=f"请求体超过上限 {MAX_UPLOAD_REQUEST_BYTES} 字节")
+
+    job_id = uuid.uuid4().hex
+    work_dir = None
+    try:
+        # 任何一步出错（含单文件超限 413）都要关掉表单，SpooledTemporaryFile 不留在磁盘上
+        try:
+            uploads = [v for _, v in form.multi_items() if isinstance(v, UploadFile)]
+            if not uploads:
+                raise HTTPException(status_code=400, detail="没有上传文件")
+
+            for up in uploads:
+                ext = os.path.splitext(up.filename or "")[1].lower()
+                if ext not in ALLOWED_EXTS:
+                    raise HTTPException(status_code=415, detail=f"不支持的文件类型: {up.filename}")
+
+            work_dir = tempfile.mkdtemp(prefix=f"analyze_{job_id[:8]}_")
+            paths = []
+            for i, up in enumerate(uploads, start=1):
+                paths.append(await asyncio.to_thread(_spool_to_disk, up, work_dir, i))
+        finally:
+            await form.close()
+
+        message = {
+            "id": f"upload-{job_id}",
+            # 记账 / 预算归属，见 _customer
+            "from": customer,
+            "subject": "POST /analyze",
+            "files": [os.path.basename(p) for p in paths],
+        }
+        result = await asyncio.to_thread(
+            run_profiled, job_id, profiling_requested(request), run_analysis_pipeline, paths, include_xml, message
+        )
+        return {"job_id": job_id, **result}
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,53 @@
+# app/config.py
+"""
+统一配置入口：.env 只在这里加载一次。
+
+各模块用 config.getenv() / getenv_int() / ... 读取环境变量，
+不要再自己调用 load_dotenv()，也不要在 import 时做网络 / 打印等副作用。
+"""
+
+import os
+import threading
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV_PATH = os.path.join(BASE_DIR, ".env")
+
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_env():
+    """加载项目根目录的 .env（幂等，已存在的环境变量不会被覆盖）"""
+    global _loaded
+    if _loaded:
+        return
+    with _lock:
+        if _loaded:
+            return
+        try:
+            from dotenv import load_dotenv
+        except ImportError:
+            pass
+        else:
+            if os.path.exists(ENV_PATH):
+                load_dotenv(dotenv_path=ENV_PATH)
+            else:
+                load_dotenv()
+        _loaded = True
+
+
+def getenv(name: str, default=None):
+    load_env()
+    return os.getenv(name, default)
+
+
+def getenv_int(name: str, default: int) -> int:
+    return int(getenv(name, str(default)))
+
+
+def getenv_float(name: str, default: float) -> float:
+    return float(getenv(name, str(default)))
+
+
+def getenv_bool(name: str, default: bool) -> bool:
+    return str(getenv(name, "1" if default else "0")).strip().lower() in ("1", "true", "yes", "on")
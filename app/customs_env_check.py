@@ -2,7 +2,6 @@ import os
 import subprocess
 import sys
 import importlib.util
-from openai import OpenAI
 
 
 def check_python_version():
@@ -47,6 +46,7 @@ def test_openai_api():
         print("⚠️  OPENAI_API_KEY not set in environment.")
         return
     try:
+        from openai import OpenAI
         client = OpenAI(api_key=key)
         response = client.models.list()
         print("✅ OpenAI API reachable. Found models:", [m.id for m in response.data[:3]], "...")
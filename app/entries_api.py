@@ -0,0 +1,35 @@
+# app/entries_api.py
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, Body, HTTPException
+
+from app.integration.netchb_client import NETCHB_MAX_CONCURRENCY
+from app.integration.post_entry_upload import upload_entries
+
+router = APIRouter()
+
+MAX_ENTRIES_PER_REQUEST = 50
+
+
+# ------------------------------
+# 多票 entry 并发上传 NET CHB（草稿，transmitFlag=N）
+# ------------------------------
+@router.post("/entries/upload")
+async def upload_entries_api(
+    entries: List[Dict[str, Any]] = Body(..., embed=True, description="entry JSON 列表（map_to_entry_json 的结构）"),
+    concurrency: Optional[int] = Body(None, embed=True, ge=1, le=16),
+):
+    if not entries:
+        raise HTTPException(status_code=400, detail="entries 为空")
+    if len(entries) > MAX_ENTRIES_PER_REQUEST:
+        raise HTTPException(status_code=413, detail=f"一次最多 {MAX_ENTRIES_PER_REQUEST} 票")
+
+    # 超过 NET CHB 连接池大小的部分没有意义，按池子大小截断
+    concurrency = min(concurrency or NETCHB_MAX_CONCURRENCY, NETCHB_MAX_CONCURRENCY)
+    results = await upload_entries(entries, concurrency=concurrency)
+    return {
+        "concurrency": concurrency,
+        "total": len(results),
+        "ok": sum(1 for r in results if r.get("status") == "OK"),
+        "results": results,
+    }
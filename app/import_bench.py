@@ -0,0 +1,123 @@
+# app/import_bench.py
+"""
+冷启动 import 基准
+
+在干净的子进程里 import 目标模块（默认 app.main 和批量 CLI），
+测 wall-clock 时间 + `python -X importtime` 的最慢模块，并检查重依赖没有被提前 import。
+
+    python -m app.import_bench                      # 预算默认 1500ms
+    IMPORT_BUDGET_MS=800 python -m app.import_bench app.main
+
+超出预算或重依赖被 eager import 时退出码为 1，可直接放进 CI。
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+DEFAULT_TARGETS = ["app.main", "app.integration.batch_mode"]
+
+# 这些模块只能在第一次使用时 import
+HEAVY_MODULES = ["fitz", "pandas", "PIL", "openai", "zeep", "googleapiclient"]
+
+IMPORT_BUDGET_MS = int(os.getenv("IMPORT_BUDGET_MS", "1500"))
+REPEAT = int(os.getenv("IMPORT_BENCH_REPEAT", "5"))
+TOP_N = 15
+
+_PROBE = (
+    "import importlib, json, sys, time\n"
+    "t0 = time.perf_counter()\n"
+    "importlib.import_module({target!r})\n"
+    "ms = (time.perf_counter() - t0) * 1000\n"
+    "heavy = sorted(m for m in {heavy!r} if m in sys.modules)\n"
+    "print(json.dumps({{'ms': ms, 'heavy': heavy}}))\n"
+)
+
+
+def _root() -> str:
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run(args, **kw):
+    return subprocess.run(
+        [sys.executable] + args,
+        cwd=_root(),
+        capture_output=True,
+        text=True,
+        **kw,
+    )
+
+
+def measure(target: str) -> dict:
+    """重复 REPEAT 次冷启动，取中位数"""
+    samples = []
+    heavy = []
+    wall = []
+    for _ in range(REPEAT):
+        t0 = time.perf_counter()
+        proc = _run(["-c", _PROBE.format(target=target, heavy=HEAVY_MODULES)])
+        wall.append((time.perf_counter() - t0) * 1000)
+        if proc.returncode != 0:
+            return {"target": target, "error": proc.stderr.strip().splitlines()[-1:]}
+        out = json.loads(proc.stdout.strip().splitlines()[-1])
+        samples.append(out["ms"])
+        heavy = out["heavy"]
+
+    samples.sort()
+    wall.sort()
+    return {
+        "target": target,
+        "import_ms": round(samples[len(samples) // 2], 1),
+        "process_ms": round(wall[len(wall) // 2], 1),
+        "eager_heavy_modules": heavy,
+    }
+
+
+def slowest_imports(target: str, top_n: int = TOP_N) -> list:
+    """解析 -X importtime 输出，按 cumulative 排序"""
+    proc = _run(["-X", "importtime", "-c", f"import {target}"])
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        try:
+            _, rest = line.split(":", 1)
+            self_us, cum_us, name = [x.strip() for x in rest.split("|")]
+            rows.append({"module": name.strip(), "self_ms": int(self_us) / 1000, "cumulative_ms": int(cum_us) / 1000})
+        except ValueError:
+            continue
+    rows.sort(key=lambda r: -r["cumulative_ms"])
+    return rows[:top_n]
+
+
+def main(argv=None):
+    targets = (argv if argv is not None else sys.argv[1:]) or DEFAULT_TARGETS
+    failed = False
+
+    for target in targets:
+        res = measure(target)
+        if "error" in res:
+            print(f"❌ {target}: import 失败 {res['error']}")
+            failed = True
+            continue
+
+        over = res["import_ms"] > IMPORT_BUDGET_MS
+        flag = "❌" if over or res["eager_heavy_modules"] else "✅"
+        print(
+            f"{flag} {target}: import {res['import_ms']}ms / 进程 {res['process_ms']}ms "
+            f"(预算 {IMPORT_BUDGET_MS}ms)"
+        )
+        if res["eager_heavy_modules"]:
+            print(f"   ⚠️ 重依赖被提前 import: {res['eager_heavy_modules']}")
+        for r in slowest_imports(target):
+            print(f"   {r['cumulative_ms']:>8.1f}ms  {r['module']}")
+
+        failed = failed or over or bool(res["eager_heavy_modules"])
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
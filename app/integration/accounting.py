@@ -0,0 +1,221 @@
+# app/integration/accounting.py
+"""
+Token / 费用记账
+
+以前 resp.usage 打印完就丢了，图片也不知道多大，没人知道一封邮件花了多少钱。这里：
+
+1) 每次模型调用记一行：model / prompt / completion / cached tokens / 图片数 / 像素 / 延迟 / 估算费用
+   （调用在 job_scope 里时带上 message_id 和 customer），写进结果库 usage_calls 表
+2) 结果库按 message / customer / day / model 汇总（GET /usage）
+3) 每个客户可配日预算（CUSTOMER_BUDGETS）：超出后 downgrade（全部改用便宜模型）或 defer（记 DEFERRED 稍后处理）
+"""
+
+import base64
+import io
+import json
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from app import config
+
+# 每百万 token 美元价格：(input, cached input, output)，按模型名前缀匹配（长前缀优先）
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+}
+MODEL_PRICES.update({
+    k: tuple(v) for k, v in json.loads(config.getenv("MODEL_PRICES_JSON", "{}") or "{}").items()
+})
+
+# {"acme.com": {"daily_usd": 5, "action": "downgrade"}, "*": {"daily_usd": 20, "action": "defer"}}
+CUSTOMER_BUDGETS: Dict[str, Dict[str, Any]] = json.loads(config.getenv("CUSTOMER_BUDGETS", "{}") or "{}")
+# downgrade 时改用的模型
+BUDGET_DOWNGRADE_MODEL = config.getenv("BUDGET_DOWNGRADE_MODEL", "gpt-4o-mini")
+
+# 认不出客户时的统一取值：记账写入和按客户查当日费用都用它（不再一边写 NULL、一边按 "" 查）
+NO_CUSTOMER = "unknown"
+
+_EMAIL_RE = re.compile(r"[a-zA-Z0-9._%+-]+@([a-zA-Z0-9.-]+\.[a-zA-Z]{2,})")
+
+
+# ---------------------- 费用 ---------------------- #
+
+def _prices(model: Optional[str]) -> Optional[Tuple[float, float, float]]:
+    if not model:
+        return None
+    for prefix in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model.startswith(prefix):
+            return MODEL_PRICES[prefix]
+    return None
+
+
+def cost_usd(model: Optional[str], prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    p = _prices(model)
+    if p is None:
+        return 0.0
+    uncached = max(0, prompt_tokens - cached_tokens)
+    return round((uncached * p[0] + cached_tokens * p[1] + completion_tokens * p[2]) / 1_000_000, 6)
+
+
+def image_stats(messages) -> Tuple[int, int]:
+    """messages 里的图片数和总像素（只读图片头，不解码像素）"""
+    count = pixels = 0
+    for m in messages or []:
+        content = m.get("content") if isinstance(m, dict) else None
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if not isinstance(part, dict) or part.get("type") != "image_url":
+                continue
+            count += 1
+            url = (part.get("image_url") or {}).get("url", "")
+            if not url.startswith("data:"):
+                continue
+            try:
+                from PIL import Image
+
+                with Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1]))) as im:
+                    pixels += im.width * im.height
+            except Exception:
+                pass
+    return count, pixels
+
+
+def estimate_prompt_tokens(messages) -> int:
+    """
+    没拿到 usage 的调用（超时 / 对冲输家 / 失败）按请求内容粗估 prompt tokens：
+    文本约 4 字符 1 token，图片按 high detail 的 512px 切块估（每块 170 + 固定 85）
+    """
+    chars = 0
+    for m in messages or []:
+        content = m.get("content") if isinstance(m, dict) else None
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            chars += sum(len(p.get("text") or "") for p in content if isinstance(p, dict))
+    images, pixels = image_stats(messages)
+    tiles = max(images, -(-pixels // (512 * 512)))
+    return chars // 4 + 85 * images + 170 * tiles
+
+
+def customer_of(message: Optional[Dict[str, Any]]) -> Optional[str]:
+    """客户 = 发件人邮箱域名（小写）；没有邮箱时用 from 原文"""
+    sender = (message or {}).get("from") or ""
+    m = _EMAIL_RE.search(sender)
+    if m:
+        return m.group(1).lower()
+    return sender.strip().lower() or None
+
+
+# ---------------------- 作业上下文 ---------------------- #
+
+@dataclass
+class Job:
+    message_id: Optional[str] = None
+    customer: Optional[str] = None
+    # None / "downgrade" / "defer"
+    action: Optional[str] = None
+    budget: Optional[Dict[str, Any]] = None
+    spent_today: float = 0.0
+    calls: List[Dict[str, Any]] = field(default_factory=list)
+
+    def totals(self) -> Dict[str, Any]:
+        keys = ("prompt_tokens", "cached_tokens", "completion_tokens", "images", "pixels", "latency_ms")
+        out = {k: sum(c.get(k) or 0 for c in self.calls) for k in keys}
+        out["calls"] = len(self.calls)
+        out["cost_usd"] = round(sum(c["cost_usd"] for c in self.calls), 6)
+        if self.action:
+            out["budget_action"] = self.action
+        return out
+
+
+_job: ContextVar[Optional[Job]] = ContextVar("accounting_job", default=None)
+
+
+def budget_for(customer: Optional[str]) -> Optional[Dict[str, Any]]:
+    if customer and customer in CUSTOMER_BUDGETS:
+        return CUSTOMER_BUDGETS[customer]
+    return CUSTOMER_BUDGETS.get("*")
+
+
+@contextmanager
+def job_scope(message_id: Optional[str] = None, customer: Optional[str] = None):
+    """
+    一票（一封邮件 / 一次上传）的记账范围；进入时检查客户当日预算，
+    超出 → job.action = budget 的 action（默认 downgrade）
+    """
+    customer = customer or NO_CUSTOMER
+    job = Job(message_id=message_id, customer=customer)
+    budget = budget_for(customer)
+    if budget and budget.get("daily_usd") is not None:
+        from app.integration.results_store import get_store
+        try:
+            job.spent_today = get_store().customer_spend(customer, _today())
+        except Exception as e:
+            print("⚠ 读取客户当日费用失败:", e)
+        if job.spent_today >= float(budget["daily_usd"]):
+            job.action = budget.get("action", "downgrade")
+            job.budget = budget
+            print(f"⚠ 客户 {customer} 今日已用 ${job.spent_today:.4f}，超出预算 → {job.action}")
+
+    token = _job.set(job)
+    try:
+        yield job
+    finally:
+        _job.reset(token)
+
+
+def current_job() -> Optional[Job]:
+    return _job.get()
+
+
+def effective_model(model: str) -> str:
+    """预算超出且 action=downgrade 时，所有调用改用便宜模型"""
+    job = _job.get()
+    if job is not None and job.action == "downgrade":
+        return BUDGET_DOWNGRADE_MODEL
+    return model
+
+
+def _today() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+# ---------------------- 记账 ---------------------- #
+
+def record_call(usage: Dict[str, Any], messages=None, job: Optional[Job] = None) -> Dict[str, Any]:
+    """
+    call_gpt_and_parse_json 的每次实际调用（含对冲输家、超时、失败）结束时调用；返回写入的记录。
+    job: 不传则取当前作业上下文；回调跑在线程池里拿不到 ContextVar，要由调用方显式传入
+    """
+    images, pixels = image_stats(messages)
+    job = job if job is not None else _job.get()
+    rec = {
+        "message_id": job.message_id if job else None,
+        "customer": job.customer if job else NO_CUSTOMER,
+        "day": _today(),
+        "created_at": int(time.time()),
+        "model": usage.get("model"),
+        "prompt_tokens": usage.get("prompt_tokens") or 0,
+        "cached_tokens": usage.get("cached_tokens") or 0,
+        "completion_tokens": usage.get("completion_tokens") or 0,
+        "images": images,
+        "pixels": pixels,
+        "latency_ms": usage.get("latency_ms") or 0,
+    }
+    rec["cost_usd"] = cost_usd(rec["model"], rec["prompt_tokens"], rec["cached_tokens"], rec["completion_tokens"])
+    if job is not None:
+        job.calls.append(rec)
+
+    try:
+        from app.integration.results_store import get_store
+        get_store().record_usage(rec)
+    except Exception as e:
+        print("⚠ 记账写入失败:", e)
+    return rec
@@ -0,0 +1,268 @@
+# app/integration/admission.py
+"""
+按内存预算的作业准入控制
+
+每票的峰值内存差别很大：pd.read_excel 整本读进来的大表、pdf_to_images 渲染的 8 页位图 + base64，
+单票就能到几百 MB，几票同时跑容器就被 OOM kill。这里在 analyze_with_vision 开始前：
+
+1) 估算：按附件类型估算峰值内存，只读文件头 / 元数据，不解析内容
+   - PDF：页数（文本页 + 最多 MAX_PDF_PAGES_IMAGES 页按 RASTER_MAX_DPI 渲染的位图）
+   - Excel：每个 sheet 的行 × 列（xlsx 读 dimension；读不到按文件大小推算）
+   - 图片：宽 × 高 × 4（只读图片头）
+2) 准入：预计 RSS = max(当前 RSS, 空闲基线 + 已预留) + 本票估算，不超过 ADMISSION_RSS_BUDGET_MB 才放行；
+   放不下就排队（先来先放，大作业不会被小作业一直插队）。没有作业在跑时总是放行，避免超大单票永远卡住
+3) 排队超过 ADMISSION_QUEUE_TIMEOUT 秒 → AdmissionTimeout，调用方把这票记为 DEFERRED
+   空闲基线在每次全部作业跑完时采样：按 ADMISSION_BASELINE_ALPHA 平滑，且最多比启动时高
+   ADMISSION_BASELINE_GROWTH_MB —— 刚跑完的大作业留下的、分配器还没还给系统的内存不会把基线越抬越高
+4) GET /metrics/memory：当前 RSS / 已预留 / 预算 / 运行中 / 排队数 / 累计等待
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from app import config
+
+ADMISSION_ENABLED = config.getenv_bool("ADMISSION_ENABLED", True)
+# 容器内存上限留出余量后的值（MB）
+ADMISSION_RSS_BUDGET_MB = config.getenv_float("ADMISSION_RSS_BUDGET_MB", 1536)
+ADMISSION_QUEUE_TIMEOUT = config.getenv_float("ADMISSION_QUEUE_TIMEOUT", 600)
+# 空闲基线：新样本的权重，以及相对启动时最多上涨多少（MB）
+ADMISSION_BASELINE_ALPHA = config.getenv_float("ADMISSION_BASELINE_ALPHA", 0.2)
+ADMISSION_BASELINE_GROWTH_MB = config.getenv_float("ADMISSION_BASELINE_GROWTH_MB", 256)
+
+MB = 1024 * 1024
+# 每票固定开销：prompt / messages / 模型返回 / entry JSON
+JOB_BASE_BYTES = 24 * MB
+# PDF 文本页：文字层 + 字典结构
+PDF_TEXT_PAGE_BYTES = 2 * MB
+# 渲染页：pixmap（RGB）+ PIL 图 + 编码后字节 + base64，约为原始像素缓冲的 2.5 倍
+RASTER_OVERHEAD = 2.5
+# pandas DataFrame（object 列）每个单元格约占的字节数
+EXCEL_CELL_BYTES = 160
+# 读不到 dimension 时：xlsx 解压后约为文件的 8 倍，DataFrame 再翻倍
+EXCEL_FILE_FACTOR = 16
+IMAGE_OVERHEAD = 3.0
+# 估算失败时按文件大小的倍数
+UNKNOWN_FILE_FACTOR = 10
+
+
+class AdmissionTimeout(TimeoutError):
+    """排队超时，调用方应推迟处理"""
+
+
+# ---------------------- 内存估算 ---------------------- #
+
+def _pdf_bytes(path: str) -> int:
+    import fitz  # PyMuPDF
+    from app.integration.analyze_vision import MAX_PDF_PAGES_IMAGES, MAX_PDF_PAGES_TEXT
+    from app.integration.rasterize import RASTER_MAX_DPI
+
+    with fitz.open(path) as doc:
+        n = len(doc)
+        total = min(n, MAX_PDF_PAGES_TEXT) * PDF_TEXT_PAGE_BYTES
+        scale = RASTER_MAX_DPI / 72.0
+        for i in range(min(n, MAX_PDF_PAGES_IMAGES)):
+            rect = doc[i].rect
+            total += int(rect.width * scale * rect.height * scale * 3 * RASTER_OVERHEAD)
+    return total
+
+
+def _excel_cells(path: str) -> Optional[int]:
+    """xlsx 每个 sheet 的 max_row × max_column 之和（read_only 只读 dimension）；xls 返回 None"""
+    if not path.lower().endswith(".xlsx"):
+        return None
+    from openpyxl import load_workbook
+
+    wb = load_workbook(path, read_only=True)
+    try:
+        cells = 0
+        for ws in wb.worksheets:
+            if ws.max_row is None or ws.max_column is None:
+                return None
+            cells += ws.max_row * ws.max_column
+        return cells
+    finally:
+        wb.close()
+
+
+def _excel_bytes(path: str) -> int:
+    try:
+        cells = _excel_cells(path)
+    except Exception:
+        cells = None
+    if cells is None:
+        return os.path.getsize(path) * EXCEL_FILE_FACTOR
+    return cells * EXCEL_CELL_BYTES
+
+
+def _image_bytes(path: str) -> int:
+    from PIL import Image
+
+    with Image.open(path) as im:
+        return int(im.width * im.height * 4 * IMAGE_OVERHEAD)
+
+
+def estimate_file(path: str) -> int:
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        if ext == ".pdf":
+            return _pdf_bytes(path)
+        if ext in (".xls", ".xlsx"):
+            return _excel_bytes(path)
+        return _image_bytes(path)
+    except Exception as e:
+        print(f"⚠ [Admission] 估算失败，按文件大小推算 {path}: {e}")
+        try:
+            return os.path.getsize(path) * UNKNOWN_FILE_FACTOR
+        except OSError:
+            return 0
+
+
+def estimate_job(file_paths: List[str]) -> Dict[str, Any]:
+    """{"bytes": 总估算, "files": {文件名: 估算字节}}"""
+    files = {os.path.basename(p): estimate_file(p) for p in file_paths}
+    return {"bytes": JOB_BASE_BYTES + sum(files.values()), "files": files}
+
+
+# ---------------------- RSS ---------------------- #
+
+def current_rss() -> int:
+    """当前进程 RSS（字节）；Linux 读 /proc，其他平台退回 ru_maxrss（峰值）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        import sys
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+    except Exception:
+        return 0
+
+
+# ---------------------- 准入 ---------------------- #
+
+class AdmissionController:
+    def __init__(self, budget_bytes: int):
+        self.budget = budget_bytes
+        self.reserved = 0
+        self.running = 0
+        # 没有作业在跑时的 RSS（解释器 + 已加载的库 + 缓存）
+        self.startup_baseline = current_rss()
+        self.baseline = self.startup_baseline
+        self._queue: deque = deque()
+        self._cond = threading.Condition()
+        self.stats = {"admitted": 0, "queued": 0, "timeouts": 0, "oversized": 0, "wait_ms_total": 0}
+
+    def _projected(self, need: int) -> int:
+        return max(current_rss(), self.baseline + self.reserved) + need
+
+    def _fits(self, ticket, need: int) -> bool:
+        if self._queue[0] is not ticket:
+            return False
+        return self.running == 0 or self._projected(need) <= self.budget
+
+    def acquire(self, need: int, timeout: float) -> int:
+        """返回排队等待的毫秒数；超时 → AdmissionTimeout"""
+        ticket = object()
+        t0 = time.monotonic()
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                if not self._fits(ticket, need):
+                    self.stats["queued"] += 1
+                    print(
+                        f"[Admission] 需要 {need / MB:.0f}MB，已预留 {self.reserved / MB:.0f}MB / "
+                        f"预算 {self.budget / MB:.0f}MB，排队等待"
+                    )
+                    # 别的作业释放时会 notify；RSS 自己回落（GC）也要能看到，所以定期重查
+                    while not self._fits(ticket, need):
+                        left = timeout - (time.monotonic() - t0)
+                        if left <= 0:
+                            self.stats["timeouts"] += 1
+                            raise AdmissionTimeout(f"内存预算不足，排队超过 {timeout:g}s")
+                        self._cond.wait(min(left, 1.0))
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+
+            if need > self.budget:
+                self.stats["oversized"] += 1
+            self.reserved += need
+            self.running += 1
+            self.stats["admitted"] += 1
+            waited = int((time.monotonic() - t0) * 1000)
+            self.stats["wait_ms_total"] += waited
+            return waited
+
+    def release(self, need: int):
+        with self._cond:
+            self.reserved -= need
+            self.running -= 1
+            if self.running == 0:
+                self.reserved = 0
+                self._update_baseline(current_rss())
+            self._cond.notify_all()
+
+    def _update_baseline(self, sample: int):
+        """平滑空闲 RSS 样本，上限 = 启动时 + ADMISSION_BASELINE_GROWTH_MB（真实占用由 _projected 里的当前 RSS 兜底）"""
+        smoothed = self.baseline + ADMISSION_BASELINE_ALPHA * (sample - self.baseline)
+        cap = self.startup_baseline + ADMISSION_BASELINE_GROWTH_MB * MB
+        self.baseline = int(min(smoothed, cap))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "rss_mb": round(current_rss() / MB, 1),
+                "baseline_mb": round(self.baseline / MB, 1),
+                "startup_baseline_mb": round(self.startup_baseline / MB, 1),
+                "reserved_mb": round(self.reserved / MB, 1),
+                "budget_mb": round(self.budget / MB, 1),
+                "running": self.running,
+                "waiting": len(self._queue),
+                **self.stats,
+            }
+
+
+_controller: Optional[AdmissionController] = None
+_controller_lock = threading.Lock()
+
+
+def get_controller() -> AdmissionController:
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController(int(ADMISSION_RSS_BUDGET_MB * MB))
+    return _controller
+
+
+@contextmanager
+def admit(file_paths: List[str], timeout: Optional[float] = None):
+    """
+    with admit(file_paths) as info: ...
+    info = {"estimate_mb", "waited_ms"}；ADMISSION_ENABLED=0 时直接放行
+    """
+    if not ADMISSION_ENABLED:
+        yield {}
+        return
+    est = estimate_job(file_paths)
+    ctl = get_controller()
+    waited = ctl.acquire(est["bytes"], ADMISSION_QUEUE_TIMEOUT if timeout is None else timeout)
+    try:
+        yield {"estimate_mb": round(est["bytes"] / MB, 1), "waited_ms": waited}
+    finally:
+        ctl.release(est["bytes"])
+
+
+def get_memory_metrics() -> Dict[str, Any]:
+    if not ADMISSION_ENABLED:
+        return {"enabled": False, "rss_mb": round(current_rss() / MB, 1)}
+    return {"enabled": True, **get_controller().snapshot()}
@@ -5,18 +5,42 @@ import base64
 import os
 import re
 import json
-import io
-from typing import List, Dict, Any
-
-import fitz  # PyMuPDF
-from PIL import Image
-import pandas as pd
-
-from openai import OpenAI
-from dotenv import load_dotenv
-
-load_dotenv()
-client = OpenAI()
+import mimetypes
+import time
+from typing import List, Dict, Any, Optional, Set
+
+import threading
+
+from app import config
+from app.integration.progress import Progress, emit
+from app.integration.prompt_templates import build_prefixed_messages, extract_usage, template_of
+from app.integration.ocr import ocr_enabled, ocr_image_file, ocr_pdf, page_is_good
+from app.integration.rasterize import compact_image_file, image_data_url, render_pdf_page
+
+# fitz / PIL / pandas / openai 都很重，放到第一次使用时再 import
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    """第一次调用时创建 OpenAI client（自动读取 OPENAI_API_KEY），之后复用连接池"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                config.load_env()
+                from openai import OpenAI
+                _client = OpenAI()
+    return _client
+
+
+def close_openai_client():
+    """关闭并丢掉缓存的 client；之后再调用（如 worker 还在收尾）会新建一个，而不是用已关闭的"""
+    global _client
+    with _client_lock:
+        client, _client = _client, None
+    if client is not None:
+        client.close()
 
 # 全局安全参数
 MAX_PDF_PAGES_TEXT = 10
@@ -24,6 +48,13 @@ MAX_PDF_PAGES_IMAGES = 4
 MAX_IMAGES_TOTAL = 8
 MIN_TEXT_CHARS_FOR_TEXT_MODE = 80
 MAX_RAW_IN_ERROR = 800
+PROMPT_TEMPLATE = "vision_entry"
+VISION_MODEL = "gpt-4o-2024-08-06"
+MAX_OUTPUT_TOKENS = 8192
+# 纯文本附件先走便宜模型（见 model_cascade.py）
+CASCADE_ENABLED = config.getenv_bool("CASCADE_ENABLED", True)
+# 一次 analyze_with_vision 里所有模型调用的总预算（秒），见 resilience.deadline_scope
+ANALYZE_BUDGET = config.getenv_float("ANALYZE_BUDGET", 300)
 
 
 def safe_print(*args, **kwargs):
@@ -36,11 +67,18 @@ def safe_print(*args, **kwargs):
 # ---------------------- PDF → 文本 ---------------------- #
 
 def pdf_to_text(path: str) -> str:
+    return "\n\n".join(pdf_page_texts(path)).strip()
+
+
+def pdf_page_texts(path: str) -> List[str]:
+    """前 MAX_PDF_PAGES_TEXT 页的文本层，每页一个字符串"""
+    import fitz  # PyMuPDF
+
     try:
         doc = fitz.open(path)
     except Exception as e:
         safe_print(f"[PDF] 打开失败: {path} -> {e}")
-        return ""
+        return []
 
     texts = []
     try:
@@ -55,18 +93,23 @@ def pdf_to_text(path: str) -> str:
         doc.close()
     except Exception as e:
         safe_print(f"[PDF] 文本抽取崩溃: {path} -> {e}")
-        return ""
+        return []
 
-    return "\n\n".join(texts).strip()
+    return texts
 
 
 # ---------------------- PDF → 图片（fallback） ---------------------- #
 
-def pdf_to_images(path: str, remaining_quota: int) -> List[Dict[str, Any]]:
+def pdf_to_images(path: str, remaining_quota: int, pages: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    """
+    pages: 只渲染这些页（1-based，例如 OCR 置信度低的页）；不传则从第 1 页开始
+    """
     items = []
     if remaining_quota <= 0:
         return items
 
+    import fitz  # PyMuPDF
+
     try:
         doc = fitz.open(path)
     except Exception as e:
@@ -74,31 +117,21 @@ def pdf_to_images(path: str, remaining_quota: int) -> List[Dict[str, Any]]:
         return items
 
     max_pages = min(MAX_PDF_PAGES_IMAGES, remaining_quota)
+    if pages is None:
+        page_indexes = range(min(max_pages, len(doc)))
+    else:
+        page_indexes = [p - 1 for p in pages if 0 < p <= len(doc)][:max_pages]
 
-    for i, page in enumerate(doc):
-        if i >= max_pages:
-            break
+    for i in page_indexes:
+        page = doc[i]
         try:
-            try:
-                pix = page.get_pixmap(dpi=220, alpha=False)
-            except Exception:
-                pix = page.get_pixmap(alpha=False)
-
-            img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
-
-            MAX_W = 2000
-            if img.width > MAX_W:
-                ratio = MAX_W / img.width
-                img = img.resize((MAX_W, int(img.height * ratio)))
-
-            buf = io.BytesIO()
-            img.save(buf, format="PNG")
-            b64 = base64.b64encode(buf.getvalue()).decode()
-
-            items.append({
-                "b64": b64,
-                "hint": f"PDF {os.path.basename(path)} 第 {i+1} 页（扫描件）"
-            })
+            # 自适应 DPI / 灰度 / 裁边 / JPEG 编码，见 rasterize.py
+            item = render_pdf_page(page, f"PDF {os.path.basename(path)} 第 {i+1} 页（扫描件）")
+            safe_print(
+                f"[PDF] page {i+1}: {item['dpi']}dpi {item['width']}x{item['height']} "
+                f"{item['mode']} {item['bytes'] // 1024}KB ~{item['est_tokens']} tokens"
+            )
+            items.append(item)
         except Exception as e_page:
             safe_print(f"[PDF] 图片转换失败 page {i+1}: {e_page}")
             continue
@@ -111,8 +144,11 @@ def pdf_to_images(path: str, remaining_quota: int) -> List[Dict[str, Any]]:
 
 def excel_to_sheet_info(path: str):
     """
-    返回 Excel 多 Sheet 内容 + 自动识别类型（invoice / packing / unknown）
+    返回 Excel 多 Sheet 内容 + 本地分类器识别的类型（commercial_invoice / packing_list / ... / unknown）
     """
+    import pandas as pd
+    from app.integration.doc_classifier import classify
+
     try:
         xls = pd.ExcelFile(path)
     except Exception as e:
@@ -128,27 +164,8 @@ def excel_to_sheet_info(path: str):
             df_head = df.head(20)  # 只取前20行
             text_table = df_head.to_csv(index=False)
 
-            # 自动识别 sheet 类型
-            content_str = " ".join(df_head.astype(str).values.flatten()).upper()
-
-            invoice_keywords = [
-                "INVOICE", "UNIT PRICE", "PRICE", "AMOUNT",
-                "TOTAL", "USD", "HS CODE", "VALUE"
-            ]
-            packing_keywords = [
-                "PACKING", "CARTON", "CARTONS", "GW", "NW",
-                "CBM", "DIMENSION", "PACKAGE", "PCS"
-            ]
-
-            score_invoice = sum(1 for kw in invoice_keywords if kw in content_str)
-            score_packing = sum(1 for kw in packing_keywords if kw in content_str)
-
-            if score_invoice > score_packing and score_invoice > 0:
-                sheet_type = "invoice"
-            elif score_packing > score_invoice and score_packing > 0:
-                sheet_type = "packing_list"
-            else:
-                sheet_type = "unknown"
+            # 本地分类器识别 sheet 类型（sheet 名通常也带类型，一起参与）
+            sheet_type = classify(f"{sheet_name}\n{text_table}")["doc_type"]
 
             results.append({
                 "sheet_name": sheet_name,
@@ -166,52 +183,130 @@ def excel_to_sheet_info(path: str):
 # ---------------------- 图片文件 → base64 ---------------------- #
 
 def image_file_to_b64(path: str) -> Dict[str, Any]:
+    hint = f"图片 {os.path.basename(path)}（扫描件）"
+    try:
+        return compact_image_file(path, hint)
+    except Exception as e:
+        safe_print(f"[Image] 压缩失败，按原图发送: {path} -> {e}")
+
     item = {
         "b64": "",
-        "hint": f"图片 {os.path.basename(path)}（扫描件）"
+        "hint": hint
     }
     try:
         with open(path, "rb") as f:
             b64 = base64.b64encode(f.read()).decode()
         item["b64"] = b64
+        item["mime"] = mimetypes.guess_type(path)[0] or "image/png"
     except Exception as e:
         safe_print(f"[Image] 打开失败: {path} -> {e}")
         item["hint"] += " ⚠️读取失败"
     return item
 
 
+# ---------------------- 本地 OCR（可选） ---------------------- #
+
+def _ocr_pdf_chunks(path: str, found: Optional[Set[str]] = None):
+    """返回 (高置信度页的文本块列表, 需要回退成图片的页码列表)"""
+    try:
+        pages = ocr_pdf(path, MAX_PDF_PAGES_TEXT)
+    except Exception as e:
+        safe_print(f"[OCR] PDF 失败，整份回退图片: {path} -> {e}")
+        return [], None
+
+    chunks = []
+    fallback = []
+    for p in pages:
+        safe_print(f"[OCR] {os.path.basename(path)} 第 {p['page']} 页 置信度 {p['confidence']}")
+        if page_is_good(p):
+            chunks.append(
+                f"PDF 文件 {os.path.basename(path)} 第 {p['page']} 页 OCR 文本"
+                f"（本地 OCR，置信度 {p['confidence']}）{_doc_type_note([p['text']], found)}：\n{p['text']}\n"
+            )
+        else:
+            fallback.append(p["page"])
+    return chunks, fallback
+
+
+def _ocr_image_chunk(path: str, found: Optional[Set[str]] = None) -> Optional[str]:
+    try:
+        res = ocr_image_file(path)
+    except Exception as e:
+        safe_print(f"[OCR] 图片失败: {path} -> {e}")
+        return None
+    safe_print(f"[OCR] {os.path.basename(path)} 置信度 {res['confidence']}")
+    if not page_is_good(res):
+        return None
+    return (
+        f"图片 {os.path.basename(path)} 的 OCR 文本"
+        f"（本地 OCR，置信度 {res['confidence']}）{_doc_type_note([res['text']], found)}：\n{res['text']}\n"
+    )
+
+
+# ---------------------- 本地文档类型 ---------------------- #
+
+DOC_TYPE_TAGS = {
+    "commercial_invoice": "这是一张 Commercial Invoice（商业发票）",
+    "packing_list": "这是一张 Packing List（装箱单）",
+    "bill_of_lading": "这是一份 Bill of Lading（提单）",
+    "arrival_notice": "这是一份 Arrival Notice（到货通知）",
+}
+
+
+def _doc_type_note(pages: List[str], found: Optional[Set[str]] = None) -> str:
+    """
+    逐页本地分类（doc_classifier.py），直接告诉模型类型；全部 unknown 时不加说明
+    found: 可选，识别出的类型加进去（payload["doc_types"]，级联质量检查按它决定必填字段）
+    """
+    from app.integration.doc_classifier import UNKNOWN, classify, describe_pages
+
+    labels = [classify(p)["doc_type"] if p.strip() else UNKNOWN for p in pages]
+    if found is not None:
+        found.update(label for label in labels if label in DOC_TYPE_TAGS)
+    if all(label == UNKNOWN for label in labels):
+        return ""
+    return f"（本地识别类型：{describe_pages(labels)}）"
+
+
 # ---------------------- 收集附件 payload ---------------------- #
 
-def build_file_payloads(file_paths: List[str]) -> Dict[str, Any]:
+def build_file_payloads(file_paths: List[str], progress: Progress = None) -> Dict[str, Any]:
     text_chunks = []
     images = []
+    doc_types: Set[str] = set()
     remaining_image_quota = MAX_IMAGES_TOTAL
 
-    for path in file_paths:
+    for idx, path in enumerate(file_paths, start=1):
         ext = os.path.splitext(path)[1].lower()
         safe_print(f"[处理附件] {path}")
+        n_chunks, n_images = len(text_chunks), len(images)
 
         if ext == ".pdf":
-            txt = pdf_to_text(path)
+            pages = pdf_page_texts(path)
+            txt = "\n\n".join(pages).strip()
             if txt:
                 text_chunks.append(
-                    f"PDF 文件 {os.path.basename(path)} 的文本内容：\n{txt}\n"
+                    f"PDF 文件 {os.path.basename(path)} 的文本内容{_doc_type_note(pages, doc_types)}：\n{txt}\n"
                 )
 
-            if len(txt) < MIN_TEXT_CHARS_FOR_TEXT_MODE and remaining_image_quota > 0:
-                pdf_imgs = pdf_to_images(path, remaining_image_quota)
-                images.extend(pdf_imgs)
-                remaining_image_quota -= len(pdf_imgs)
+            if len(txt) < MIN_TEXT_CHARS_FOR_TEXT_MODE:
+                # 扫描件：先本地 OCR，只有低置信度的页才转图片
+                fallback_pages = None
+                if ocr_enabled():
+                    good, fallback_pages = _ocr_pdf_chunks(path, doc_types)
+                    text_chunks.extend(good)
+
+                if remaining_image_quota > 0 and fallback_pages != []:
+                    pdf_imgs = pdf_to_images(path, remaining_image_quota, fallback_pages)
+                    images.extend(pdf_imgs)
+                    remaining_image_quota -= len(pdf_imgs)
 
         elif ext in [".xls", ".xlsx"]:
             sheets = excel_to_sheet_info(path)
             for s in sheets:
-                if s["type"] == "invoice":
-                    tag = "这是一张 Commercial Invoice（商业发票）"
-                elif s["type"] == "packing_list":
-                    tag = "这是一张 Packing List（装箱单）"
-                else:
-                    tag = "请判断该表格是发票还是装箱单"
+                tag = DOC_TYPE_TAGS.get(s["type"], "请判断该表格是发票还是装箱单")
+                if s["type"] in DOC_TYPE_TAGS:
+                    doc_types.add(s["type"])
 
                 text_chunks.append(
                     f"Excel {os.path.basename(path)} - Sheet {s['sheet_name']}（自动识别类型：{s['type']}）\n"
@@ -220,7 +315,10 @@ def build_file_payloads(file_paths: List[str]) -> Dict[str, Any]:
                 )
 
         else:
-            if remaining_image_quota > 0:
+            ocr_res = _ocr_image_chunk(path, doc_types) if ocr_enabled() else None
+            if ocr_res:
+                text_chunks.append(ocr_res)
+            elif remaining_image_quota > 0:
                 img_item = image_file_to_b64(path)
                 images.append(img_item)
                 remaining_image_quota -= 1
@@ -229,46 +327,30 @@ def build_file_payloads(file_paths: List[str]) -> Dict[str, Any]:
                     f"图片 {os.path.basename(path)} 被忽略（超过图片上限）。"
                 )
 
+        emit(
+            progress, "extract",
+            file=os.path.basename(path), index=idx, total=len(file_paths),
+            text_chunks=len(text_chunks) - n_chunks, images=len(images) - n_images,
+        )
+
     if not text_chunks and not images:
         text_chunks.append("⚠️ 所有附件无法解析，请返回空结构 JSON。")
 
-    return {"text_chunks": text_chunks, "images": images}
+    return {"text_chunks": text_chunks, "images": images, "doc_types": sorted(doc_types)}
 
 
 # ---------------------- 构造 messages ---------------------- #
 
-def build_messages(payload: Dict[str, Any]):
+def build_messages(payload: Dict[str, Any], template: str = PROMPT_TEMPLATE):
+    """
+    system = 固定模板（不到 1024 tokens，单独不会命中 OpenAI prefix cache，见 prompt_templates.py）
+    user   = 本票的文本块 + 图片
+    """
     text_chunks = payload["text_chunks"]
     images = payload["images"]
 
     user_content = []
 
-    user_content.append({
-        "type": "text",
-        "text": (
-            "你是美国清关单据分析 AI，请从提单、发票、装箱单、到货通知中提取所有信息。\n"
-            "并严格按以下 JSON 结构返回（所有字段必须存在）：\n\n"
-            "{\n"
-            '  "summary": {\n'
-            '    "container_no": null,\n'
-            '    "seal_no": null,\n'
-            '    "bl_no": null,\n'
-            '    "firms_code": null,\n'
-            '    "consignee": null,\n'
-            '    "total_packages": null,\n'
-            '    "gross_weight_kg": 0,\n'
-            '    "volume_cbm": 0,\n'
-            '    "total_value_usd": 0\n'
-            "  },\n"
-            '  "bill_of_lading": {},\n'
-            '  "commercial_invoice": {"source": null, "items": []},\n'
-            '  "packing_list": {"source": null, "items": []},\n'
-            '  "arrival_notice": {}\n'
-            "}\n"
-            "返回 **纯 JSON**，无解释。"
-        )
-    })
-
     # 加文本
     for i, chunk in enumerate(text_chunks, start=1):
         user_content.append({
@@ -283,32 +365,149 @@ def build_messages(payload: Dict[str, Any]):
         if img.get("b64"):
             user_content.append({
                 "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{img['b64']}"}
+                "image_url": {"url": image_data_url(img)}
             })
 
-    messages = [
-        {"role": "system", "content": "你是严谨的清关单据结构化专家，只能输出 JSON。"},
-        {"role": "user", "content": user_content},
-    ]
-    return messages
+    return build_prefixed_messages(template, user_content)
 
 
 # ---------------------- GPT 调用 + JSON 恢复 ---------------------- #
 
-def call_gpt_and_parse_json(messages):
+# 流式输出时，每累计这么多字符推一次 delta
+STREAM_DELTA_CHARS = 256
+
+
+def _stream_completion(client, model: str, messages, max_tokens: int, on_delta,
+                       cancel: Optional[threading.Event] = None):
+    """
+    stream=True：边收边回调 on_delta(新增文本, 已收总字符数)，返回 (全文, usage 所在 chunk)
+    cancel 被 set（超时被放弃）时关闭连接，不再继续收
+    """
+    from app.integration.resilience import AttemptCancelled
+
+    stream = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,
+        max_tokens=max_tokens,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    parts = []
+    pending = []
+    pending_len = 0
+    total = 0
+    usage_chunk = None
+
+    for chunk in stream:
+        if cancel is not None and cancel.is_set():
+            stream.close()
+            raise AttemptCancelled(f"{model} 流式调用已被放弃")
+        if getattr(chunk, "usage", None):
+            usage_chunk = chunk
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        if not delta:
+            continue
+        parts.append(delta)
+        pending.append(delta)
+        pending_len += len(delta)
+        total += len(delta)
+        if pending_len >= STREAM_DELTA_CHARS:
+            on_delta("".join(pending), total)
+            pending, pending_len = [], 0
+
+    if pending:
+        on_delta("".join(pending), total)
+    return "".join(parts), usage_chunk
+
+
+def _complete(model: str, timeout: float, cancel: threading.Event, messages, max_tokens: int, on_delta=None):
+    """一次实际调用（resilience.call_model 的 fn），返回 (全文, resp)"""
+    from app.integration.resilience import AttemptCancelled
+
+    if cancel.is_set():
+        # 排到时已经有结果了（对冲的另一路赢了 / 超时放弃），不再发请求，也不记账
+        raise AttemptCancelled(f"{model} 调用已被放弃", sent=False)
+    client = get_openai_client().with_options(timeout=timeout)
+    if on_delta is not None:
+        return _stream_completion(client, model, messages, max_tokens, on_delta, cancel)
+    resp = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,
+        max_tokens=max_tokens
+    )
+    return resp.choices[0].message.content or "", resp
+
+
+def call_gpt_and_parse_json(messages, usage: Optional[Dict[str, Any]] = None,
+                            model: Optional[str] = None, max_tokens: Optional[int] = None,
+                            on_delta=None):
+    """
+    usage: 可选，传入 dict 时会被填上本次调用的 token 使用量（含 cached_tokens）
+    model / max_tokens: 不传则用 VISION_MODEL / MAX_OUTPUT_TOKENS
+    on_delta: 可选，传入时走流式输出，on_delta(新增文本, 已收总字符数)；流式调用不做对冲
+    超时 / 对冲 / 熔断 / 备用模型见 resilience.py；全部熔断时返回 {"error": ..., "deferred": True}
+    """
+    from app.integration.accounting import (
+        cost_usd, current_job, effective_model, estimate_prompt_tokens, record_call,
+    )
+    from app.integration.resilience import CircuitOpenError, call_model
+
+    tpl = template_of(messages)
+    job = current_job()
+    # 成功的那次在回调里记完账再返回，保证调用方随后看到的 job.totals() 已经包含它
+    success_recorded = threading.Event()
+
+    def _on_attempt(m: str, fut, ms: int):
+        # 每次发出去的调用都记账：对冲输家 / 超时 / 失败的按估算的 prompt tokens 记，赢的那次用真实 usage
+        if fut.exception() is None:
+            a = extract_usage(fut.result()[1])
+        else:
+            a = {"prompt_tokens": estimate_prompt_tokens(messages), "cached_tokens": 0, "completion_tokens": 0}
+        a["model"] = a.get("model") or m
+        a["latency_ms"] = ms
+        record_call(a, messages, job=job)
+        if fut.exception() is None:
+            success_recorded.set()
+
+    t0 = time.perf_counter()
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-2024-08-06",
-            messages=messages,
-            temperature=0,
-            max_tokens=8192
+        (raw, resp), used_model = call_model(
+            effective_model(model or VISION_MODEL),
+            lambda m, timeout, cancel: _complete(m, timeout, cancel, messages, max_tokens or MAX_OUTPUT_TOKENS,
+                                                on_delta),
+            hedge=on_delta is None,
+            on_attempt=_on_attempt,
         )
+    except CircuitOpenError as e:
+        return {"error": f"OpenAI 暂不可用，稍后重试: {e}", "deferred": True}
     except Exception as e:
         return {"error": f"OpenAI API 调用失败: {e}"}
 
-    raw = resp.choices[0].message.content or ""
+    success_recorded.wait(timeout=1.0)
+    u = extract_usage(resp)
+    u["latency_ms"] = int((time.perf_counter() - t0) * 1000)
+    u["model"] = u.get("model") or used_model
+    u["prompt"] = tpl.label if tpl else None
+    # 记账在 _on_attempt 里做过了（每次调用一条），这里只算赢的那次的费用用于日志 / usage
+    u["cost_usd"] = cost_usd(u["model"], u["prompt_tokens"], u["cached_tokens"], u["completion_tokens"])
+    if usage is not None:
+        usage.update(u)
+    safe_print(
+        f"[OpenAI] {used_model} prompt={u['prompt']} tokens prompt={u['prompt_tokens']} cached={u['cached_tokens']} "
+        f"completion={u['completion_tokens']} latency={u['latency_ms']}ms cost=${u['cost_usd']:.4f}"
+    )
+
     safe_print("[OpenAI] 返回前300：", raw[:300])
 
+    return parse_model_json(raw)
+
+
+def parse_model_json(raw: str) -> Dict[str, Any]:
+    """模型输出 → dict（先直接解析，失败再从 {} 中恢复）"""
     # 直接解析
     try:
         return json.loads(raw)
@@ -329,13 +528,60 @@ def call_gpt_and_parse_json(messages):
 
 # ---------------------- 主入口 ---------------------- #
 
-def analyze_with_vision(file_paths: List[str]) -> Dict[str, Any]:
+def analyze_with_vision(file_paths: List[str], progress: Progress = None) -> Dict[str, Any]:
+    """
+    progress: 可选进度回调（admission / template / extract / payload / gpt_start / gpt_delta / gpt_done / reconcile）
+    开始前按估算内存排队准入（见 admission.py），排队超时返回 {"error": ..., "deferred": True}
+    """
     if not file_paths:
         return {"error": "no files"}
 
+    from app.integration.admission import AdmissionTimeout, admit
+    from app.integration.resilience import deadline_scope
+
     try:
-        payload = build_file_payloads(file_paths)
-        messages = build_messages(payload)
-        return call_gpt_and_parse_json(messages)
+        with admit(file_paths) as info:
+            if info:
+                emit(progress, "admission", **info)
+            with deadline_scope(ANALYZE_BUDGET):
+                return _analyze(file_paths, progress)
+    except AdmissionTimeout as e:
+        return {"error": f"内存不足，推迟处理: {e}", "deferred": True}
     except Exception as e:
         return {"error": f"analyze_with_vision 崩溃: {e}"}
+
+
+def _analyze(file_paths: List[str], progress: Progress = None) -> Dict[str, Any]:
+    # 已学会的供应商版式：本地按坐标抽取，验证通过就不调用模型
+    from app.integration.layout_templates import extract_with_templates, learn_from_result
+    result = extract_with_templates(file_paths)
+    if result is not None:
+        emit(progress, "template", templates=result["extraction"]["templates"])
+        return result
+
+    payload = build_file_payloads(file_paths, progress)
+    emit(progress, "payload", text_chunks=len(payload["text_chunks"]), images=len(payload["images"]))
+
+    messages = build_messages(payload)
+    on_delta = None
+    if progress is not None:
+        def on_delta(text, total):
+            emit(progress, "gpt_delta", text=text, chars=total)
+
+    emit(progress, "gpt_start")
+    if CASCADE_ENABLED:
+        from app.integration.model_cascade import run_cascade
+        result = run_cascade(payload, messages, on_delta=on_delta)
+    else:
+        result = call_gpt_and_parse_json(messages, on_delta=on_delta)
+    emit(progress, "gpt_done", result=result)
+
+    # 数字对账：对不上的字段只做一次定向追问
+    from app.integration.reconciliation import reconcile
+    result = reconcile(result, payload)
+    emit(progress, "reconcile", report=result.get("reconciliation") if isinstance(result, dict) else None)
+    try:
+        learn_from_result(file_paths, result)
+    except Exception as e:
+        print(f"⚠ [Layout] 学习版式失败: {e}")
+    return result
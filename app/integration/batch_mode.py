@@ -0,0 +1,439 @@
+# app/integration/batch_mode.py
+"""
+离线批量模式（OpenAI Batch API 格式）
+
+新客户上线时需要回溯几个月的历史邮件，逐封走 analyze_with_vision 会撞限流、按原价计费。
+这里分四步：
+
+1) build   : 目录 / Gmail 查询范围 → 用现有 build_file_payloads + build_messages 生成 Batch JSONL
+2) submit  : 提交到真实 Batch 接口（/v1/batches），或本地替身（LocalBatchBackend，逐行同步调用）
+3) poll    : 轮询直到完成，下载 output JSONL
+4) ingest  : 输出逐行 → parse_model_json → map_to_entry_json → 结果库
+
+所有状态记在 <batch_dir>/manifest.json 里，每一步都可以单独重跑。
+
+命令行：
+    python -m app.integration.batch_mode build --dir backlog/
+    python -m app.integration.batch_mode build --gmail-query "has:attachment after:2024/01/01" --max 500
+    python -m app.integration.batch_mode submit [--local]
+    python -m app.integration.batch_mode poll
+    python -m app.integration.batch_mode ingest
+    python -m app.integration.batch_mode run --dir backlog/ --local   # 一条龙
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from app.integration.analyze_vision import (
+    MAX_OUTPUT_TOKENS,
+    VISION_MODEL,
+    build_file_payloads,
+    build_messages,
+    parse_model_json,
+    safe_print,
+)
+from app.integration.entry_json_mapping import map_to_entry_json
+from app.integration.results_store import get_store
+
+BATCH_DIR = os.path.join("attachments", "batch")
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+
+# OpenAI 限制：单个输入文件 ≤ 50,000 请求、≤ 200 MB；留一点余量
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+# ---------------------- manifest ---------------------- #
+
+def _sibling_path(input_path: str, prefix: str) -> str:
+    """input_001.jsonl → 同目录下的 <prefix>001.jsonl（只换文件名前缀，目录名里的 input_ 不动）"""
+    d, name = os.path.split(input_path)
+    if name.startswith("input_"):
+        name = name[len("input_"):]
+    return os.path.join(d, prefix + name)
+
+
+def _manifest_path(batch_dir: str) -> str:
+    return os.path.join(batch_dir, "manifest.json")
+
+
+def load_manifest(batch_dir: str = BATCH_DIR) -> Dict[str, Any]:
+    with open(_manifest_path(batch_dir), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: Dict[str, Any], batch_dir: str = BATCH_DIR):
+    os.makedirs(batch_dir, exist_ok=True)
+    tmp = _manifest_path(batch_dir) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp, _manifest_path(batch_dir))
+
+
+# ---------------------- 1) 收集任务 ---------------------- #
+
+def collect_jobs_from_dir(root: str) -> List[Dict[str, Any]]:
+    """
+    root 下每个子目录 = 一票（custom_id = 子目录名）；
+    没有子目录时，整个 root 算一票。
+    """
+    jobs = []
+    subdirs = sorted(
+        d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d))
+    )
+
+    def _files(d):
+        return sorted(
+            os.path.join(d, f) for f in os.listdir(d)
+            if os.path.isfile(os.path.join(d, f))
+        )
+
+    if subdirs:
+        for d in subdirs:
+            files = _files(os.path.join(root, d))
+            if files:
+                jobs.append({"custom_id": f"dir-{d}", "files": files})
+    else:
+        files = _files(root)
+        if files:
+            jobs.append({"custom_id": f"dir-{os.path.basename(os.path.abspath(root))}", "files": files})
+
+    return jobs
+
+
+def collect_jobs_from_gmail(query: str, max_results: int = 100) -> List[Dict[str, Any]]:
+    """按 Gmail 查询范围下载附件（每封邮件一个子目录），每封邮件 = 一票"""
+    from app.Gmail_Authen.gmail_oauth import get_gmail_service
+    from app.integration.gmail_reader import ATTACH_DIR, fetch_email_by_id, list_message_ids
+
+    service = get_gmail_service()
+    jobs = []
+    for msg_id in list_message_ids(query, max_results=max_results, service=service):
+        try:
+            msg = fetch_email_by_id(msg_id, service=service, attach_dir=os.path.join(ATTACH_DIR, msg_id))
+        except Exception as e:
+            safe_print(f"[Batch] 邮件下载失败 {msg_id}: {e}")
+            continue
+        if msg and msg["files"]:
+            jobs.append({
+                "custom_id": f"gmail-{msg_id}",
+                "files": msg["files"],
+                "message_id": msg_id,
+                "from": msg["from"],
+                "subject": msg["subject"],
+            })
+    return jobs
+
+
+# ---------------------- 1) 生成 JSONL ---------------------- #
+
+def _request_line(custom_id: str, messages) -> str:
+    return json.dumps({
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": VISION_MODEL,
+            "messages": messages,
+            "temperature": 0,
+            "max_tokens": MAX_OUTPUT_TOKENS,
+        },
+    }, ensure_ascii=False)
+
+
+def build_batch_files(jobs: List[Dict[str, Any]], batch_dir: str = BATCH_DIR) -> Dict[str, Any]:
+    """
+    jobs → 一个或多个 Batch 输入 JSONL（按请求数 / 字节数自动切分），写 manifest.json
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    manifest: Dict[str, Any] = {"created_at": int(time.time()), "jobs": {}, "batches": []}
+
+    part = 0
+    fh = None
+    count = 0
+    size = 0
+
+    def _open_next():
+        nonlocal part, fh, count, size
+        if fh:
+            fh.close()
+        part += 1
+        path = os.path.join(batch_dir, f"input_{part:03d}.jsonl")
+        fh = open(path, "w", encoding="utf-8")
+        count = 0
+        size = 0
+        manifest["batches"].append({"input_path": path, "custom_ids": [], "status": "built"})
+
+    try:
+        for job in jobs:
+            cid = job["custom_id"]
+            try:
+                payload = build_file_payloads(job["files"])
+                line = _request_line(cid, build_messages(payload)) + "\n"
+            except Exception as e:
+                safe_print(f"[Batch] 构造请求失败 {cid}: {e}")
+                manifest["jobs"][cid] = {**job, "error": str(e)}
+                continue
+
+            nbytes = len(line.encode("utf-8"))
+            if fh is None or count >= MAX_REQUESTS_PER_FILE or size + nbytes > MAX_BYTES_PER_FILE:
+                _open_next()
+
+            fh.write(line)
+            count += 1
+            size += nbytes
+            manifest["batches"][-1]["custom_ids"].append(cid)
+            manifest["jobs"][cid] = job
+    finally:
+        if fh:
+            fh.close()
+
+    save_manifest(manifest, batch_dir)
+    safe_print(f"[Batch] 生成 {len(manifest['batches'])} 个 JSONL，共 {len(manifest['jobs'])} 票")
+    return manifest
+
+
+# ---------------------- 2) 后端 ---------------------- #
+
+class OpenAIBatchBackend:
+    """真实 OpenAI Batch 接口"""
+
+    name = "openai"
+
+    def __init__(self, client=None):
+        if client is None:
+            from app.integration.analyze_vision import get_openai_client
+            client = get_openai_client()
+        self.client = client
+
+    def submit(self, input_path: str) -> str:
+        with open(input_path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=uploaded.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=COMPLETION_WINDOW,
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        b = self.client.batches.retrieve(batch_id)
+        return {
+            "status": b.status,
+            "output_file_id": getattr(b, "output_file_id", None),
+            "error_file_id": getattr(b, "error_file_id", None),
+        }
+
+    def download(self, file_id: str, dest: str):
+        content = self.client.files.content(file_id)
+        with open(dest, "wb") as f:
+            f.write(content.read())
+
+
+class LocalBatchBackend:
+    """
+    本地替身：submit 时逐行同步调用 chat.completions，按 Batch 输出格式写 JSONL。
+    complete: 可注入的调用函数 (body: dict) -> dict（chat completion 响应体），方便离线测试。
+    """
+
+    name = "local"
+
+    def __init__(self, complete: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None):
+        self.complete = complete or self._call_openai
+        self._outputs: Dict[str, str] = {}
+
+    @staticmethod
+    def _call_openai(body: Dict[str, Any]) -> Dict[str, Any]:
+        from app.integration.analyze_vision import get_openai_client
+        resp = get_openai_client().chat.completions.create(**body)
+        return resp.model_dump() if hasattr(resp, "model_dump") else resp
+
+    def submit(self, input_path: str) -> str:
+        batch_id = "local-" + hashlib.sha1(input_path.encode("utf-8")).hexdigest()[:12]
+        out_path = _sibling_path(input_path, "output_")
+        with open(input_path, "r", encoding="utf-8") as fin, \
+                open(out_path, "w", encoding="utf-8") as fout:
+            for line in fin:
+                if not line.strip():
+                    continue
+                req = json.loads(line)
+                rec = {"id": f"{batch_id}-{req['custom_id']}", "custom_id": req["custom_id"],
+                       "response": None, "error": None}
+                try:
+                    rec["response"] = {"status_code": 200, "body": self.complete(req["body"])}
+                except Exception as e:
+                    rec["error"] = {"code": "local_error", "message": str(e)}
+                fout.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self._outputs[batch_id] = out_path
+        return batch_id
+
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        return {"status": "completed", "output_file_id": batch_id, "error_file_id": None}
+
+    def download(self, file_id: str, dest: str):
+        src = self._outputs.get(file_id)
+        if src and os.path.abspath(src) != os.path.abspath(dest):
+            os.replace(src, dest)
+
+
+def submit_batches(backend, batch_dir: str = BATCH_DIR) -> Dict[str, Any]:
+    manifest = load_manifest(batch_dir)
+    for b in manifest["batches"]:
+        if b.get("batch_id"):
+            continue
+        b["batch_id"] = backend.submit(b["input_path"])
+        b["backend"] = backend.name
+        b["status"] = "submitted"
+        safe_print(f"[Batch] 已提交 {b['input_path']} → {b['batch_id']}")
+        save_manifest(manifest, batch_dir)
+    return manifest
+
+
+# ---------------------- 3) 轮询 ---------------------- #
+
+def poll_batches(backend, batch_dir: str = BATCH_DIR, interval: float = 60.0,
+                 timeout: Optional[float] = None) -> Dict[str, Any]:
+    manifest = load_manifest(batch_dir)
+    deadline = time.monotonic() + timeout if timeout else None
+
+    while True:
+        pending = 0
+        for b in manifest["batches"]:
+            if not b.get("batch_id") or b["status"] in TERMINAL_STATUSES:
+                continue
+            st = backend.status(b["batch_id"])
+            b["status"] = st["status"]
+            if st["status"] == "completed" and st.get("output_file_id"):
+                out_path = _sibling_path(b["input_path"], "output_")
+                backend.download(st["output_file_id"], out_path)
+                b["output_path"] = out_path
+            if st.get("error_file_id"):
+                err_path = _sibling_path(b["input_path"], "errors_")
+                backend.download(st["error_file_id"], err_path)
+                b["error_path"] = err_path
+            if b["status"] not in TERMINAL_STATUSES:
+                pending += 1
+        save_manifest(manifest, batch_dir)
+
+        if not pending:
+            return manifest
+        if deadline and time.monotonic() > deadline:
+            safe_print(f"[Batch] 轮询超时，仍有 {pending} 个 batch 未完成")
+            return manifest
+        safe_print(f"[Batch] {pending} 个 batch 未完成，{interval}s 后重试")
+        time.sleep(interval)
+
+
+# ---------------------- 4) 回灌 ---------------------- #
+
+def save_result(custom_id: str, job: Dict[str, Any], final: Dict[str, Any], entry_json: Optional[Dict[str, Any]]):
+    """写入结果库（message_id 用 Gmail ID，目录任务用 custom_id）"""
+    message = {
+        "id": job.get("message_id") or custom_id,
+        "from": job.get("from"),
+        "subject": job.get("subject"),
+        "files": job.get("files"),
+    }
+    get_store().save_shipment(message, final, entry_json)
+
+
+def _content_of(body: Dict[str, Any]) -> str:
+    try:
+        return body["choices"][0]["message"]["content"] or ""
+    except (KeyError, IndexError, TypeError):
+        return ""
+
+
+def ingest_outputs(batch_dir: str = BATCH_DIR) -> Dict[str, int]:
+    manifest = load_manifest(batch_dir)
+    stats = {"ok": 0, "parse_error": 0, "request_error": 0}
+
+    for b in manifest["batches"]:
+        out_path = b.get("output_path")
+        if not out_path or not os.path.exists(out_path):
+            continue
+        with open(out_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                cid = rec.get("custom_id")
+                job = manifest["jobs"].get(cid, {"custom_id": cid})
+                resp = rec.get("response") or {}
+
+                if rec.get("error") or resp.get("status_code") != 200:
+                    stats["request_error"] += 1
+                    save_result(cid, job, {"error": rec.get("error") or resp}, None)
+                    continue
+
+                final = parse_model_json(_content_of(resp.get("body") or {}))
+                if "error" in final:
+                    stats["parse_error"] += 1
+                    save_result(cid, job, final, None)
+                    continue
+
+                save_result(cid, job, final, map_to_entry_json(final))
+                stats["ok"] += 1
+        b["ingested"] = True
+
+    save_manifest(manifest, batch_dir)
+    safe_print(f"[Batch] 回灌完成: {stats}")
+    return stats
+
+
+# ---------------------- CLI ---------------------- #
+
+def _backend(local: bool):
+    return LocalBatchBackend() if local else OpenAIBatchBackend()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Customs AI Gateway 离线批量模式")
+    ap.add_argument("--batch-dir", default=BATCH_DIR)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    for name in ("build", "run"):
+        p = sub.add_parser(name)
+        src = p.add_mutually_exclusive_group(required=True)
+        src.add_argument("--dir")
+        src.add_argument("--gmail-query")
+        p.add_argument("--max", type=int, default=100)
+        if name == "run":
+            p.add_argument("--local", action="store_true")
+            p.add_argument("--interval", type=float, default=60.0)
+
+    p = sub.add_parser("submit")
+    p.add_argument("--local", action="store_true")
+    p = sub.add_parser("poll")
+    p.add_argument("--interval", type=float, default=60.0)
+    p.add_argument("--timeout", type=float, default=None)
+    sub.add_parser("ingest")
+
+    args = ap.parse_args(argv)
+
+    if args.cmd in ("build", "run"):
+        jobs = collect_jobs_from_dir(args.dir) if args.dir else collect_jobs_from_gmail(args.gmail_query, args.max)
+        build_batch_files(jobs, args.batch_dir)
+    if args.cmd == "submit":
+        submit_batches(_backend(args.local), args.batch_dir)
+    if args.cmd == "poll":
+        # 本地替身在 submit 时已经写好 output（与 poll 下载路径相同），poll 只是标记完成
+        local = any(b.get("backend") == "local" for b in load_manifest(args.batch_dir)["batches"])
+        poll_batches(_backend(local), args.batch_dir, args.interval, args.timeout)
+    if args.cmd == "run":
+        backend = _backend(args.local)
+        submit_batches(backend, args.batch_dir)
+        poll_batches(backend, args.batch_dir, args.interval)
+    if args.cmd in ("ingest", "run"):
+        ingest_outputs(args.batch_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+# app/integration/doc_classifier.py
+"""
+本地文档类型分类器（TF-IDF 加权的多项式朴素贝叶斯，纯 Python）
+
+以前 app/analyze.py 每个附件都让 gpt-4o 先判断是提单 / 发票 / 装箱单 / 到货通知，
+excel_to_sheet_info 用固定关键词计数猜 sheet 类型。这里：
+
+1) 特征：英文单词 + 相邻词二元组，中文按字二元组；只看前 CLASSIFY_MAX_CHARS 个字符，单次 < 1ms
+2) 模型：每个特征存 [idf, 各类别 log P(特征|类别)]。打分 = Σ tf-idf × log P ÷ Σ tf-idf（按特征权重归一化，
+   否则长文本的分差被放大，softmax 几乎总是 1.0），乘 SCORE_SCALE 后 softmax 得置信度
+3) 不属于四类的文档：
+   - "other" 类（求职信 / 原产地证 / ISF 表等种子语料 + GPT 判为 unknown 的样本）：预测为 other → unknown
+   - 覆盖率：文档特征权重里在词表内的比例低于 DOC_CLASSIFY_MIN_COVERAGE → unknown
+   置信度低于阈值 → unknown（调用方再交给模型判断）。阈值由交叉验证校准：
+   在折外预测上取精确率 ≥ DOC_CLASSIFY_TARGET_PRECISION 的最低置信度，写进模型文件；
+   没有校准结果（只有种子语料）时用 DOC_CLASSIFY_MIN_CONFIDENCE
+4) 训练数据：内置种子语料（冷启动）+ 结果库 doc_samples 表
+   - analyze_file 本地不确定、由 GPT 判断的文档自动记为 gpt 样本
+   - import-dir 从 <目录>/<类型>/ 导入人工标注（manual，优先于 gpt 标签）
+5) 重训练时做 k 折交叉验证，准确率 / 每类 precision、recall / 混淆矩阵 / 校准阈值写进模型文件并打印
+
+命令行：
+    python -m app.integration.doc_classifier train [--dir labeled/]
+    python -m app.integration.doc_classifier report
+    python -m app.integration.doc_classifier import-dir labeled/      # labeled/bill_of_lading/*.pdf、labeled/other/ ...
+    python -m app.integration.doc_classifier classify a.pdf b.xlsx
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app import config
+
+DOC_CLASSIFIER_MODEL = config.getenv(
+    "DOC_CLASSIFIER_MODEL", os.path.join("attachments", "models", "doc_classifier.json")
+)
+DOC_CLASSIFY_MIN_CONFIDENCE = config.getenv_float("DOC_CLASSIFY_MIN_CONFIDENCE", 0.7)
+DOC_CLASSIFY_MIN_COVERAGE = config.getenv_float("DOC_CLASSIFY_MIN_COVERAGE", 0.35)
+DOC_CLASSIFY_TARGET_PRECISION = config.getenv_float("DOC_CLASSIFY_TARGET_PRECISION", 0.95)
+# 校准阈值的上下限
+THRESHOLD_RANGE = (0.5, 0.99)
+# 归一化后的平均 log P 差值很小，放大后再 softmax
+SCORE_SCALE = 3.0
+CLASSIFY_MAX_CHARS = config.getenv_int("CLASSIFY_MAX_CHARS", 3000)
+# 结果库里每个样本保留的字符数
+SAMPLE_MAX_CHARS = 2 * CLASSIFY_MAX_CHARS
+CV_FOLDS = 5
+ALPHA = 0.1
+MODEL_VERSION = 2
+
+LABELS = ["bill_of_lading", "commercial_invoice", "packing_list", "arrival_notice"]
+UNKNOWN = "unknown"
+# 四类以外的文档；只在模型内部使用，对外报 unknown
+OTHER = "other"
+CLASSES = LABELS + [OTHER]
+
+# 冷启动种子：每类几段典型措辞（英文 + 中文）
+SEED_DOCS: Dict[str, List[str]] = {
+    "bill_of_lading": [
+        "bill of lading shipper consignee notify party vessel voyage port of loading port of discharge "
+        "place of receipt place of delivery freight prepaid freight collect number of original bills",
+        "ocean bill of lading master bl house bl carrier scac booking no container no seal no "
+        "marks and numbers shipped on board said to contain",
+        "提单 托运人 收货人 通知方 船名 航次 装货港 卸货港 集装箱号 封条号 运费预付 正本提单",
+    ],
+    "commercial_invoice": [
+        "commercial invoice invoice no invoice date seller buyer description of goods quantity "
+        "unit price amount total usd payment terms",
+        "invoice hs code country of origin total value fob cif incoterms manufacturer unit price amount",
+        "商业发票 发票号 单价 金额 总价 美元 原产国 海关编码 付款方式",
+    ],
+    "packing_list": [
+        "packing list cartons ctns gross weight net weight kgs measurement cbm carton no pcs",
+        "packing list gw nw cbm dimension package total packages pallets qty per carton",
+        "装箱单 箱数 件数 毛重 净重 体积 尺寸 包装 托盘",
+    ],
+    "arrival_notice": [
+        "arrival notice eta estimated time of arrival last free day firms code terminal "
+        "available for pickup freight charges due",
+        "notice of arrival it number it date customs release demurrage cargo availability "
+        "delivery order pickup location free time",
+        "到货通知 预计到港 免费期 提货地点 码头 滞港费 清关放行",
+    ],
+    OTHER: [
+        "dear sir madam please find attached the documents for your reference thank you best regards "
+        "kind regards let me know if you have any questions",
+        "certificate of origin exporter producer the undersigned hereby declares that the goods "
+        "originate in certifying authority signature stamp",
+        "importer security filing isf manufacturer supplier seller buyer ship to party consolidator "
+        "stuffing location container stuffing",
+        "customs bond surety principal obligor insurance certificate policy insured sum safety data sheet",
+        "您好 附件是相关文件 请查收 谢谢 原产地证书 保险单 安全数据表",
+    ],
+}
+
+_WORD_RE = re.compile(r"[a-z][a-z]+|[一-鿿]+")
+
+_model: Optional[Dict[str, Any]] = None
+_model_lock = threading.Lock()
+
+
+# ---------------------- 特征 ---------------------- #
+
+def features(text: str) -> Counter:
+    words = _WORD_RE.findall((text or "")[:CLASSIFY_MAX_CHARS].lower())
+    out: Counter = Counter()
+    prev = None
+    for w in words:
+        if w[0] >= "一":
+            # 中文：字二元组（单字时用单字）
+            out.update(w[i:i + 2] for i in range(max(1, len(w) - 1)))
+            prev = None
+            continue
+        out[w] += 1
+        if prev is not None:
+            out[prev + " " + w] += 1
+        prev = w
+    return out
+
+
+def _weights(counts: Counter, idf) -> Dict[str, float]:
+    return {f: (1.0 + math.log(c)) * idf(f) for f, c in counts.items()}
+
+
+# ---------------------- 训练 ---------------------- #
+
+def fit(samples: List[Tuple[str, str]]) -> Dict[str, Any]:
+    """samples: [(label, text)] → 模型 dict（可 JSON 序列化）"""
+    docs = [(label, features(text)) for label, text in samples if label in CLASSES]
+    n = len(docs)
+    df: Counter = Counter()
+    for _, counts in docs:
+        df.update(counts.keys())
+    idf_table = {f: math.log((n + 1) / (d + 1)) + 1.0 for f, d in df.items()}
+
+    class_docs = Counter(label for label, _ in docs)
+    class_feat: Dict[str, Counter] = {label: Counter() for label in CLASSES}
+    for label, counts in docs:
+        w = _weights(counts, idf_table.__getitem__)
+        norm = math.sqrt(sum(v * v for v in w.values())) or 1.0
+        for f, v in w.items():
+            class_feat[label][f] += v / norm
+
+    vocab = list(idf_table)
+    totals = {label: sum(class_feat[label].values()) + ALPHA * len(vocab) for label in CLASSES}
+    tokens = {
+        f: [round(idf_table[f], 4)] + [
+            round(math.log((class_feat[label][f] + ALPHA) / totals[label]), 4) for label in CLASSES
+        ]
+        for f in vocab
+    }
+    priors = [math.log((class_docs[label] + 1) / (n + len(CLASSES))) for label in CLASSES]
+    return {
+        "version": MODEL_VERSION,
+        "labels": CLASSES,
+        "priors": priors,
+        "tokens": tokens,
+        # 词表外特征的 idf（df = 0）
+        "oov_idf": round(math.log(n + 1) + 1.0, 4),
+        "trained_at": int(time.time()),
+        "samples": dict(class_docs),
+    }
+
+
+def predict(model: Dict[str, Any], text: str) -> Tuple[str, float]:
+    """
+    (类别, 置信度)；类别可能是 other。词表覆盖率不足时返回 (unknown, 0)
+    """
+    tokens = model["tokens"]
+    labels = model["labels"]
+    oov_idf = model.get("oov_idf", 1.0)
+    sums = [0.0] * len(labels)
+    known = total = 0.0
+    for f, c in features(text).items():
+        tf = 1.0 + math.log(c)
+        row = tokens.get(f)
+        if row is None:
+            total += tf * oov_idf
+            continue
+        w = tf * row[0]
+        known += w
+        total += w
+        for i in range(len(labels)):
+            sums[i] += w * row[i + 1]
+    if not known or known / total < DOC_CLASSIFY_MIN_COVERAGE:
+        return UNKNOWN, 0.0
+    # 先验按一个单位的证据计入
+    scores = [SCORE_SCALE * (s + p) / (known + 1.0) for s, p in zip(sums, model["priors"])]
+    top = max(scores)
+    exp = [math.exp(s - top) for s in scores]
+    best = scores.index(top)
+    return labels[best], exp[best] / sum(exp)
+
+
+def threshold(model: Dict[str, Any]) -> float:
+    return (model.get("report") or {}).get("threshold") or DOC_CLASSIFY_MIN_CONFIDENCE
+
+
+# ---------------------- 模型加载 / 对外接口 ---------------------- #
+
+def _seed_samples() -> List[Tuple[str, str]]:
+    return [(label, text) for label, texts in SEED_DOCS.items() for text in texts]
+
+
+def get_model() -> Dict[str, Any]:
+    """模型文件不存在时用种子语料现训（几毫秒）"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                model = None
+                if os.path.exists(DOC_CLASSIFIER_MODEL):
+                    with open(DOC_CLASSIFIER_MODEL, encoding="utf-8") as f:
+                        model = json.load(f)
+                # 旧版本模型文件（没有 other 类 / 未归一化）不再使用，等下次 train 覆盖
+                if model is None or model.get("version") != MODEL_VERSION:
+                    model = fit(_seed_samples())
+                _model = model
+    return _model
+
+
+def classify(text: str) -> Dict[str, Any]:
+    """{"doc_type": bill_of_lading / ... / unknown, "confidence": 0~1}"""
+    model = get_model()
+    label, confidence = predict(model, text)
+    if label == OTHER or confidence < threshold(model):
+        label = UNKNOWN
+    return {"doc_type": label, "confidence": round(confidence, 3)}
+
+
+def describe_pages(labels: List[str]) -> str:
+    """["bill_of_lading", "commercial_invoice", "commercial_invoice"] → "第 1 页 bill_of_lading；第 2-3 页 commercial_invoice" """
+    parts = []
+    start = 0
+    for i in range(1, len(labels) + 1):
+        if i == len(labels) or labels[i] != labels[start]:
+            pages = f"{start + 1}" if i - 1 == start else f"{start + 1}-{i}"
+            parts.append(f"第 {pages} 页 {labels[start]}")
+            start = i
+    return "；".join(parts)
+
+
+def record_sample(text: str, label: str, source: str = "gpt", file_name: Optional[str] = None):
+    """把一份已判定类型的文档存为训练样本（下次 train 时使用）；GPT 判为 unknown 的记为 other"""
+    if label == UNKNOWN:
+        label = OTHER
+    if label not in CLASSES or not (text or "").strip():
+        return
+    text = text[:SAMPLE_MAX_CHARS]
+    sha = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    try:
+        from app.integration.results_store import get_store
+        get_store().add_doc_sample(sha, label, source, text, file_name)
+    except Exception as e:
+        print("⚠ 分类样本写入失败:", e)
+
+
+# ---------------------- 评估 / 训练命令 ---------------------- #
+
+def _calibrate(preds: List[Tuple[str, str, float]]) -> Optional[float]:
+    """
+    折外预测 [(真实, 预测, 置信度)] → 使精确率（只算预测为四类之一的）≥ DOC_CLASSIFY_TARGET_PRECISION
+    的最低置信度阈值；样本太少返回 None（沿用 DOC_CLASSIFY_MIN_CONFIDENCE）
+    """
+    claimed = sorted((conf, pred == label) for label, pred, conf in preds if pred in LABELS)
+    if len(claimed) < 2 * len(LABELS):
+        return None
+    correct = sum(ok for _, ok in claimed)
+    for i, (conf, ok) in enumerate(claimed):
+        # 阈值取 conf 时，保留 claimed[i:]
+        if correct / (len(claimed) - i) >= DOC_CLASSIFY_TARGET_PRECISION:
+            return round(min(max(conf, THRESHOLD_RANGE[0]), THRESHOLD_RANGE[1]), 3)
+        correct -= ok
+    return THRESHOLD_RANGE[1]
+
+
+def evaluate(samples: List[Tuple[str, str]], folds: int = CV_FOLDS) -> Dict[str, Any]:
+    """
+    k 折交叉验证（按类别轮流分折）；种子语料始终在训练集里。
+    先在折外预测上校准阈值，再按该阈值统计准确率 / 混淆矩阵
+    """
+    samples = [(label, text) for label, text in samples if label in CLASSES]
+    if len(samples) < 2:
+        return {"samples": len(samples), "accuracy": None}
+    folds = max(2, min(folds, len(samples)))
+    by_label: Dict[str, List[Tuple[str, str]]] = {}
+    for s in samples:
+        by_label.setdefault(s[0], []).append(s)
+    fold_of = {}
+    for items in by_label.values():
+        for i, s in enumerate(items):
+            fold_of[id(s)] = i % folds
+
+    preds: List[Tuple[str, str, float]] = []
+    elapsed = 0.0
+    for k in range(folds):
+        train = [s for s in samples if fold_of[id(s)] != k]
+        test = [s for s in samples if fold_of[id(s)] == k]
+        if not test:
+            continue
+        model = fit(_seed_samples() + train)
+        for label, text in test:
+            t0 = time.perf_counter()
+            pred, conf = predict(model, text)
+            elapsed += time.perf_counter() - t0
+            preds.append((label, pred, conf))
+
+    cut = _calibrate(preds)
+    confusion = {t: Counter() for t in CLASSES}
+    correct = 0
+    for label, pred, conf in preds:
+        if pred == OTHER or conf < (cut or DOC_CLASSIFY_MIN_CONFIDENCE):
+            pred = UNKNOWN
+        confusion[label][pred] += 1
+        # other 样本报 unknown 算对
+        correct += pred == label or (label == OTHER and pred == UNKNOWN)
+
+    per_class = {}
+    for label in LABELS:
+        tp = confusion[label][label]
+        predicted = sum(confusion[t][label] for t in CLASSES)
+        actual = sum(confusion[label].values())
+        precision = tp / predicted if predicted else None
+        recall = tp / actual if actual else None
+        f1 = (2 * precision * recall / (precision + recall)) if precision and recall else None
+        per_class[label] = {
+            "support": actual,
+            "precision": round(precision, 3) if precision is not None else None,
+            "recall": round(recall, 3) if recall is not None else None,
+            "f1": round(f1, 3) if f1 is not None else None,
+        }
+    return {
+        "samples": len(samples),
+        "folds": folds,
+        "threshold": cut,
+        "accuracy": round(correct / len(samples), 4),
+        "unknown_rate": round(sum(c[UNKNOWN] for c in confusion.values()) / len(samples), 4),
+        "avg_predict_us": round(elapsed / len(samples) * 1e6, 1),
+        "per_class": per_class,
+        "confusion": {t: dict(c) for t, c in confusion.items()},
+    }
+
+
+def file_text(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".txt":
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            return f.read()
+    from app.analyze import extract_file_content
+    return extract_file_content(path)
+
+
+def import_dir(root: str) -> Dict[str, int]:
+    """<root>/<类型>/* → manual 样本"""
+    counts: Dict[str, int] = {}
+    for label in CLASSES:
+        folder = os.path.join(root, label)
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            text = file_text(os.path.join(folder, name))
+            if text.strip():
+                record_sample(text, label, "manual", name)
+                counts[label] = counts.get(label, 0) + 1
+    return counts
+
+
+def _store_samples() -> List[Tuple[str, str]]:
+    from app.integration.results_store import get_store
+    return [(r["label"], r["text"]) for r in get_store().list_doc_samples()]
+
+
+def train(extra: Iterable[Tuple[str, str]] = ()) -> Dict[str, Any]:
+    """种子 + 结果库样本（+ extra）训练并写模型文件；返回交叉验证报告"""
+    global _model
+    samples = _store_samples() + list(extra)
+    report = evaluate(samples)
+    model = fit(_seed_samples() + samples)
+    model["report"] = report
+    os.makedirs(os.path.dirname(os.path.abspath(DOC_CLASSIFIER_MODEL)), exist_ok=True)
+    tmp = DOC_CLASSIFIER_MODEL + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(model, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, DOC_CLASSIFIER_MODEL)
+    with _model_lock:
+        _model = model
+    return report
+
+
+def _fmt(v) -> str:
+    return "-" if v is None else f"{v:.3f}"
+
+
+def print_report(report: Dict[str, Any]):
+    if not report or report.get("accuracy") is None:
+        print(f"样本不足，无法评估（{(report or {}).get('samples', 0)} 条）")
+        return
+    print(
+        f"样本 {report['samples']}，{report['folds']} 折交叉验证：准确率 {report['accuracy']:.2%}，"
+        f"unknown {report['unknown_rate']:.2%}，单次预测 {report['avg_predict_us']}µs，"
+        f"置信度阈值 {report.get('threshold') or DOC_CLASSIFY_MIN_CONFIDENCE}"
+    )
+    print(f"{'类型':<20}{'support':>8}{'precision':>11}{'recall':>8}{'f1':>7}")
+    for label, m in report["per_class"].items():
+        print(f"{label:<20}{m['support']:>8}{_fmt(m['precision']):>11}{_fmt(m['recall']):>8}{_fmt(m['f1']):>7}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地文档类型分类器")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_train = sub.add_parser("train", help="用种子 + 结果库样本重训练，打印交叉验证报告")
+    p_train.add_argument("--dir", help="先导入 <dir>/<类型>/ 下的人工标注文件")
+    sub.add_parser("report", help="打印当前模型的评估报告")
+    p_import = sub.add_parser("import-dir", help="导入 <dir>/<类型>/ 下的人工标注文件")
+    p_import.add_argument("dir")
+    p_cls = sub.add_parser("classify", help="对文件分类")
+    p_cls.add_argument("files", nargs="+")
+
+    args = parser.parse_args(argv)
+    if args.cmd == "import-dir" or (args.cmd == "train" and args.dir):
+        print("导入:", import_dir(args.dir))
+    if args.cmd == "train":
+        print_report(train())
+        print(f"模型已写入 {DOC_CLASSIFIER_MODEL}")
+    elif args.cmd == "report":
+        print_report(get_model().get("report"))
+    elif args.cmd == "classify":
+        for path in args.files:
+            print(os.path.basename(path), classify(file_text(path)))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,15 +6,16 @@
 ✔ Carrier 名称 → SCAC 自动转换
 ✔ 国家名称 → Country code 自动转换
 ✔ 安全提取字段（避免 dict/list）
+✔ 字段别名 / 类型在 entry_schema 里声明，一次解码 + 预编译映射表
 """
 
-import os
-from typing import Dict, Any, List
-from dotenv import load_dotenv
+from operator import attrgetter
+from typing import Dict, Any
 
-load_dotenv()
+from app import config
+from app.integration.entry_schema import AnalysisResult, decode, to_scalar
 
-BROKER_NO = os.getenv("NETCHB_BROKER_NO", "")
+BROKER_NO = config.getenv("NETCHB_BROKER_NO", "")
 
 # -------------------- Port Code 映射表（CBP 官方代码） --------------------
 PORT_CODES = {
@@ -70,36 +71,8 @@ COUNTRY_MAP = {
 
 
 # -------------------- 安全取值函数 --------------------
-def _safe_extract(v):
-    """
-    无论 GPT 返回 str / dict / list / None，都转换成安全 string。
-    """
-    if v is None:
-        return None
-
-    # Already string?
-    if isinstance(v, str):
-        return v.strip()
-
-    # numbers
-    if isinstance(v, (int, float)):
-        return str(v)
-
-    # dict
-    if isinstance(v, dict):
-        for k in ["value", "raw", "text", "name"]:
-            if k in v:
-                return _safe_extract(v[k])
-        return str(v)
-
-    # list
-    if isinstance(v, list):
-        if not v:
-            return None
-        return _safe_extract(v[0])
-
-    # fallback
-    return str(v)
+# 拆包逻辑统一在 entry_schema.to_scalar（XML builder 共用）
+_safe_extract = to_scalar
 
 
 # -------------------- 规范化港口（文本 → CBP code）--------------------
@@ -161,84 +134,81 @@ def normalize_country(v):
     return "CN"
 
 
+# -------------------- 字段映射表（导入时编译） --------------------
+# entry 字段 → (来源字段（已按别名表解码），按优先级; 规范化函数)
+ENTRY_FIELDS = {
+    "entry_no": (("entry_no",), None),
+    "entry_type": (("entry_type",), lambda v: v or "01"),
+    "importer_no": (("commercial_invoice.importer_no", "bill_of_lading.importer_no"), None),
+    "port_of_entry": (("bill_of_lading.port_of_entry", "arrival_notice.port_of_entry"), normalize_port),
+    "port_of_unlading": (("bill_of_lading.port_of_discharge", "arrival_notice.port_of_discharge"), normalize_port),
+    "carrier_scac": (
+        ("bill_of_lading.carrier_scac", "arrival_notice.carrier_scac", "summary.carrier"),
+        normalize_scac,
+    ),
+    "hbl": (("bill_of_lading.hbl",), None),
+    "mbl": (("bill_of_lading.mbl",), None),
+    "country_of_origin": (
+        ("commercial_invoice.country_of_origin", "summary.country_of_origin"),
+        normalize_country,
+    ),
+    "total_value_usd": (
+        ("summary.total_value_usd", "commercial_invoice.total_value_usd"),
+        lambda v: v or 0,
+    ),
+}
+
+ITEM_FIELDS = {
+    "hs_code": (("hs_code",), None),
+    "origin": (("origin",), normalize_country),
+    "value": (("value",), None),
+    "qty": (("qty",), None),
+    "uom": (("uom",), lambda v: v or "PCS"),
+    "mid": (("mid",), None),
+    "description": (("description",), None),
+}
+
+
+def _compile(table):
+    """[(目标字段, [attrgetter...], 规范化函数)]，映射时只剩属性访问"""
+    return [
+        (name, [attrgetter(src) for src in sources], fn)
+        for name, (sources, fn) in table.items()
+    ]
+
+
+_ENTRY_MAPPER = _compile(ENTRY_FIELDS)
+_ITEM_MAPPER = _compile(ITEM_FIELDS)
+
+
+def _apply(mapper, obj) -> Dict[str, Any]:
+    out = {}
+    for name, getters, fn in mapper:
+        v = None
+        for get in getters:
+            v = get(obj)
+            if v is not None:
+                break
+        out[name] = fn(v) if fn else v
+    return out
+
+
 # -------------------- 主 mapping 函数 --------------------
 def map_to_entry_json(raw: Dict[str, Any]) -> Dict[str, Any]:
-    summary = raw.get("summary", {}) or {}
-    bol = raw.get("bill_of_lading", {}) or {}
-    inv = raw.get("commercial_invoice", {}) or {}
-    pl = raw.get("packing_list", {}) or {}
-    an = raw.get("arrival_notice", {}) or {}
-
-    # --------------- Header 字段 ---------------
-
-    entry_no = _safe_extract(raw.get("entry_no"))
-    entry_type = _safe_extract(raw.get("entry_type")) or "01"
-
-    importer_no = (
-        _safe_extract(inv.get("importer_no"))
-        or _safe_extract(inv.get("importer_id"))
-        or _safe_extract(bol.get("importer_no"))
-        or None
-    )
-
-    port_of_entry = normalize_port(
-        bol.get("port_of_entry") or an.get("port_of_entry")
-    )
-
-    port_of_unlading = normalize_port(
-        bol.get("port_of_discharge") or an.get("port_of_discharge")
-    )
-
-    carrier_scac = normalize_scac(
-        bol.get("carrier_scac") or an.get("carrier_scac") or summary.get("carrier")
-    )
-
-    hbl = _safe_extract(
-        bol.get("house_bl_no") or bol.get("hbl") or bol.get("hbl_no")
-    )
-    mbl = _safe_extract(
-        bol.get("master_bl_no") or bol.get("mbl") or bol.get("mbl_no")
-    )
-
-    country_of_origin = normalize_country(
-        inv.get("country_of_origin") or summary.get("country_of_origin")
-    )
-
-    total_value_usd = (
-        summary.get("total_value_usd")
-        or inv.get("total_value_usd")
-        or inv.get("total_amount")
-        or 0
-    )
-
-    # --------------- Line Items ---------------
-    items_src = inv.get("items", []) or []
-    items: List[Dict[str, Any]] = []
-
-    for it in items_src:
-        items.append({
-            "hs_code": _safe_extract(it.get("hs_code") or it.get("hts") or it.get("tariff")),
-            "origin": normalize_country(it.get("origin")),
-            "value": _safe_extract(it.get("amount") or it.get("total") or it.get("line_total")),
-            "qty": _safe_extract(it.get("qty") or it.get("quantity")),
-            "uom": _safe_extract(it.get("uom") or it.get("unit") or "PCS"),
-            "mid": _safe_extract(it.get("mid") or it.get("manufacturer_id")),
-            "description": _safe_extract(it.get("description"))
-        })
-
-    entry_json = {
-        "entry_no": entry_no,
-        "entry_type": entry_type,
-        "importer_no": importer_no,
-        "broker_no": BROKER_NO,
-        "port_of_entry": port_of_entry,
-        "port_of_unlading": port_of_unlading,
-        "carrier_scac": carrier_scac,
-        "hbl": hbl,
-        "mbl": mbl,
-        "country_of_origin": country_of_origin,
-        "total_value_usd": total_value_usd,
-        "items": items,
-    }
+    """
+    GPT 结果 → Entry JSON。
+    解码失败的字段记在 validation_errors（字段路径 + 原因），其余字段照常映射。
+    """
+    doc, errors = decode(AnalysisResult, raw)
+
+    entry_json = _apply(_ENTRY_MAPPER, doc)
+    entry_json["broker_no"] = BROKER_NO
+    entry_json["items"] = [
+        _apply(_ITEM_MAPPER, it)
+        for it in doc.commercial_invoice.items
+        # 解码失败被置空的行不输出
+        if any(v is not None for v in it.__dict__.values())
+    ]
+    entry_json["validation_errors"] = errors
 
     return entry_json
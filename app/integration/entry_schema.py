@@ -0,0 +1,299 @@
+# app/integration/entry_schema.py
+"""
+GPT 解析结果 / Entry JSON 的类型化 schema（pydantic v2）
+
+以前 map_to_entry_json 每个字段都是 bol.get("house_bl_no") or bol.get("hbl") or ...，
+每个值再递归 _safe_extract 一遍；entry_xml_builder.to_str 又重复一次同样的拆包，
+格式错误的数据（金额 "USD 1,2O0"、items 里混进字符串）一路透传到 XML。
+
+这里：
+1) 别名表（ALIASES）声明每个规范字段在 GPT 输出里可能出现的键名，按优先级排列
+2) 模型在导入时编译一次（pydantic-core），解码是一次遍历：别名解析 + 拆包 + 类型转换
+3) 某个字段解码失败不影响其他字段：错误按字段路径收集，该字段置空后重新解码
+   （同一字段的低优先级别名一起丢掉，不会拿 total 顶替解析失败的 amount）
+"""
+
+from typing import Annotated, Any, Dict, List, Optional, Tuple, Type
+
+from pydantic import (
+    AliasChoices,
+    BaseModel,
+    BeforeValidator,
+    ConfigDict,
+    Field,
+    ValidationError,
+    create_model,
+    model_validator,
+)
+
+# dict 形式的值（{"value": ...} / {"text": ...}）按这个顺序拆包
+UNWRAP_KEYS = ("value", "raw", "text", "name")
+
+# 单个字段最多重新解码几轮（每轮丢掉出错的字段）
+MAX_DECODE_PASSES = 4
+
+
+# ---------------------- 标量拆包 / 数字解析 ---------------------- #
+
+def _format_float(v: float) -> str:
+    """整数值不带 .0（XML 里是 100 而不是 100.0），其余定点格式，不出现科学计数法"""
+    if v.is_integer():
+        return str(int(v))
+    s = f"{v:.10f}".rstrip("0").rstrip(".")
+    return s if s not in ("", "-0") else "0"
+
+
+def to_scalar(v) -> Optional[str]:
+    """
+    无论 GPT 返回 str / dict / list / None，都转换成安全 string。
+    dict 取 value/raw/text/name，list 取第一个元素。
+    """
+    while True:
+        if v is None:
+            return None
+        if isinstance(v, str):
+            return v.strip()
+        if isinstance(v, float):
+            return _format_float(v)
+        if isinstance(v, (bool, int)):
+            return str(v)
+        if isinstance(v, dict):
+            k = next((k for k in UNWRAP_KEYS if k in v), None)
+            if k is None:
+                return str(v)
+            v = v[k]
+            continue
+        if isinstance(v, list):
+            if not v:
+                return None
+            v = v[0]
+            continue
+        return str(v)
+
+
+_NUMBER_JUNK = str.maketrans("", "", ",$  ")
+_UNIT_SUFFIXES = ("USD", "KGS", "KG", "CBM", "CTNS", "CTN", "PCS", "PKGS", "PKG")
+
+
+def to_number(v) -> Optional[float]:
+    """"USD 1,234.50" / "12 CTNS" / 12 → float；空值 → None；无法解析 → ValueError（记为字段错误）"""
+    if isinstance(v, bool):
+        raise ValueError("布尔值不是数字")
+    if isinstance(v, (int, float)):
+        return float(v)
+    s = to_scalar(v)
+    if not s:
+        return None
+    s = s.upper().translate(_NUMBER_JUNK)
+    for unit in _UNIT_SUFFIXES:
+        s = s.replace(unit, "")
+    if not s:
+        return None
+    try:
+        return float(s)
+    except ValueError:
+        raise ValueError(f"无法解析为数字: {to_scalar(v)!r}")
+
+
+Scalar = Annotated[Optional[str], BeforeValidator(to_scalar)]
+Number = Annotated[Optional[float], BeforeValidator(to_number)]
+
+
+def _is_empty(v) -> bool:
+    return v is None or v == "" or v == [] or v == {}
+
+
+class _Section(BaseModel):
+    """
+    空值先剔除，别名按顺序取第一个非空键 —— 与原来 `a or b or c` 的语义一致
+    """
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+    @model_validator(mode="before")
+    @classmethod
+    def _drop_empty(cls, data):
+        if isinstance(data, dict):
+            return {k: v for k, v in data.items() if not _is_empty(v)}
+        return data
+
+
+# ---------------------- 别名表 ---------------------- #
+
+# 规范字段名 → (类型, GPT 输出里可能的键名，优先级从高到低)
+ALIASES: Dict[str, Dict[str, Tuple[Any, Tuple[str, ...]]]] = {
+    "invoice_item": {
+        "hs_code": (Scalar, ("hs_code", "hts", "tariff")),
+        "origin": (Scalar, ("origin", "country_of_origin")),
+        "value": (Number, ("amount", "total", "line_total")),
+        "qty": (Number, ("qty", "quantity")),
+        "uom": (Scalar, ("uom", "unit")),
+        "mid": (Scalar, ("mid", "manufacturer_id")),
+        "description": (Scalar, ("description",)),
+    },
+    "bill_of_lading": {
+        "hbl": (Scalar, ("house_bl_no", "hbl", "hbl_no")),
+        "mbl": (Scalar, ("master_bl_no", "mbl", "mbl_no")),
+        "importer_no": (Scalar, ("importer_no",)),
+        "port_of_entry": (Scalar, ("port_of_entry",)),
+        "port_of_discharge": (Scalar, ("port_of_discharge",)),
+        "carrier_scac": (Scalar, ("carrier_scac",)),
+    },
+    "arrival_notice": {
+        "port_of_entry": (Scalar, ("port_of_entry",)),
+        "port_of_discharge": (Scalar, ("port_of_discharge",)),
+        "carrier_scac": (Scalar, ("carrier_scac",)),
+    },
+    "commercial_invoice": {
+        "importer_no": (Scalar, ("importer_no", "importer_id")),
+        "country_of_origin": (Scalar, ("country_of_origin",)),
+        "total_value_usd": (Number, ("total_value_usd", "total_amount")),
+    },
+    "summary": {
+        "carrier": (Scalar, ("carrier",)),
+        "country_of_origin": (Scalar, ("country_of_origin",)),
+        "total_value_usd": (Number, ("total_value_usd",)),
+    },
+}
+
+
+# 别名 → 同一规范字段的全部别名（解码出错时整组丢掉）
+_ALIAS_GROUPS: Dict[str, set] = {}
+for _section in ALIASES.values():
+    for _typ, _aliases in _section.values():
+        for _a in _aliases:
+            _ALIAS_GROUPS.setdefault(_a, set()).update(_aliases)
+
+
+def _compile_section(name: str, extra: Optional[Dict[str, Any]] = None) -> Type[_Section]:
+    fields: Dict[str, Any] = {}
+    for field, (typ, aliases) in ALIASES[name].items():
+        fields[field] = (typ, Field(None, validation_alias=AliasChoices(*aliases)))
+    fields.update(extra or {})
+    model_name = "".join(p.title() for p in name.split("_"))
+    return create_model(model_name, __base__=_Section, **fields)
+
+
+InvoiceItem = _compile_section("invoice_item")
+BillOfLading = _compile_section("bill_of_lading")
+ArrivalNotice = _compile_section("arrival_notice")
+CommercialInvoice = _compile_section(
+    "commercial_invoice", {"items": (List[InvoiceItem], Field(default_factory=list))}
+)
+Summary = _compile_section("summary")
+
+
+class AnalysisResult(_Section):
+    """GPT 解析结果里 entry mapping 用得到的部分"""
+    entry_no: Scalar = None
+    entry_type: Scalar = None
+    summary: Summary = Field(default_factory=Summary)
+    bill_of_lading: BillOfLading = Field(default_factory=BillOfLading)
+    commercial_invoice: CommercialInvoice = Field(default_factory=CommercialInvoice)
+    arrival_notice: ArrivalNotice = Field(default_factory=ArrivalNotice)
+
+
+# ---------------------- Entry JSON ---------------------- #
+
+class EntryItem(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    hs_code: Scalar = None
+    origin: Scalar = None
+    value: Number = None
+    qty: Number = None
+    uom: Scalar = None
+    mid: Scalar = None
+    description: Scalar = None
+
+
+class EntryJson(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    entry_no: Scalar = None
+    entry_type: Scalar = None
+    importer_no: Scalar = None
+    broker_no: Scalar = None
+    port_of_entry: Scalar = None
+    port_of_unlading: Scalar = None
+    carrier_scac: Scalar = None
+    hbl: Scalar = None
+    mbl: Scalar = None
+    country_of_origin: Scalar = None
+    total_value_usd: Number = None
+    items: List[EntryItem] = Field(default_factory=list)
+
+
+# ---------------------- 解码（逐字段收集错误） ---------------------- #
+
+def _loc_path(loc) -> str:
+    path = ""
+    for p in loc:
+        path += f"[{p}]" if isinstance(p, int) else (f".{p}" if path else str(p))
+    return path
+
+
+def _drop(data, loc) -> bool:
+    """
+    按错误位置把输入里对应的值删掉（list 元素换成空 dict），返回是否删成功。
+    出错的是别名时同组别名一起删：最高优先级的键有值但解析失败，字段就是 None，不回落到下一个别名
+    """
+    if not loc:
+        return False
+    cur = data
+    for p in loc[:-1]:
+        try:
+            cur = cur[p]
+        except (KeyError, IndexError, TypeError):
+            return False
+    last = loc[-1]
+    if isinstance(cur, dict) and last in cur:
+        for k in _ALIAS_GROUPS.get(last, {last}):
+            cur.pop(k, None)
+        return True
+    if isinstance(cur, list) and isinstance(last, int) and 0 <= last < len(cur):
+        cur[last] = {}
+        return True
+    return False
+
+
+def _copy(v):
+    """只复制容器，叶子值共享（比 deepcopy 快得多）"""
+    if isinstance(v, dict):
+        return {k: _copy(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_copy(x) for x in v]
+    return v
+
+
+def decode(model: Type[BaseModel], data: Any) -> Tuple[BaseModel, List[Dict[str, Any]]]:
+    """
+    解码为类型化结构，返回 (实例, 错误列表)。
+    错误: {"field": "commercial_invoice.items[3].amount", "error": "...", "input": ...}
+    出错的字段置空后重新解码，其余字段照常保留。
+    """
+    errors: List[Dict[str, Any]] = []
+    if not isinstance(data, dict):
+        errors.append({"field": "", "error": f"期望 JSON 对象，实际是 {type(data).__name__}", "input": None})
+        data = {}
+
+    copied = False
+    for _ in range(MAX_DECODE_PASSES):
+        try:
+            return model.model_validate(data), errors
+        except ValidationError as e:
+            if not copied:
+                data, copied = _copy(data), True
+            dropped = False
+            for err in e.errors(include_url=False):
+                loc = tuple(err["loc"])
+                bad = err.get("input")
+                errors.append({
+                    "field": _loc_path(loc),
+                    "error": err["msg"],
+                    "input": None if isinstance(bad, (dict, list)) else bad,
+                })
+                dropped = _drop(data, loc) or dropped
+            if not dropped:
+                break
+
+    return model(), errors
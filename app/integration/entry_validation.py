@@ -0,0 +1,218 @@
+# app/integration/entry_validation.py
+"""
+entryUpload XML 提交前的本地校验
+
+以前 build_entry_upload_xml 生成什么就直接发 NET CHB，缺 importerNo、tariff 为空、
+portOfEntry 不对这类错误要等一次 SOAP 往返（最长 30 秒）才知道，还占用 NET CHB 的配额。
+这里在本地先过两层：
+
+1) XSD：schemas/entry_upload.xsd（或 NETCHB_ENTRY_XSD 指定的文件），编译一次后缓存；
+   需要 lxml（zeep 的依赖），没装时跳过这一层。
+   NET CHB 没有公开 entryXml 的 schema，自带的 XSD 是按我们的 builder 推测的，报出的问题只作 warning；
+   拿到 NET CHB 官方 schema 后用 NETCHB_ENTRY_XSD 指过去、并设 NETCHB_XSD_BLOCKING=1，才按 error 拦截
+2) 业务规则：必填字段（进口商 / 报关行 / 口岸 / SCAC 等）、HBL/MBL 至少一个、每行 tariff / 原产国 / 金额、
+   合计行数与金额、transmitFlag=N
+
+返回结构化的问题列表，有 error 级别的问题就不提交。
+"""
+
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, Optional
+
+from app import config
+
+NETCHB_PREVALIDATE = config.getenv_bool("NETCHB_PREVALIDATE", True)
+ENTRY_XSD_PATH = config.getenv(
+    "NETCHB_ENTRY_XSD",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas", "entry_upload.xsd"),
+)
+# XSD 报错是否拦截提交（只有换成 NET CHB 官方 schema 时才应打开）
+NETCHB_XSD_BLOCKING = config.getenv_bool("NETCHB_XSD_BLOCKING", False)
+# 行金额合计与 totalEnteredValue 的相对误差容忍度
+TOTAL_VALUE_TOLERANCE = config.getenv_float("ENTRY_TOTAL_TOLERANCE", 0.01)
+
+HEADER_REQUIRED = {
+    "entryType": "Entry 类型",
+    "importerNo": "进口商编号（IOR）",
+    "brokerNo": "报关行编号",
+    "portOfEntry": "入境口岸代码",
+    "carrierSCAC": "承运人 SCAC",
+    "countryOfOrigin": "原产国",
+}
+
+_PORT_RE = re.compile(r"^\d{4}$")
+_COUNTRY_RE = re.compile(r"^[A-Z]{2}$")
+
+_schema = None
+_schema_loaded = False
+_schema_lock = threading.Lock()
+
+
+# ---------------------- 1) XSD ---------------------- #
+
+def load_schema():
+    """编译并缓存 XSD；没有 lxml 或文件不存在时返回 None（只做业务规则校验）"""
+    global _schema, _schema_loaded
+    if _schema_loaded:
+        return _schema
+    with _schema_lock:
+        if _schema_loaded:
+            return _schema
+        try:
+            from lxml import etree
+        except ImportError:
+            print("⚠ 未安装 lxml，entryUpload 只做业务规则校验")
+        else:
+            if os.path.exists(ENTRY_XSD_PATH):
+                _schema = etree.XMLSchema(etree.parse(ENTRY_XSD_PATH))
+            else:
+                print(f"⚠ 找不到 entryUpload XSD: {ENTRY_XSD_PATH}")
+        _schema_loaded = True
+    return _schema
+
+
+def _xsd_field(path: Optional[str]) -> str:
+    """/entryUpload/entry/lineItems/lineItem[2]/tariff → lineItems/lineItem[2]/tariff"""
+    if not path:
+        return ""
+    return re.sub(r"^/entryUpload/entry/?", "", path)
+
+
+def _field_key(field: str) -> str:
+    """去重用：lxml 对唯一的兄弟元素不带下标（lineItem/quantity），业务规则总是带（lineItem[1]/quantity）"""
+    return field.replace("[1]", "")
+
+
+def _xsd_issues(entry_xml: str) -> List[Dict[str, Any]]:
+    schema = load_schema()
+    if schema is None:
+        return []
+    from lxml import etree
+
+    doc = etree.fromstring(entry_xml.encode("utf-8"))
+    if schema.validate(doc):
+        return []
+    severity = "error" if NETCHB_XSD_BLOCKING else "warning"
+    return [
+        _issue(severity, "xsd", _xsd_field(err.path), err.message)
+        for err in schema.error_log
+    ]
+
+
+# ---------------------- 2) 业务规则 ---------------------- #
+
+def _issue(severity: str, source: str, field: str, message: str) -> Dict[str, Any]:
+    return {"severity": severity, "source": source, "field": field, "message": message}
+
+
+def _text(el, tag: str) -> str:
+    child = el.find(tag) if el is not None else None
+    return (child.text or "").strip() if child is not None else ""
+
+
+def _decimal(s: str) -> Optional[float]:
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return None
+
+
+def _rule_issues(root) -> List[Dict[str, Any]]:
+    issues: List[Dict[str, Any]] = []
+    header = root.find("entry/entryHeader")
+    if header is None:
+        return [_issue("error", "rule", "entryHeader", "缺少 entryHeader")]
+
+    for tag, label in HEADER_REQUIRED.items():
+        if not _text(header, tag):
+            issues.append(_issue("error", "rule", f"entryHeader/{tag}", f"{label}为空"))
+
+    port = _text(header, "portOfEntry")
+    if port and not _PORT_RE.match(port):
+        issues.append(_issue("error", "rule", "entryHeader/portOfEntry", f"口岸代码应为 4 位数字: {port}"))
+
+    if not _text(header, "houseBOLNumber") and not _text(header, "masterBOLNumber"):
+        issues.append(_issue("error", "rule", "entryHeader/masterBOLNumber", "HBL / MBL 至少需要一个"))
+
+    if _text(header, "transmitFlag") != "N":
+        issues.append(_issue("error", "rule", "entryHeader/transmitFlag", "草稿模式 transmitFlag 必须为 N"))
+
+    lines = root.findall("entry/lineItems/lineItem")
+    if not lines:
+        issues.append(_issue("error", "rule", "lineItems", "没有任何 line item"))
+
+    line_sum = 0.0
+    for idx, li in enumerate(lines, start=1):
+        field = f"lineItems/lineItem[{idx}]"
+
+        tariff = _text(li, "tariff").replace(".", "")
+        if not tariff:
+            issues.append(_issue("error", "rule", f"{field}/tariff", "HTS 编码为空"))
+        elif not tariff.isdigit():
+            issues.append(_issue("error", "rule", f"{field}/tariff", f"HTS 编码含非数字字符: {tariff}"))
+        elif len(tariff) != 10:
+            issues.append(_issue("warning", "rule", f"{field}/tariff", f"HTS 编码不是 10 位: {tariff}"))
+
+        if not _COUNTRY_RE.match(_text(li, "countryOfOrigin")):
+            issues.append(_issue("error", "rule", f"{field}/countryOfOrigin", "原产国应为 2 位 ISO 代码"))
+
+        value = _decimal(_text(li, "value"))
+        if value is None or value <= 0:
+            issues.append(_issue("error", "rule", f"{field}/value", "申报金额缺失或不大于 0"))
+        else:
+            line_sum += value
+
+        if _decimal(_text(li, "quantity")) is None:
+            issues.append(_issue("warning", "rule", f"{field}/quantity", "数量缺失"))
+
+        if not _text(li, "manufacturerId"):
+            issues.append(_issue("warning", "rule", f"{field}/manufacturerId", "MID 为空（正式报关需要）"))
+
+    totals = root.find("entry/totals")
+    count = _decimal(_text(totals, "totalLineItems"))
+    if count is not None and int(count) != len(lines):
+        issues.append(_issue(
+            "error", "rule", "totals/totalLineItems", f"totalLineItems={int(count)} 与实际行数 {len(lines)} 不符"
+        ))
+
+    total = _decimal(_text(totals, "totalEnteredValue"))
+    if total and line_sum and abs(total - line_sum) > TOTAL_VALUE_TOLERANCE * max(total, line_sum):
+        issues.append(_issue(
+            "warning", "rule", "totals/totalEnteredValue",
+            f"totalEnteredValue={total:g} 与行金额合计 {line_sum:g} 不符",
+        ))
+
+    return issues
+
+
+# ---------------------- 入口 ---------------------- #
+
+def validate_entry_xml(entry_xml: str) -> List[Dict[str, Any]]:
+    """
+    返回问题列表：
+    [{"severity": "error"|"warning", "source": "xsd"|"rule", "field": "entryHeader/importerNo", "message": "..."}]
+    同一字段业务规则已报过（error 或 warning）时，不再重复列出 XSD 的报错。
+    """
+    try:
+        root = ET.fromstring(entry_xml)
+    except ET.ParseError as e:
+        return [_issue("error", "xsd", "", f"XML 格式错误: {e}")]
+
+    issues = _rule_issues(root)
+    reported = {_field_key(i["field"]) for i in issues}
+    issues.extend(i for i in _xsd_issues(entry_xml) if _field_key(i["field"]) not in reported)
+    return issues
+
+
+def has_errors(issues: List[Dict[str, Any]]) -> bool:
+    return any(i["severity"] == "error" for i in issues)
+
+
+def format_issues(issues: List[Dict[str, Any]], limit: int = 10) -> str:
+    lines = [f"[{i['severity']}] {i['field']}: {i['message']}" for i in issues[:limit]]
+    if len(issues) > limit:
+        lines.append(f"... 共 {len(issues)} 条")
+    return "\n".join(lines)
@@ -3,22 +3,12 @@
 import xml.etree.ElementTree as ET
 from typing import Dict, Any
 
+from app.integration.entry_schema import to_scalar
+
 
 def to_str(v):
-    if v is None:
-        return ""
-    if isinstance(v, (int, float, bool)):
-        return str(v)
-    if isinstance(v, str):
-        return v.strip()
-    if isinstance(v, dict):
-        for k in ["value", "raw", "text", "name"]:
-            if k in v:
-                return to_str(v[k])
-        return str(v)
-    if isinstance(v, list):
-        return to_str(v[0]) if v else ""
-    return str(v)
+    s = to_scalar(v)
+    return s if s is not None else ""
 
 
 def build_entry_upload_xml(entry_json: Dict[str, Any]) -> str:
@@ -1,22 +1,28 @@
 # app/integration/gmail_auto_reply.py
-import os
+import asyncio
 import json
 import base64
+import os
+from typing import Optional
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-import pickle
-
-from app.integration.gmail_reader import fetch_latest_email_with_attachments
+from app.Gmail_Authen.gmail_oauth import get_gmail_service
+from app.integration.gmail_reader import ATTACH_DIR, fetch_email_by_id, list_message_ids
 from app.integration.analyze_vision import analyze_with_vision   # ← 改成 Vision 版
 # from app.integration.post_entry_upload import upload_entry_from_gpt_result
 from app.integration.post_entry_upload import process_entry_from_gpt
+from app.integration.accounting import customer_of, job_scope
+from app.integration.progress import Progress, emit
+from app.integration.results_store import get_store
+from app.integration.single_flight import ensure_leases, files_digest, single_flight
+from app.integration.thread_merge import analyze_incremental, entry_changes, format_changes, remember_files
+from app import config
 
 
-MY_NOTIFY_EMAIL = os.getenv("MY_NOTIFY_EMAIL")
+MY_NOTIFY_EMAIL = config.getenv("MY_NOTIFY_EMAIL")
+# 同一组附件处理完后多久内不再重复处理（秒）
+FILES_DEDUP_TTL = config.getenv_float("FILES_DEDUP_TTL", 24 * 3600)
 
 
 def send_email(to_addr, subject, body, service):
@@ -28,22 +34,6 @@ def send_email(to_addr, subject, body, service):
     raw = base64.urlsafe_b64encode(msg.as_bytes()).decode()
     service.users().messages().send(userId="me", body={"raw": raw}).execute()
 
-def get_gmail_service():
-    token_path = "app/integration/token.pickle"
-    creds_path = "app/Gmail_Authen/credentials.json"
-    creds = None
-    if os.path.exists(token_path):
-        with open(token_path, "rb") as f:
-            creds = pickle.load(f)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(creds_path, ["https://www.googleapis.com/auth/gmail.modify"])
-            creds = flow.run_local_server(port=0)
-        with open(token_path, "wb") as f:
-            pickle.dump(creds, f)
-    return build("gmail", "v1", credentials=creds)
 
 # async def process_latest_email_and_reply():
 #     msg = fetch_latest_email_with_attachments()
@@ -69,11 +59,19 @@ def get_gmail_service():
 #     send_email(MY_NOTIFY_EMAIL, f"[Copy] Re: {subject}", body, service)
 #
 #     return {"status": "ok", "result": final}
-async def process_latest_email_and_reply():
-    msg = fetch_latest_email_with_attachments()
-    if not msg:
-        return {"status": "no email"}
+def process_email_and_reply(msg, progress: Progress = None):
+    """
+    单封邮件：解析 → Entry 草稿上传 → 存库 → 回信（同步，调用方放到线程里跑）
+    所有模型调用按 message id / 客户记账，返回值带 usage 汇总
+    """
+    with job_scope(msg.get("id"), customer_of(msg)) as job:
+        out = _process_email_and_reply(msg, job, progress)
+    out["usage"] = job.totals()
+    emit(progress, "usage", **out["usage"])
+    return out
 
+
+def _process_email_and_reply(msg, job, progress: Progress = None):
     attachments = msg["files"]
     raw_from = msg["from"]
     subject = msg["subject"]
@@ -86,22 +84,75 @@ async def process_latest_email_and_reply():
     else:
         from_addr = MY_NOTIFY_EMAIL
 
-    # 1️⃣ AI 解析清关文件
-    final = analyze_with_vision(attachments)
+    # 1️⃣ AI 解析清关文件（客户超出当日预算且配置为 defer 时不调用模型）
+    # 同一线程里已解析过：只解析新增 / 改过的附件，合并进上次结果（见 thread_merge.py）
+    if job.action == "defer":
+        final = {"error": f"客户 {job.customer} 已超出当日预算，推迟处理", "deferred": True}
+    else:
+        final = analyze_incremental(msg, progress)
+        if final is None:
+            final = analyze_with_vision(attachments, progress)
+            remember_files(final, msg)
 
-    # 2️⃣ 保存解析结果 JSON
-    os.makedirs("attachments/results", exist_ok=True)
-    with open("attachments/results/latest.json", "w", encoding="utf-8") as f:
-        json.dump(final, f, indent=2, ensure_ascii=False)
+    # 同一线程里附件都解析过：上次的 shipment 已上传、回过信，这封不再重复
+    if isinstance(final, dict) and final.get("unchanged"):
+        return {"status": "unchanged", "shipment_id": final["base_shipment_id"], "result": final}
 
-    # 3️⃣ 基于解析结果，尝试生成并上传 Entry 草稿
+    # OpenAI 熔断：只记一条 DEFERRED，不上传、不回信，等恢复后重跑
+    if isinstance(final, dict) and final.get("deferred"):
+        try:
+            shipment_id = get_store().save_shipment(msg, final)
+        except Exception as e:
+            print("❌ 结果库写入失败:", e)
+            shipment_id = None
+        emit(progress, "deferred", shipment_id=shipment_id, reason=final.get("error"))
+        return {"status": "deferred", "shipment_id": shipment_id, "result": final}
+
+    # 解析失败：记一条 ERROR，不上传、不回信；返回 ERROR 让 single_flight / worker 释放租约，稍后重试
+    if isinstance(final, dict) and "error" in final:
+        try:
+            shipment_id = get_store().save_shipment(msg, final)
+        except Exception as e:
+            print("❌ 结果库写入失败:", e)
+            shipment_id = None
+        emit(progress, "analysis_failed", shipment_id=shipment_id, reason=final.get("error"))
+        return {"status": "ERROR", "shipment_id": shipment_id, "result": final}
+
+    # 2️⃣ 基于解析结果，尝试生成并上传 Entry 草稿
     # entry_upload_result = upload_entry_from_gpt_result(final)
-    entry_upload_result = process_entry_from_gpt(final)
+    # 解析可能很慢：租约已被别的节点接手就不再上传，免得同一封邮件上传两份草稿
+    ensure_leases("上传 NET CHB")
+    entry_upload_result = process_entry_from_gpt(final, progress)
+
+    # 3️⃣ 保存到结果库（GPT 原始输出 / entry JSON / XML / NET CHB 返回）
+    if isinstance(entry_upload_result, dict):
+        entry_json = entry_upload_result.pop("entry_json", None)
+        entry_xml = entry_upload_result.pop("entry_xml", None)
+    else:
+        entry_json = entry_xml = None
+    thread = final.get("thread") if isinstance(final, dict) else None
+    if thread and thread.get("base_shipment_id"):
+        thread["entry_changes"] = entry_changes(final, entry_json)
+    try:
+        shipment_id = get_store().save_shipment(msg, final, entry_json, entry_xml, entry_upload_result)
+    except Exception as e:
+        print("❌ 结果库写入失败:", e)
+        shipment_id = None
+    emit(progress, "stored", shipment_id=shipment_id)
 
     # 4️⃣ 组织回信内容
     body_parts = []
 
     body_parts.append("您好，系统已自动解析您的清关文件，初步结果如下（仅供参考）：\n")
+    if thread and thread.get("base_shipment_id"):
+        body_parts.append(
+            f"本次为同一线程的更新：沿用 {len(thread['reused'])} 个附件，"
+            f"重新解析 {len(thread['extracted'])} 个（对比 shipment #{thread['base_shipment_id']}）\n"
+        )
+        body_parts.append("解析结果变更：\n" + (format_changes(thread["changes"]) or "- 无") + "\n")
+        body_parts.append("Entry 变更：\n" + (format_changes(thread["entry_changes"]) or "- 无") + "\n")
+        if thread.get("warnings"):
+            body_parts.append("⚠ 请人工核对：\n" + "\n".join(f"- {w}" for w in thread["warnings"]) + "\n")
     body_parts.append(json.dumps(final, indent=2, ensure_ascii=False))
 
     # body_parts.append("\n\n--- NET CHB Entry 草稿上传结果（不会自动发送 CBP） ---\n")
@@ -124,9 +175,9 @@ async def process_latest_email_and_reply():
         if entry_no:
             body_parts.append(f"Entry No: {entry_no}\n")
 
-        msg = entry_upload_result.get("message") or entry_upload_result.get("error")
-        if msg:
-            body_parts.append(f"Message: {msg}\n")
+        err_msg = entry_upload_result.get("message") or entry_upload_result.get("error")
+        if err_msg:
+            body_parts.append(f"Message: {err_msg}\n")
 
         # 如果 NET CHB 返回完整 XML，也输出
         raw_resp = entry_upload_result.get("response")
@@ -140,14 +191,70 @@ async def process_latest_email_and_reply():
 
     body = "\n".join(body_parts)
 
+    ensure_leases("回信")
     service = get_gmail_service()
     # 回给客户
     send_email(from_addr, f"Re: {subject}", body, service)
     # 抄送给自己
     send_email(MY_NOTIFY_EMAIL, f"[Copy] Re: {subject}", body, service)
+    emit(progress, "reply", to=from_addr)
 
     return {
         "status": "ok",
+        "shipment_id": shipment_id,
         "result": final,
         "entry_upload": entry_upload_result,
     }
+
+
+def run_latest_email_pipeline(progress: Progress = None):
+    """
+    最新一封带附件的邮件 → process_email_and_reply
+    同一封邮件（message id）/ 同一组附件（内容哈希）并发或重复触发时只处理一次，见 single_flight.py
+    """
+    emit(progress, "download_start")
+    try:
+        ids = list_message_ids("has:attachment", max_results=1)
+    except Exception as e:
+        print("❌ Gmail 读取错误:", e)
+        return {"status": "no email"}
+    if not ids:
+        print("⚠ 没有找到带附件的邮件")
+        return {"status": "no email"}
+
+    msg_id = ids[0]
+    return single_flight(f"gmail:{msg_id}", lambda: process_message_id(msg_id, progress))
+
+
+def _sender_key(msg) -> str:
+    """发件人邮箱（小写）；解析不出邮箱时退回客户（见 accounting.customer_of）"""
+    import re
+    m = re.search(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}", msg.get("from") or "")
+    return m.group(0).lower() if m else (customer_of(msg) or "")
+
+
+def process_message_id(msg_id: str, progress: Progress = None, attach_dir: Optional[str] = None):
+    """
+    下载并处理一封邮件；调用方负责 gmail:<message id> 的租约（single_flight / worker 认领）
+    attach_dir: 附件目录，并发处理多封邮件时每封一个目录，避免同名附件互相覆盖
+    """
+    try:
+        msg = fetch_email_by_id(msg_id, attach_dir=attach_dir or ATTACH_DIR, progress=progress)
+    except Exception as e:
+        print("❌ Gmail 读取错误:", e)
+        return {"status": "no email"}
+    if not msg:
+        return {"status": "no email"}
+    emit(progress, "download_done", message_id=msg.get("id"), files=[os.path.basename(p) for p in msg["files"]])
+
+    if not msg["files"]:
+        return process_email_and_reply(msg, progress)
+    # 同一发件人转发 / 重发的同一组附件：FILES_DEDUP_TTL 内不重复上传 NET CHB 草稿。
+    # key 带上发件人：别的客户 / 货代发来同样的单据要照常处理、照常回信，不能拿别人的结果合并掉
+    key = f"files:{_sender_key(msg)}:{files_digest(msg['files'])}"
+    return single_flight(key, lambda: process_email_and_reply(msg, progress), keep=FILES_DEDUP_TTL)
+
+
+async def process_latest_email_and_reply():
+    # Gmail / GPT / NET CHB 都是阻塞调用，放到线程里，不卡事件循环
+    return await asyncio.to_thread(run_latest_email_pipeline)
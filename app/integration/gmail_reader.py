@@ -1,20 +1,163 @@
 # app/integration/gmail_reader.py
 import os
 import base64
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from email.mime.text import MIMEText
+import html
+import threading
+from typing import Dict, List, Optional
 
 from app.Gmail_Authen.gmail_oauth import get_gmail_service
+from app.integration.progress import Progress, emit
 
 ATTACH_DIR = "attachments"
 
+# 标签名 → 标签 id（进程内缓存，标签不存在时创建）
+_label_ids: Dict[str, str] = {}
+_label_lock = threading.Lock()
 
-def fetch_latest_email_with_attachments():
+
+def list_message_ids(query: str = "has:attachment", max_results: int = 1, service=None) -> List[str]:
+    """
+    按 Gmail 查询语法列出邮件 ID（自动翻页），例如：
+        "has:attachment after:2024/01/01 before:2024/04/01"
+    """
+    service = service or get_gmail_service()
+    ids: List[str] = []
+    page_token = None
+
+    while len(ids) < max_results:
+        results = (
+            service.users()
+            .messages()
+            .list(
+                userId="me",
+                q=query,
+                maxResults=min(500, max_results - len(ids)),
+                pageToken=page_token,
+            )
+            .execute()
+        )
+        ids.extend(m["id"] for m in results.get("messages", []))
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            break
+
+    return ids[:max_results]
+
+
+def _label_id(name: str, service) -> str:
+    with _label_lock:
+        if name in _label_ids:
+            return _label_ids[name]
+        labels = service.users().labels().list(userId="me").execute().get("labels", [])
+        _label_ids.update({l["name"]: l["id"] for l in labels})
+        if name not in _label_ids:
+            created = service.users().labels().create(
+                userId="me",
+                body={"name": name, "labelListVisibility": "labelShow", "messageListVisibility": "show"},
+            ).execute()
+            _label_ids[name] = created["id"]
+        return _label_ids[name]
+
+
+def set_label(msg_id: str, name: str, add: bool = True, service=None):
+    """给邮件加 / 去掉标签（worker 用标签标记已处理 / 已放弃的邮件，列表查询时用 -label: 排除）"""
+    service = service or get_gmail_service()
+    label = _label_id(name, service)
+    body = {"addLabelIds": [label]} if add else {"removeLabelIds": [label]}
+    service.users().messages().modify(userId="me", id=msg_id, body=body).execute()
+
+
+def fetch_message_meta(msg_id: str, service=None) -> dict:
+    """
+    只取邮件头和摘要，不下载附件（worker 排优先级用）。
+    返回 {"id", "thread_id", "from", "subject", "snippet", "received_at"(秒)}
+    """
+    service = service or get_gmail_service()
+    msg = (
+        service.users()
+        .messages()
+        .get(userId="me", id=msg_id, format="metadata", metadataHeaders=["From", "Subject"])
+        .execute()
+    )
+    headers = {h["name"]: h["value"] for h in msg.get("payload", {}).get("headers", [])}
+    internal = msg.get("internalDate")
+    return {
+        "id": msg_id,
+        "thread_id": msg.get("threadId"),
+        "from": headers.get("From", ""),
+        "subject": headers.get("Subject", ""),
+        "snippet": html.unescape(msg.get("snippet", "")),
+        "received_at": int(internal) / 1000.0 if internal else None,
+    }
+
+
+def fetch_email_by_id(msg_id: str, service=None, attach_dir: str = ATTACH_DIR,
+                      progress: Progress = None) -> Optional[dict]:
+    """
+    下载指定邮件的附件到 attach_dir。
+    返回:
+    {
+        "id": "...",
+        "from": "...",
+        "subject": "...",
+        "files": ["attachments/a.pdf", "attachments/b.xls"]
+    }
+    """
+    service = service or get_gmail_service()
+    msg = (
+        service.users().messages().get(userId="me", id=msg_id).execute()
+    )
+
+    # ---------------------
+    # 解析邮件头
+    # ---------------------
+    headers = msg["payload"]["headers"]
+    msg_from = next(h["value"] for h in headers if h["name"] == "From")
+    subject = next(h["value"] for h in headers if h["name"] == "Subject")
+
+    # ---------------------
+    # 下载附件
+    # ---------------------
+    saved_files = []
+
+    parts = msg["payload"].get("parts", [])
+    os.makedirs(attach_dir, exist_ok=True)
+
+    for part in parts:
+        if part.get("filename"):
+            attach_id = part["body"]["attachmentId"]
+            attach = (
+                service.users()
+                .messages()
+                .attachments()
+                .get(userId="me", messageId=msg_id, id=attach_id)
+                .execute()
+            )
+            file_data = base64.urlsafe_b64decode(attach["data"])
+            save_path = os.path.join(attach_dir, part["filename"])
+
+            with open(save_path, "wb") as f:
+                f.write(file_data)
+
+            print(f"📥 下载成功: {save_path}")
+            saved_files.append(save_path)
+            emit(progress, "download", file=part["filename"], bytes=len(file_data))
+
+    return {
+        "id": msg_id,
+        "thread_id": msg.get("threadId"),
+        "from": msg_from,
+        "subject": subject,
+        "files": saved_files,
+    }
+
+
+def fetch_latest_email_with_attachments(progress: Progress = None):
     """
     获取 Gmail 中最新一封带附件的邮件。
     返回:
     {
+        "id": "...",
         "from": "...",
         "subject": "...",
         "files": ["attachments/a.pdf", "attachments/b.xls"]
@@ -24,62 +167,12 @@ def fetch_latest_email_with_attachments():
     try:
         service = get_gmail_service()
 
-        results = (
-            service.users()
-            .messages()
-            .list(userId="me", q="has:attachment", maxResults=1)
-            .execute()
-        )
-
-        messages = results.get("messages", [])
-        if not messages:
+        ids = list_message_ids("has:attachment", max_results=1, service=service)
+        if not ids:
             print("⚠ 没有找到带附件的邮件")
             return None
 
-        msg_id = messages[0]["id"]
-        msg = (
-            service.users().messages().get(userId="me", id=msg_id).execute()
-        )
-
-        # ---------------------
-        # 解析邮件头
-        # ---------------------
-        headers = msg["payload"]["headers"]
-        msg_from = next(h["value"] for h in headers if h["name"] == "From")
-        subject = next(h["value"] for h in headers if h["name"] == "Subject")
-
-        # ---------------------
-        # 下载附件
-        # ---------------------
-        saved_files = []
-
-        parts = msg["payload"].get("parts", [])
-        os.makedirs(ATTACH_DIR, exist_ok=True)
-
-        for part in parts:
-            if part.get("filename"):
-                attach_id = part["body"]["attachmentId"]
-                attach = (
-                    service.users()
-                    .messages()
-                    .attachments()
-                    .get(userId="me", messageId=msg_id, id=attach_id)
-                    .execute()
-                )
-                file_data = base64.urlsafe_b64decode(attach["data"])
-                save_path = os.path.join(ATTACH_DIR, part["filename"])
-
-                with open(save_path, "wb") as f:
-                    f.write(file_data)
-
-                print(f"📥 下载成功: {save_path}")
-                saved_files.append(save_path)
-
-        return {
-            "from": msg_from,
-            "subject": subject,
-            "files": saved_files,
-        }
+        return fetch_email_by_id(ids[0], service=service, progress=progress)
 
     except Exception as e:
         print("❌ Gmail 读取错误:", e)
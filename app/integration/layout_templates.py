@@ -0,0 +1,532 @@
+# app/integration/layout_templates.py
+"""
+供应商版式指纹 + 模板抽取
+
+大部分单量来自几十家固定的货代 / 供应商，提单和发票每次都是同一个版式，却每票都走完整的 vision 解析。这里：
+
+1) 指纹：PyMuPDF 文本层里不含数字的 span（标签文字）+ 所在页 / 量化坐标 / 字体 / 字号；
+   页面尺寸 + 页数作为 signature 先粗筛，再看模板的稳定标签在新文档里出现的比例（≥ LAYOUT_MIN_MATCH）
+2) 学习：每次 GPT 结果出来后，在每份 PDF 的 span 里找 GPT 给出的字段值，记下字段坐标（页 / 起点 / 前缀）；
+   发票 / 装箱单的 items 记每列的 x 范围和表格起始 y。同一版式下一份文档本地读出的值和 GPT 一致，
+   该字段确认数 +1；不一致就换成新坐标、确认数归 1（版式变了会自己纠正）
+3) 抽取：所有附件都是命中模板的文本 PDF、且用到的字段都确认过 LAYOUT_CONFIRMATIONS 次，才本地抽取，
+   不调用模型；结果用现有的归一化（to_number / to_scalar）和质量检查（model_cascade.check_result，
+   含 reconciliation.run_checks 数字对账）验证，不通过视为版式漂移，回退到模型
+4) 缓存：每个 signature 的模板缓存在进程内，取用前对一下结果库里的版本（模板数 / 样本数 / 更新时间），
+   别的 worker 进程学到的新坐标也能马上用上；学习时先复制再改，缓存里的模板不会被改到一半
+"""
+
+import copy
+import os
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from app import config
+
+LAYOUT_TEMPLATES_ENABLED = config.getenv_bool("LAYOUT_TEMPLATES_ENABLED", True)
+# 字段被 GPT 结果确认多少次后才用于本地抽取
+LAYOUT_CONFIRMATIONS = config.getenv_int("LAYOUT_CONFIRMATIONS", 2)
+# 模板的稳定标签在新文档里出现的比例
+LAYOUT_MIN_MATCH = config.getenv_float("LAYOUT_MIN_MATCH", 0.8)
+# 本地结果的质量分（check_result）低于该值 → 回退模型
+LAYOUT_MIN_CONFIDENCE = config.getenv_float("LAYOUT_MIN_CONFIDENCE", 1.0)
+# 坐标容差（pt）
+LAYOUT_POS_TOL = config.getenv_float("LAYOUT_POS_TOL", 6)
+LAYOUT_MAX_PAGES = 3
+LAYOUT_MIN_LABELS = 5
+QUANT = 8
+ROW_TOL = 3
+
+SCALAR_SECTIONS = ("summary", "bill_of_lading", "arrival_notice", "commercial_invoice", "packing_list")
+TABLE_PATHS = ("commercial_invoice.items", "packing_list.items")
+TOTAL_WORDS = ("TOTAL", "合计", "总计")
+
+_NUM_RE = re.compile(r"\d[\d,]*(?:\.\d+)?")
+# signature → (结果库版本, 模板列表)
+_cache: Dict[str, Tuple[Tuple[int, int, int], List[Dict[str, Any]]]] = {}
+_cache_lock = threading.Lock()
+
+
+# ---------------------- 版式读取 / 指纹 ---------------------- #
+
+def read_layout(path: str) -> Optional[Dict[str, Any]]:
+    """前 LAYOUT_MAX_PAGES 页的 span（文字 / bbox / 字体 / 字号）；没有文本层返回 None"""
+    import fitz  # PyMuPDF
+
+    try:
+        doc = fitz.open(path)
+    except Exception:
+        return None
+    with doc:
+        pages = []
+        for i, page in enumerate(doc):
+            if i >= LAYOUT_MAX_PAGES:
+                break
+            spans = []
+            for block in page.get_text("dict").get("blocks", []):
+                for line in block.get("lines", []):
+                    for sp in line.get("spans", []):
+                        text = " ".join(sp.get("text", "").split())
+                        if text:
+                            spans.append({
+                                "text": text,
+                                "bbox": [round(v, 1) for v in sp["bbox"]],
+                                "font": sp.get("font", ""),
+                                "size": round(sp.get("size", 0), 1),
+                            })
+            pages.append(spans)
+        if not any(pages):
+            return None
+        rect = doc[0].rect
+        signature = f"{round(rect.width)}x{round(rect.height)}:{len(pages)}"
+    return {"signature": signature, "pages": pages}
+
+
+def labels(layout: Dict[str, Any], skip: Optional[Dict[str, Any]] = None) -> Set[str]:
+    """
+    不含数字的 span 视为版式标签：页|x|y|字体|字号|文字
+    skip: 建模板时排除的 span —— {"spans": {(页, x, y)} 字段值所在 span, "tables": {页: 表格起始 y}}
+    """
+    skip = skip or {"spans": set(), "tables": {}}
+    out = set()
+    for p, spans in enumerate(layout["pages"]):
+        table_y = skip["tables"].get(p)
+        for sp in spans:
+            t = sp["text"]
+            if any(c.isdigit() for c in t) or sum(c.isalpha() for c in t) < 2:
+                continue
+            x0, y0 = sp["bbox"][:2]
+            if (p, x0, y0) in skip["spans"] or (table_y is not None and y0 >= table_y):
+                continue
+            out.add(f"{p}|{round(x0 / QUANT)}|{round(y0 / QUANT)}|{sp['font']}|{sp['size']:g}|{t.upper()}")
+    return out
+
+
+def _templates(signature: str) -> List[Dict[str, Any]]:
+    """缓存里的模板是只读的，要改先 copy.deepcopy"""
+    from app.integration.results_store import get_store
+
+    store = get_store()
+    version = store.layout_templates_version(signature)
+    with _cache_lock:
+        cached = _cache.get(signature)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    templates = store.list_layout_templates(signature)
+    with _cache_lock:
+        _cache[signature] = (version, templates)
+    return templates
+
+
+def _invalidate(signature: str):
+    with _cache_lock:
+        _cache.pop(signature, None)
+
+
+def match_template(layout: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], float]:
+    found = labels(layout)
+    best, best_score = None, 0.0
+    for tpl in _templates(layout["signature"]):
+        stable = set(tpl["labels"])
+        if len(stable) < LAYOUT_MIN_LABELS:
+            continue
+        score = len(stable & found) / len(stable)
+        if score > best_score:
+            best, best_score = tpl, score
+    if best_score < LAYOUT_MIN_MATCH:
+        return None, best_score
+    return best, best_score
+
+
+# ---------------------- 值定位 / 读取 ---------------------- #
+
+def _num(s) -> Optional[float]:
+    from app.integration.entry_schema import to_number
+    try:
+        return to_number(s)
+    except ValueError:
+        return None
+
+
+def _is_number(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _same(a, b) -> bool:
+    """本地读出的值与 GPT 的值是否一致：有一方是数字就按数字比（0.5% 容差），否则忽略大小写 / 空白比"""
+    if a is None or b is None:
+        return False
+    if _is_number(a) or _is_number(b):
+        na = float(a) if _is_number(a) else _num(a)
+        nb = float(b) if _is_number(b) else _num(b)
+        return na is not None and nb is not None and abs(na - nb) <= 0.005 * max(1.0, abs(na), abs(nb))
+    return " ".join(str(a).split()).upper() == " ".join(str(b).split()).upper()
+
+
+def _find_value(layout: Dict[str, Any], value, page: Optional[int] = None, min_y: Optional[float] = None,
+                row_y: Optional[float] = None, whole: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    在 span 里找 value，返回定位 {"page", "x", "y", "x1", "prefix", "suffix", "kind"}。
+    page / min_y / row_y 限定搜索范围（表格用）；whole=True 要求 value 从 span 开头开始
+    """
+    numeric = _is_number(value)
+    if numeric:
+        target = float(value)
+        # 个位数整数到处都是，定位不可靠
+        if target.is_integer() and abs(target) < 10:
+            return None
+    else:
+        target = " ".join(str(value).split()).upper()
+        if len(target) < 2:
+            return None
+
+    for p, spans in enumerate(layout["pages"]):
+        if page is not None and p != page:
+            continue
+        for sp in spans:
+            x0, y0, x1, _ = sp["bbox"]
+            if min_y is not None and y0 < min_y:
+                continue
+            if row_y is not None and abs(y0 - row_y) > ROW_TOL:
+                continue
+            t = sp["text"].upper()
+            if numeric:
+                for m in _NUM_RE.finditer(t):
+                    n = _num(m.group())
+                    if n is not None and abs(n - target) <= 1e-6 * max(1.0, abs(target)):
+                        if whole and m.start() > 0:
+                            continue
+                        return {"page": p, "x": x0, "y": y0, "x1": x1, "prefix": t[:m.start()], "kind": "number"}
+                continue
+            i = t.find(target)
+            if i < 0 or (whole and i > 0):
+                continue
+            return {
+                "page": p, "x": x0, "y": y0, "x1": x1,
+                "prefix": t[:i], "suffix": t[i + len(target):], "kind": "text",
+            }
+    return None
+
+
+def read_field(layout: Dict[str, Any], loc: Dict[str, Any]):
+    """按定位读取字段值；起点在容差内、前缀一致的 span 里取"""
+    if loc["page"] >= len(layout["pages"]):
+        return None
+    spans = [
+        sp for sp in layout["pages"][loc["page"]]
+        if abs(sp["bbox"][0] - loc["x"]) <= LAYOUT_POS_TOL and abs(sp["bbox"][1] - loc["y"]) <= LAYOUT_POS_TOL
+    ]
+    spans.sort(key=lambda sp: abs(sp["bbox"][0] - loc["x"]) + abs(sp["bbox"][1] - loc["y"]))
+    for sp in spans:
+        text = sp["text"]
+        prefix = loc.get("prefix") or ""
+        if not text.upper().startswith(prefix):
+            continue
+        rest = text[len(prefix):]
+        if loc["kind"] == "number":
+            m = _NUM_RE.search(rest)
+            return _num(m.group()) if m else None
+        suffix = loc.get("suffix") or ""
+        if suffix and rest.upper().endswith(suffix):
+            rest = rest[:-len(suffix)]
+        return rest.strip() or None
+    return None
+
+
+# ---------------------- 表格（items） ---------------------- #
+
+def _learn_table(layout: Dict[str, Any], items: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """在版式里找出 GPT items 的每一行，记每列的 x 范围 / 类型 / 表格起始 y"""
+    columns: Dict[str, Dict[str, Any]] = {}
+    hits: Dict[str, int] = {}
+    rows_y: List[float] = []
+    page = None
+    last_y = None
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        keys = sorted(item, key=lambda k: not _is_number(item[k]))  # 数字列先定位，行更可靠
+        row_y = None
+        for k in keys:
+            v = item[k]
+            if v in (None, "") or isinstance(v, (dict, list, bool)):
+                continue
+            loc = _find_value(
+                layout, v, page=page, whole=True, row_y=row_y,
+                min_y=last_y + ROW_TOL if last_y is not None and row_y is None else None,
+            )
+            if loc is None:
+                continue
+            if row_y is None:
+                row_y, page = loc["y"], loc["page"]
+            col = columns.setdefault(k, {"x0": loc["x"], "x1": loc["x1"], "kind": loc["kind"]})
+            col["x0"], col["x1"] = min(col["x0"], loc["x"]), max(col["x1"], loc["x1"])
+            hits[k] = hits.get(k, 0) + 1
+        if row_y is not None:
+            rows_y.append(row_y)
+            last_y = row_y
+
+    n = len(items)
+    columns = {k: c for k, c in columns.items() if hits[k] * 2 >= n}
+    numeric = [k for k, c in columns.items() if c["kind"] == "number"]
+    if not rows_y or not numeric or len(columns) < 2:
+        return None
+    return {
+        "page": page,
+        "y_start": min(rows_y) - ROW_TOL,
+        "columns": columns,
+        "anchor": max(numeric, key=lambda k: hits[k]),
+        "rows": len(rows_y),
+    }
+
+
+def _rows(spans: List[Dict[str, Any]]) -> Iterable[List[Dict[str, Any]]]:
+    row: List[Dict[str, Any]] = []
+    for sp in sorted(spans, key=lambda s: (s["bbox"][1], s["bbox"][0])):
+        if row and sp["bbox"][1] - row[0]["bbox"][1] > ROW_TOL:
+            yield row
+            row = []
+        row.append(sp)
+    if row:
+        yield row
+
+
+def read_table(layout: Dict[str, Any], table: Dict[str, Any]) -> List[Dict[str, Any]]:
+    if table["page"] >= len(layout["pages"]):
+        return []
+    spans = [sp for sp in layout["pages"][table["page"]] if sp["bbox"][1] >= table["y_start"]]
+    items = []
+    for row in _rows(spans):
+        if items and any(w in sp["text"].upper() for sp in row for w in TOTAL_WORDS):
+            break
+        item: Dict[str, Any] = {}
+        for key, col in table["columns"].items():
+            cell = [
+                sp for sp in row
+                if sp["bbox"][0] < col["x1"] + LAYOUT_POS_TOL and sp["bbox"][2] > col["x0"] - LAYOUT_POS_TOL
+            ]
+            text = " ".join(sp["text"] for sp in cell).strip()
+            if not text:
+                continue
+            if col["kind"] == "number":
+                m = _NUM_RE.search(text)
+                item[key] = _num(m.group()) if m else None
+            else:
+                item[key] = text
+        # 描述换行之类没有锚定数字列的行跳过
+        if item.get(table["anchor"]) is not None:
+            items.append(item)
+    return items
+
+
+def _same_items(local: List[Dict[str, Any]], gpt: List[Dict[str, Any]], columns: Iterable[str]) -> bool:
+    if len(local) != len(gpt):
+        return False
+    for a, b in zip(local, gpt):
+        for k in columns:
+            if b.get(k) not in (None, "") and not _same(a.get(k), b.get(k)):
+                return False
+    return True
+
+
+# ---------------------- 学习（GPT 结果确认） ---------------------- #
+
+def _scalar_paths(result: Dict[str, Any]) -> Iterable[Tuple[str, Any]]:
+    for section in SCALAR_SECTIONS:
+        sec = result.get(section)
+        if not isinstance(sec, dict):
+            continue
+        for k, v in sec.items():
+            if v in (None, "", 0) or isinstance(v, (dict, list, bool)):
+                continue
+            yield f"{section}.{k}", v
+
+
+def _get(result: Dict[str, Any], path: str):
+    obj = result
+    for part in path.split("."):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(part)
+    return obj
+
+
+def _put(result: Dict[str, Any], path: str, value):
+    parts = path.split(".")
+    obj = result
+    for part in parts[:-1]:
+        obj = obj.setdefault(part, {})
+    obj[parts[-1]] = value
+
+
+def learn_from_result(file_paths: List[str], result: Dict[str, Any]):
+    """模型结果出来后调用：学习 / 确认每份文本 PDF 的字段坐标"""
+    if not LAYOUT_TEMPLATES_ENABLED or not isinstance(result, dict) or "error" in result:
+        return
+    from app.integration.results_store import get_store
+
+    scalars = list(_scalar_paths(result))
+    tables = {p: _get(result, p) for p in TABLE_PATHS}
+    tables = {p: v for p, v in tables.items() if isinstance(v, list) and v}
+
+    for path in file_paths:
+        if not path.lower().endswith(".pdf"):
+            continue
+        layout = read_layout(path)
+        if layout is None:
+            continue
+        found = {}
+        for p, v in scalars:
+            loc = _find_value(layout, v)
+            if loc is not None:
+                found[p] = loc
+        learned_tables = {}
+        for p, items in tables.items():
+            table = _learn_table(layout, items)
+            if table is not None:
+                learned_tables[p] = table
+        if not found and not learned_tables:
+            continue
+
+        # 字段值和表格行随票变化，不算版式标签
+        skip = {
+            "spans": {(loc["page"], loc["x"], loc["y"]) for loc in found.values()},
+            "tables": {t["page"]: t["y_start"] for t in learned_tables.values()},
+        }
+        doc_labels = labels(layout, skip)
+        tpl, _ = match_template(layout)
+        tpl = copy.deepcopy(tpl)
+        if tpl is None:
+            tpl = {"id": None, "signature": layout["signature"], "labels": sorted(doc_labels),
+                   "fields": {}, "tables": {}, "samples": 0}
+        else:
+            # 只保留每份文档都出现的标签（去掉随票变化的文字）
+            stable = set(tpl["labels"]) & doc_labels
+            if len(stable) >= LAYOUT_MIN_LABELS:
+                tpl["labels"] = sorted(stable)
+
+        for p, old in list(tpl["fields"].items()):
+            gv = _get(result, p)
+            if gv in (None, "") or p in found:
+                continue
+            local = read_field(layout, old)
+            if local is not None and not _same(local, gv):
+                old["confirmations"] = 0
+        for p, loc in found.items():
+            old = tpl["fields"].get(p)
+            if old is not None and _same(read_field(layout, old), _get(result, p)):
+                old["confirmations"] = old.get("confirmations", 0) + 1
+            else:
+                tpl["fields"][p] = {**loc, "confirmations": 1}
+
+        for p, table in learned_tables.items():
+            old = tpl["tables"].get(p)
+            if old is not None and _same_items(read_table(layout, old), tables[p], old["columns"]):
+                old["confirmations"] = old.get("confirmations", 0) + 1
+            else:
+                tpl["tables"][p] = {**table, "confirmations": 1}
+
+        tpl["samples"] = tpl.get("samples", 0) + 1
+        tpl["id"] = get_store().save_layout_template(tpl)
+        _invalidate(layout["signature"])
+        print(
+            f"[Layout] {os.path.basename(path)} → 模板 #{tpl['id']}：字段 {len(found)}，表格 {len(learned_tables)}，"
+            f"样本 {tpl['samples']}"
+        )
+
+
+# ---------------------- 本地抽取 ---------------------- #
+
+def _skeleton() -> Dict[str, Any]:
+    return {
+        "summary": {},
+        "bill_of_lading": {},
+        "commercial_invoice": {"source": None, "items": []},
+        "packing_list": {"source": None, "items": []},
+        "arrival_notice": {},
+    }
+
+
+def _apply(tpl: Dict[str, Any], layout: Dict[str, Any], result: Dict[str, Any]) -> int:
+    """把模板里确认过的字段 / 表格读进 result（不覆盖已有值），返回读到的数量"""
+    n = 0
+    for p, loc in tpl["fields"].items():
+        if loc.get("confirmations", 0) < LAYOUT_CONFIRMATIONS or _get(result, p) not in (None, ""):
+            continue
+        v = read_field(layout, loc)
+        if v is not None:
+            _put(result, p, v)
+            n += 1
+    for p, table in tpl["tables"].items():
+        if table.get("confirmations", 0) < LAYOUT_CONFIRMATIONS or _get(result, p):
+            continue
+        items = read_table(layout, table)
+        if items:
+            _put(result, p, items)
+            n += 1
+    return n
+
+
+def _verify(result: Dict[str, Any]) -> Tuple[bool, List[str]]:
+    from app.integration.model_cascade import check_result
+    from app.integration.netchb_aggregator import CONTAINER_RE
+
+    confidence, problems = check_result(result)
+    container = result["summary"].get("container_no")
+    if container and not CONTAINER_RE.search(str(container).upper()):
+        problems.append(f"summary.container_no 格式不对: {container}")
+    return confidence >= LAYOUT_MIN_CONFIDENCE and not problems, problems
+
+
+def extract_with_templates(file_paths: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    所有附件都是命中模板的文本 PDF 时本地抽取，通过验证返回结果（带 "extraction"），否则返回 None（走模型）
+    """
+    if not LAYOUT_TEMPLATES_ENABLED or not file_paths:
+        return None
+    if any(not p.lower().endswith(".pdf") for p in file_paths):
+        return None
+    from app.integration.results_store import get_store
+
+    result = _skeleton()
+    used = []
+    for path in file_paths:
+        layout = read_layout(path)
+        if layout is None:
+            return None
+        tpl, score = match_template(layout)
+        if tpl is None or _apply(tpl, layout, result) == 0:
+            return None
+        used.append({"file": os.path.basename(path), "template": tpl["id"], "match": round(score, 3)})
+
+    ok, problems = _verify(result)
+    store = get_store()
+    for u in used:
+        store.count_layout_use(u["template"], ok)
+    if not ok:
+        print(f"[Layout] 模板结果未通过验证（版式漂移？），回退模型: {problems[:3]}")
+        return None
+    print(f"[Layout] 模板抽取成功，不调用模型: {used}")
+    result["extraction"] = {"mode": "template", "templates": used}
+    return result
+
+
+def list_templates() -> List[Dict[str, Any]]:
+    from app.integration.results_store import get_store
+
+    out = []
+    for tpl in get_store().list_layout_templates():
+        confirmed = [p for p, f in {**tpl["fields"], **tpl["tables"]}.items()
+                     if f.get("confirmations", 0) >= LAYOUT_CONFIRMATIONS]
+        out.append({
+            "id": tpl["id"],
+            "signature": tpl["signature"],
+            "labels": len(tpl["labels"]),
+            "samples": tpl["samples"],
+            "hits": tpl["hits"],
+            "misses": tpl["misses"],
+            "fields": len(tpl["fields"]) + len(tpl["tables"]),
+            "confirmed": sorted(confirmed),
+        })
+    return out
@@ -0,0 +1,199 @@
+# app/integration/model_cascade.py
+"""
+模型级联：便宜的文本模型先跑，不合格再升级到 vision 大模型
+
+- 只有文本块、没有图片的 payload → 先走 text tier（默认 gpt-4o-mini）
+- 结果做质量检查：必填字段 + 数字交叉校验（reconciliation.run_checks）；
+  必填字段按附件里实际有的单据类型定（只有发票时不要求提单号 / 收货人）
+- 检查分数低于阈值、或解析失败 → 同一份 messages 升级到 vision tier
+- 有图片的 payload 直接走 vision tier
+
+每个 tier 的模型 / max_tokens / 阈值都可用环境变量配置，
+升级率、各 tier 调用次数和延迟可通过 get_cascade_metrics() 查看。
+"""
+
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from app.integration.analyze_vision import (
+    MAX_OUTPUT_TOKENS,
+    VISION_MODEL,
+    call_gpt_and_parse_json,
+    safe_print,
+)
+from app import config
+from app.integration.reconciliation import run_checks
+
+# -------------------- tier 配置 --------------------
+TIERS: Dict[str, Dict[str, Any]] = {
+    "text": {
+        "model": config.getenv("CASCADE_TEXT_MODEL", "gpt-4o-mini"),
+        "max_tokens": config.getenv_int("CASCADE_TEXT_MAX_TOKENS", 4096),
+        # 质量分低于该值就升级
+        "min_confidence": config.getenv_float("CASCADE_TEXT_MIN_CONFIDENCE", 0.8),
+    },
+    "vision": {
+        "model": config.getenv("CASCADE_VISION_MODEL", VISION_MODEL),
+        "max_tokens": config.getenv_int("CASCADE_VISION_MAX_TOKENS", MAX_OUTPUT_TOKENS),
+        "min_confidence": 0.0,
+    },
+}
+
+# 单据类型 → 该类单据在附件里时才要求的字段
+REQUIRED_FIELDS_BY_TYPE: Dict[str, List[str]] = {
+    "bill_of_lading": ["summary.container_no", "summary.bl_no", "summary.consignee"],
+    "arrival_notice": ["summary.container_no", "summary.bl_no"],
+    "commercial_invoice": ["commercial_invoice.items"],
+    "packing_list": [],
+}
+
+
+# ---------------------- 质量检查 ---------------------- #
+
+def present_doc_types(result: Dict[str, Any], payload: Optional[Dict[str, Any]] = None) -> Set[str]:
+    """
+    附件里有哪些单据：本地分类器识别出的（payload["doc_types"]）+ 结果里有内容的段落
+    """
+    types = set((payload or {}).get("doc_types") or [])
+    for t in REQUIRED_FIELDS_BY_TYPE:
+        section = result.get(t)
+        if isinstance(section, dict) and any(v not in (None, "", [], {}) for v in section.values()):
+            types.add(t)
+    return types
+
+
+def required_fields(doc_types: Iterable[str]) -> List[str]:
+    """一个类型都认不出来时按全套单据要求（结果多半是空的，应当升级）"""
+    doc_types = [t for t in doc_types if t in REQUIRED_FIELDS_BY_TYPE] or list(REQUIRED_FIELDS_BY_TYPE)
+    fields: List[str] = []
+    for t in doc_types:
+        fields += [f for f in REQUIRED_FIELDS_BY_TYPE[t] if f not in fields]
+    return fields
+
+
+def check_result(result: Dict[str, Any], doc_types: Optional[Iterable[str]] = None) -> Tuple[float, List[str]]:
+    """
+    返回 (confidence 0~1, 问题列表)。
+    confidence = 通过的检查数 / 总检查数。
+    doc_types: 附件里的单据类型（见 present_doc_types）；None 时按结果里有内容的段落推断
+    """
+    if not isinstance(result, dict) or "error" in result:
+        return 0.0, ["解析失败"]
+
+    problems: List[str] = []
+    total = 0
+
+    # ---------- 必填字段 ----------
+    if doc_types is None:
+        doc_types = present_doc_types(result)
+    for f in required_fields(doc_types):
+        total += 1
+        section, key = f.split(".", 1)
+        value = (result.get(section) or {}).get(key)
+        if not value:
+            problems.append(f"{f} 为空" if key == "items" else f"{f} 缺失")
+
+    # ---------- 数字交叉校验（见 reconciliation.run_checks）----------
+    total += 1
+    issues = run_checks(result)
+    if issues:
+        # 多个数字问题合成一条、只算一项失败，避免把 confidence 压成负数
+        problems.append(f"数字校验 {len(issues)} 项: " + "; ".join(i["message"] for i in issues))
+
+    confidence = (total - len(problems)) / total if total else 0.0
+    return round(confidence, 4), problems
+
+
+# ---------------------- 指标 ---------------------- #
+
+_metrics_lock = threading.Lock()
+_metrics: Dict[str, Any] = {
+    "requests": 0,
+    "text_first": 0,
+    "escalations": 0,
+    "escalation_reasons": {},
+    "tiers": {name: {"calls": 0, "latency_ms_total": 0} for name in TIERS},
+}
+
+
+def _record_call(tier: str, latency_ms: int):
+    with _metrics_lock:
+        t = _metrics["tiers"][tier]
+        t["calls"] += 1
+        t["latency_ms_total"] += latency_ms
+
+
+def _record_escalation(problems: List[str]):
+    with _metrics_lock:
+        _metrics["escalations"] += 1
+        reasons = _metrics["escalation_reasons"]
+        for p in problems:
+            key = p.split(" ")[0]
+            reasons[key] = reasons.get(key, 0) + 1
+
+
+def get_cascade_metrics() -> Dict[str, Any]:
+    with _metrics_lock:
+        text_first = _metrics["text_first"]
+        tiers = {}
+        for name, t in _metrics["tiers"].items():
+            tiers[name] = {
+                "model": TIERS[name]["model"],
+                "calls": t["calls"],
+                "avg_latency_ms": int(t["latency_ms_total"] / t["calls"]) if t["calls"] else 0,
+            }
+        return {
+            "requests": _metrics["requests"],
+            "text_first": text_first,
+            "escalations": _metrics["escalations"],
+            "escalation_rate": round(_metrics["escalations"] / text_first, 4) if text_first else 0.0,
+            "escalation_reasons": dict(_metrics["escalation_reasons"]),
+            "tiers": tiers,
+        }
+
+
+# ---------------------- 级联主流程 ---------------------- #
+
+def _call_tier(tier: str, messages, on_delta=None) -> Dict[str, Any]:
+    cfg = TIERS[tier]
+    t0 = time.perf_counter()
+    result = call_gpt_and_parse_json(
+        messages, model=cfg["model"], max_tokens=cfg["max_tokens"], on_delta=on_delta
+    )
+    _record_call(tier, int((time.perf_counter() - t0) * 1000))
+    return result
+
+
+def run_cascade(payload: Dict[str, Any], messages, on_delta=None) -> Dict[str, Any]:
+    """
+    payload: build_file_payloads 的输出
+    messages: build_messages(payload) 的输出
+    on_delta: 可选，流式输出回调（见 call_gpt_and_parse_json）
+    """
+    with _metrics_lock:
+        _metrics["requests"] += 1
+
+    if payload.get("images"):
+        return _call_tier("vision", messages, on_delta)
+
+    with _metrics_lock:
+        _metrics["text_first"] += 1
+
+    result = _call_tier("text", messages, on_delta)
+    confidence, problems = check_result(result, present_doc_types(result, payload) if isinstance(result, dict) else None)
+    if confidence >= TIERS["text"]["min_confidence"]:
+        safe_print(f"[Cascade] text tier 通过 (confidence={confidence})")
+        return result
+
+    from app.integration.accounting import current_job
+
+    job = current_job()
+    if job is not None and job.action == "downgrade":
+        # 客户当天预算已进入降级档：不再花钱升级到 vision，直接返回 text tier 的结果，问题留给后面的校验
+        safe_print(f"[Cascade] 预算降级中，不升级 (confidence={confidence}): {problems}")
+        return result
+
+    safe_print(f"[Cascade] 升级到 vision tier (confidence={confidence}): {problems}")
+    _record_escalation(problems)
+    return _call_tier("vision", messages, on_delta)
@@ -1,56 +1,253 @@
 # app/integration/netchb_aggregator.py
+"""
+多柜 / 多提单聚合引擎
+
+每个附件的分析结果（analyze_file 的输出）里可能带有：
+柜号 / 订舱号 / 提单号 / 发票号。
+这里对所有单据建立 key → 单据 的索引，用并查集把共享柜号 / 分提单号（HBL）的单据连成同一票（entry），
+最后每票（每个柜 / 每个分单）输出一条合并记录。
+
+主提单号（MBL）/ 订舱号 / 发票号只作属性，不参与合并：拼箱时同一 MBL 下有多个 HBL，
+一个订舱 / 一张发票也可能跨多个柜，用它们合并会把几票并成一条。
+没有柜号 / HBL 的单据（发票、装箱单）按这些属性挂到唯一对得上的那一票；对不上或对上多票时放到 "unassigned"。
+
+复杂度：O(单据数 + key 数)，几百份单据也是线性的。
+"""
+
 import os
-from collections import defaultdict
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+# 柜号：4 位字母 + 7 位数字（ISO 6346）
+CONTAINER_RE = re.compile(r"\b([A-Z]{4})\s*-?\s*(\d{7})\b")
+
+# 参与 join 的 key 类型 → analyze_file 里可能出现的字段名；
+# 单据自己的 bl_no 按分单算（拼箱时货代发的是 HBL）
+JOIN_FIELDS = {
+    "container": ["container", "container_no", "containers", "container_numbers"],
+    "bl": ["bl_no", "bl_number", "hbl", "hbl_no", "house_bl_no"],
+}
+# 只作属性（合并记录里列出来，没有 join key 的单据靠它们挂靠）
+ATTR_FIELDS = {
+    "mbl": ["mbl", "mbl_no", "master_bl_no"],
+    "booking": ["booking_number", "booking_no", "booking_numbers"],
+    "invoice": ["invoice_no", "invoice_number", "invoice_numbers"],
+}
+
+UNASSIGNED = "unassigned"
+
+
+# ---------------------- key 规范化 ---------------------- #
+
+def _iter_values(v) -> Iterable[str]:
+    """字段值可能是 str / list / dict / 逗号分隔字符串，统一展开成字符串"""
+    if v is None:
+        return
+    if isinstance(v, (list, tuple, set)):
+        for x in v:
+            yield from _iter_values(x)
+        return
+    if isinstance(v, dict):
+        for k in ["value", "raw", "text", "number", "no"]:
+            if k in v:
+                yield from _iter_values(v[k])
+                return
+        return
+    s = str(v).strip()
+    if not s:
+        return
+    for part in re.split(r"[,;/\n]+", s):
+        part = part.strip()
+        if part:
+            yield part
 
-def aggregate_results(results: list) -> list:
-    """
-    输入：每个附件的分析结果（list）
-    输出：按柜号合并：每柜一个 dict
-    """
 
-    containers = defaultdict(lambda: {
+def _norm_key(kind: str, value: str) -> Optional[str]:
+    v = re.sub(r"[\s\-]", "", value.upper())
+    if not v or v in ("NULL", "NONE", "N/A", "NA", "TBA"):
+        return None
+    if kind == "container":
+        m = CONTAINER_RE.search(value.upper())
+        return (m.group(1) + m.group(2)) if m else None
+    return v
+
+
+def extract_keys(data: Dict[str, Any], field_map: Dict[str, List[str]] = JOIN_FIELDS) -> List[Tuple[str, str]]:
+    """从单据 data 中取出所有 (key 类型, 规范化值)；field_map 默认 JOIN_FIELDS，属性用 ATTR_FIELDS"""
+    keys = []
+    seen = set()
+    for kind, fields in field_map.items():
+        for f in fields:
+            for raw in _iter_values(data.get(f)):
+                k = _norm_key(kind, raw)
+                if k and (kind, k) not in seen:
+                    seen.add((kind, k))
+                    keys.append((kind, k))
+    return keys
+
+
+# ---------------------- 并查集 ---------------------- #
+
+class _DSU:
+    def __init__(self, n: int):
+        self.parent = list(range(n))
+
+    def find(self, x: int) -> int:
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a: int, b: int):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[rb] = ra
+
+
+# ---------------------- 合并记录 ---------------------- #
+
+def _new_record() -> Dict[str, Any]:
+    return {
         "container": None,
+        "containers": [],
         "booking_numbers": [],
+        "bl_numbers": [],
+        "mbl_numbers": [],
+        "invoice_numbers": [],
         "consignee": None,
+        "packages": None,
         "invoice_items": [],
         "total_value": 0,
         "gross_weight": 0,
         "packing_list": [],
         "firms_code": None,
-    })
-
-    for item in results:
-        path = item["file"]
-        doc_type = item["doc_type"]
-        data = item["data"]
-
-        # ---------- BOL ----------
-        if doc_type == "bill_of_lading":
-            C = containers[data.get("container")]
-            C["container"] = data.get("container")
-            C["consignee"] = data.get("consignee")
-            if data.get("booking_number"):
-                C["booking_numbers"].append(data.get("booking_number"))
-            C["packages"] = data.get("packages")
-
-        # ---------- Commercial Invoice ----------
-        elif doc_type == "commercial_invoice":
-            C = containers[os.path.basename(path)[:12]]  # 若无法读取柜号，则用文件名前12位作为group
-            C["invoice_items"].extend(data.get("invoice_items", []))
-            if data.get("total_value"):
-                C["total_value"] += data.get("total_value")
-
-        # ---------- Packing List ----------
-        elif doc_type == "packing_list":
-            C = containers[os.path.basename(path)[:12]]
-            C["packing_list"].extend(data.get("packing_rows", []))
-            if data.get("gross_weight_total"):
-                C["gross_weight"] += data.get("gross_weight_total")
-
-        # ---------- Arrival Notice ----------
-        elif doc_type == "arrival_notice":
-            C = containers["unknown"]
-            C["firms_code"] = data.get("firms_code")
-
-    return list(containers.values())
+        "files": [],
+    }
+
+
+def _to_number(v) -> float:
+    if v is None or v == "":
+        return 0
+    if isinstance(v, (int, float)):
+        return v
+    try:
+        return float(str(v).replace(",", "").strip())
+    except ValueError:
+        return 0
+
+
+def _merge_doc(C: Dict[str, Any], item: Dict[str, Any]):
+    doc_type = item.get("doc_type")
+    data = item.get("data") or {}
+    C["files"].append(item.get("file"))
+
+    # ---------- BOL ----------
+    if doc_type == "bill_of_lading":
+        C["consignee"] = C["consignee"] or data.get("consignee")
+        C["packages"] = C["packages"] or data.get("packages")
+
+    # ---------- Commercial Invoice ----------
+    elif doc_type == "commercial_invoice":
+        C["invoice_items"].extend(data.get("invoice_items", []) or [])
+        C["total_value"] += _to_number(data.get("total_value"))
+
+    # ---------- Packing List ----------
+    elif doc_type == "packing_list":
+        C["packing_list"].extend(data.get("packing_rows", []) or [])
+        C["gross_weight"] += _to_number(data.get("gross_weight_total"))
+
+    # ---------- Arrival Notice ----------
+    elif doc_type == "arrival_notice":
+        C["firms_code"] = C["firms_code"] or data.get("firms_code")
+
+
+_KEY_LISTS = {
+    "container": "containers",
+    "booking": "booking_numbers",
+    "bl": "bl_numbers",
+    "mbl": "mbl_numbers",
+    "invoice": "invoice_numbers",
+}
+
+
+def aggregate_results(results: list) -> list:
+    """
+    输入：每个附件的分析结果（list of {"file", "doc_type", "data"}）
+    输出：按柜号 / 分提单号 join 后，每票一个 dict（MBL / 订舱号 / 发票号作为属性列出）
+
+    - 共享柜号或 HBL 的单据归为同一票
+    - 没有柜号 / HBL 的单据：属性（MBL / 订舱号 / 发票号）只对上一票就挂进去；
+      一票都没有时并进唯一的那票；其余放到 "unassigned"
+    """
+    n = len(results)
+    dsu = _DSU(n)
+    key_owner: Dict[Tuple[str, str], int] = {}
+    doc_keys: List[List[Tuple[str, str]]] = []
+    doc_attrs: List[List[Tuple[str, str]]] = []
+
+    # ---------- 一遍扫描：建索引 + union ----------
+    for i, item in enumerate(results):
+        data = item.get("data") or {}
+        keys = extract_keys(data)
+        doc_keys.append(keys)
+        doc_attrs.append(extract_keys(data, ATTR_FIELDS))
+        for key in keys:
+            owner = key_owner.get(key)
+            if owner is None:
+                key_owner[key] = i
+            else:
+                dsu.union(owner, i)
+
+    # ---------- 按连通分量输出 ----------
+    groups: Dict[int, Dict[str, Any]] = {}
+    # 属性 → 出现在哪些票里（只看有 join key 的单据）
+    attr_groups: Dict[Tuple[str, str], set] = {}
+    orphans: List[int] = []
+
+    def _add_keys(C: Dict[str, Any], keys: List[Tuple[str, str]]):
+        for kind, value in keys:
+            lst = C[_KEY_LISTS[kind]]
+            if value not in lst:
+                lst.append(value)
+
+    for i, item in enumerate(results):
+        if not doc_keys[i]:
+            orphans.append(i)
+            continue
+        root = dsu.find(i)
+        C = groups.get(root)
+        if C is None:
+            C = groups[root] = _new_record()
+        _merge_doc(C, item)
+        _add_keys(C, doc_keys[i] + doc_attrs[i])
+        for attr in doc_attrs[i]:
+            attr_groups.setdefault(attr, set()).add(root)
+
+    records = list(groups.values())
+
+    unassigned = None
+    for i in orphans:
+        roots = set()
+        for attr in doc_attrs[i]:
+            roots |= attr_groups.get(attr, set())
+        if len(roots) == 1:
+            target = groups[roots.pop()]
+        elif not roots and len(groups) == 1:
+            target = records[0]
+        else:
+            if unassigned is None:
+                unassigned = _new_record()
+                unassigned["container"] = UNASSIGNED
+                records.append(unassigned)
+            target = unassigned
+        _merge_doc(target, results[i])
+        _add_keys(target, doc_attrs[i])
+
+    for C in records:
+        if C["container"] is None:
+            C["container"] = C["containers"][0] if C["containers"] else None
+        C["files"] = [os.path.basename(p) for p in C["files"] if p]
+
+    return records
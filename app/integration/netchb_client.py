@@ -1,21 +1,63 @@
 # app/integration/netchb_client.py
+"""
+NET CHB SOAP 客户端
 
-import os
-from dotenv import load_dotenv
-from zeep import Client
-from zeep.transports import Transport
+- 同步：get_client() / send_entry_to_netchb()，zeep Client + requests，流水线线程里用
+- 异步：get_async_client() / upload_entry_async() / upload_many()，zeep AsyncClient + httpx 连接池，
+  在 FastAPI 事件循环里并发上传多票 entry（多柜 shipment），并发数有上限，每次调用单独超时
+"""
 
-load_dotenv()
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional
 
-NETCHB_USER = os.getenv("NETCHB_USER")
-NETCHB_PASS = os.getenv("NETCHB_PASS")
-WSDL_URL = os.getenv("NETCHB_ENTRY_WSDL")
+from app import config
 
-if not WSDL_URL:
-    raise ValueError("环境变量 NETCHB_ENTRY_WSDL 未设置")
+NETCHB_USER = config.getenv("NETCHB_USER")
+NETCHB_PASS = config.getenv("NETCHB_PASS")
+WSDL_URL = config.getenv("NETCHB_ENTRY_WSDL")
+
+# 单次 uploadEntry 超时（秒）
+NETCHB_TIMEOUT = config.getenv_float("NETCHB_TIMEOUT", 30)
+# upload_many 默认并发数；httpx 连接池按这个大小开
+NETCHB_MAX_CONCURRENCY = config.getenv_int("NETCHB_MAX_CONCURRENCY", 4)
+
+_client = None
+_client_lock = threading.Lock()
+
+_async_client = None
+_async_lock = threading.Lock()
+
+
+def get_client():
+    """
+    第一次调用时加载 WSDL 并缓存 zeep Client（启动 warm-up 会提前调用一次）
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if not WSDL_URL:
+                    raise ValueError("环境变量 NETCHB_ENTRY_WSDL 未设置")
+                from zeep import Client
+                from zeep.transports import Transport
+
+                transport = Transport(timeout=NETCHB_TIMEOUT)
+                _client = Client(WSDL_URL, transport=transport)
+    return _client
+
+
+def close_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            try:
+                _client.transport.session.close()
+            except Exception:
+                pass
+            _client = None
 
-transport = Transport(timeout=30)
-client = Client(WSDL_URL, transport=transport)
 
 def send_entry_to_netchb(entry_xml: str):
     """
@@ -23,7 +65,7 @@ def send_entry_to_netchb(entry_xml: str):
     """
 
     try:
-        result = client.service.uploadEntry(NETCHB_USER, NETCHB_PASS, entry_xml)
+        result = get_client().service.uploadEntry(NETCHB_USER, NETCHB_PASS, entry_xml)
         return {
             "status": "OK",
             "response": result
@@ -33,3 +75,82 @@ def send_entry_to_netchb(entry_xml: str):
             "status": "ERROR",
             "error": str(e)
         }
+
+
+# ---------------------- 异步客户端 ---------------------- #
+
+def get_async_client():
+    """
+    zeep AsyncClient：WSDL 用同步 httpx.Client 加载一次，SOAP 调用走 httpx.AsyncClient 连接池
+    会阻塞：在事件循环里用 await asyncio.to_thread(get_async_client)（lifecycle 预热时已建好）
+    """
+    global _async_client
+    if _async_client is None:
+        with _async_lock:
+            if _async_client is None:
+                if not WSDL_URL:
+                    raise ValueError("环境变量 NETCHB_ENTRY_WSDL 未设置")
+                import httpx
+                from zeep import AsyncClient
+                from zeep.transports import AsyncTransport
+
+                limits = httpx.Limits(
+                    max_connections=NETCHB_MAX_CONCURRENCY,
+                    max_keepalive_connections=NETCHB_MAX_CONCURRENCY,
+                )
+                transport = AsyncTransport(
+                    client=httpx.AsyncClient(limits=limits, timeout=NETCHB_TIMEOUT),
+                    wsdl_client=httpx.Client(timeout=NETCHB_TIMEOUT),
+                )
+                _async_client = AsyncClient(WSDL_URL, transport=transport)
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    with _async_lock:
+        client, _async_client = _async_client, None
+    if client is not None:
+        try:
+            await client.transport.aclose()
+        except Exception:
+            pass
+        try:
+            client.transport.wsdl_client.close()
+        except Exception:
+            pass
+
+
+async def upload_entry_async(entry_xml: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+    """异步版 send_entry_to_netchb，返回结构相同，另加 elapsed_ms"""
+    t0 = time.perf_counter()
+    try:
+        client = _async_client or await asyncio.to_thread(get_async_client)
+        result = await asyncio.wait_for(
+            client.service.uploadEntry(NETCHB_USER, NETCHB_PASS, entry_xml),
+            timeout=timeout or NETCHB_TIMEOUT,
+        )
+        out = {"status": "OK", "response": result}
+    except asyncio.TimeoutError:
+        out = {"status": "ERROR", "error": f"NET CHB 超时（{timeout or NETCHB_TIMEOUT}s）"}
+    except Exception as e:
+        out = {"status": "ERROR", "error": str(e)}
+    out["elapsed_ms"] = int((time.perf_counter() - t0) * 1000)
+    return out
+
+
+async def upload_many(entry_xmls: List[str], concurrency: Optional[int] = None,
+                      timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    并发上传多票 entry，最多 concurrency 个同时在途；
+    concurrency 不超过连接池大小（NETCHB_MAX_CONCURRENCY），多出来的只会在池子上排队、白白耗掉 SOAP 超时
+    单票失败 / 超时不影响其他票，结果按输入顺序返回（带 index）
+    """
+    sem = asyncio.Semaphore(max(1, min(concurrency or NETCHB_MAX_CONCURRENCY, NETCHB_MAX_CONCURRENCY)))
+
+    async def _one(i: int, xml: str):
+        async with sem:
+            res = await upload_entry_async(xml, timeout)
+        return {"index": i, **res}
+
+    return list(await asyncio.gather(*(_one(i, x) for i, x in enumerate(entry_xmls))))
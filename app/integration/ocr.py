@@ -0,0 +1,150 @@
+# app/integration/ocr.py
+"""
+本地 OCR 预处理（可选，Tesseract）
+
+扫描 PDF / 图片附件以前一律转图片发 gpt-4o，是最慢最贵的路径。
+开启 OCR_ENABLED 后：
+- 扫描页先在本地 OCR（线程池并行，tesseract 本身是子进程，不受 GIL 限制）
+- 每页给出平均置信度；≥ OCR_MIN_CONFIDENCE 且字数够的页面走文本路径
+- 只有低置信度的页面才回退成图片
+没装 pytesseract / tesseract 时自动跳过，行为与原来一致。
+"""
+
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from app import config
+from app.profiling import traced
+
+OCR_ENABLED = config.getenv_bool("OCR_ENABLED", False)
+OCR_LANG = config.getenv("OCR_LANG", "eng")
+OCR_DPI = config.getenv_int("OCR_DPI", 300)
+OCR_MIN_CONFIDENCE = config.getenv_float("OCR_MIN_CONFIDENCE", 80)
+OCR_MIN_CHARS = config.getenv_int("OCR_MIN_CHARS", 40)
+OCR_WORKERS = config.getenv_int("OCR_WORKERS", min(4, os.cpu_count() or 1))
+OCR_TIMEOUT = config.getenv_int("OCR_TIMEOUT", 60)
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+_available: Optional[bool] = None
+
+
+def ocr_available() -> bool:
+    """pytesseract 可 import 且 tesseract 可执行文件存在（结果缓存）"""
+    global _available
+    if _available is None:
+        try:
+            import pytesseract  # noqa: F401
+            cmd = getattr(pytesseract.pytesseract, "tesseract_cmd", "tesseract")
+            _available = bool(shutil.which(cmd) or os.path.exists(cmd))
+        except ImportError:
+            _available = False
+    return _available
+
+
+def ocr_enabled() -> bool:
+    return OCR_ENABLED and ocr_available()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+# ---------------------- 单页 OCR ---------------------- #
+
+def ocr_image(img) -> Dict[str, Any]:
+    """
+    PIL Image → {"text", "confidence", "words"}
+    confidence = 有效单词（conf ≥ 0）的平均置信度，0~100
+    """
+    import pytesseract
+
+    data = pytesseract.image_to_data(
+        img, lang=OCR_LANG, output_type=pytesseract.Output.DICT, timeout=OCR_TIMEOUT
+    )
+
+    confs = []
+    lines: Dict[tuple, List[str]] = {}
+    for i, word in enumerate(data.get("text", [])):
+        word = (word or "").strip()
+        try:
+            conf = float(data["conf"][i])
+        except (ValueError, TypeError):
+            conf = -1
+        if not word or conf < 0:
+            continue
+        confs.append(conf)
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append(word)
+
+    text = "\n".join(" ".join(ws) for _, ws in sorted(lines.items()))
+    return {
+        "text": text,
+        "confidence": round(sum(confs) / len(confs), 1) if confs else 0.0,
+        "words": len(confs),
+    }
+
+
+def page_is_good(res: Dict[str, Any]) -> bool:
+    return res["confidence"] >= OCR_MIN_CONFIDENCE and len(res["text"]) >= OCR_MIN_CHARS
+
+
+# ---------------------- PDF / 图片文件 ---------------------- #
+
+def ocr_pdf(path: str, max_pages: int) -> List[Dict[str, Any]]:
+    """
+    PDF 前 max_pages 页 → [{"page": 1-based, "text", "confidence", "words"}]
+    渲染在当前线程（PyMuPDF 不是线程安全的），OCR 在线程池；
+    每批最多 OCR_WORKERS 页在内存里，控制峰值内存。
+    """
+    import fitz
+    from PIL import Image
+
+    results: List[Dict[str, Any]] = []
+    pool = _get_pool()
+
+    with fitz.open(path) as doc:
+        n = min(len(doc), max_pages)
+        for start in range(0, n, OCR_WORKERS):
+            futures = []
+            for i in range(start, min(start + OCR_WORKERS, n)):
+                pix = doc[i].get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY, alpha=False)
+                img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+                del pix
+                futures.append((i, pool.submit(traced(ocr_image), img)))
+                del img
+            for i, fut in futures:
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    res = {"text": "", "confidence": 0.0, "words": 0, "error": str(e)}
+                results.append({"page": i + 1, **res})
+
+    return results
+
+
+def ocr_image_file(path: str) -> Dict[str, Any]:
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as im:
+        img = ImageOps.exif_transpose(im).convert("L")
+    try:
+        return _get_pool().submit(traced(ocr_image), img).result()
+    except Exception as e:
+        return {"text": "", "confidence": 0.0, "words": 0, "error": str(e)}
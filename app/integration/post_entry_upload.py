@@ -1,14 +1,21 @@
 # app/integration/post_entry_upload.py
 
 import json
+from app.integration.entry_json_mapping import map_to_entry_json
+from app.integration.entry_schema import EntryJson, decode
+from app.integration.entry_validation import NETCHB_PREVALIDATE, format_issues, has_errors, validate_entry_xml
 from app.integration.entry_xml_builder import build_entry_upload_xml
-from app.integration.netchb_client import send_entry_to_netchb
+from app.integration.netchb_client import send_entry_to_netchb, upload_many
+from app.integration.progress import Progress, emit
 
 
-def process_entry_from_gpt(gpt_result):
+def process_entry_from_gpt(gpt_result, progress: Progress = None):
     """
     从 GPT 解析结果生成 entryUpload XML，并提交给 NET CHB。
-    一定返回一个 dict: {"status": "...", "response": "...", "error": "..."}
+    一定返回一个 dict: {"status": "...", "response": "...", "error": "...", "validation": [...],
+                       "entry_json": {...}, "entry_xml": "..."}
+    本地校验有 error 时 status=INVALID，不调用 NET CHB
+    progress: 可选进度回调（mapping / xml / validate / upload）
     """
 
     # gpt_result 可能是 str（JSON 字符串），也可能已经是 dict
@@ -28,24 +35,88 @@ def process_entry_from_gpt(gpt_result):
         gpt.get("entry_json")
         or gpt.get("entry_upload")
         or gpt.get("entry")
-        or {}
     )
+    if entry_json:
+        # GPT 直接给了 entry：同样按 schema 解码，字段错误一并记录
+        typed, errors = decode(EntryJson, entry_json)
+        entry_json = {**typed.model_dump(), "validation_errors": errors}
+    else:
+        # GPT 原始结构（summary / bill_of_lading / ...）→ 走 mapping
+        entry_json = map_to_entry_json(gpt)
+    if entry_json["validation_errors"]:
+        print("⚠ Entry 字段解码错误:", entry_json["validation_errors"])
+    emit(progress, "mapping", entry_json=entry_json)
 
     try:
         entry_xml = build_entry_upload_xml(entry_json)
     except Exception as e:
         return {"status": "ERROR", "error": f"生成 XML 失败: {e}", "response": None}
+    emit(progress, "xml", entry_xml=entry_xml)
 
     print("========== entryUpload XML ==========")
     print(entry_xml)
     print("=====================================")
 
+    # 本地预校验：有 error 级问题直接返回，不占用 NET CHB
+    issues = validate_entry_xml(entry_xml) if NETCHB_PREVALIDATE else []
+    emit(progress, "validate", issues=issues)
+    if has_errors(issues):
+        print("❌ entryUpload 本地校验未通过:\n" + format_issues(issues))
+        return {
+            "status": "INVALID",
+            "error": "本地校验未通过，未提交 NET CHB：\n" + format_issues(issues),
+            "response": None,
+            "validation": issues,
+            "entry_json": entry_json,
+            "entry_xml": entry_xml,
+        }
+
     try:
         res = send_entry_to_netchb(entry_xml)
         # send_entry_to_netchb 已经返回 {"status": "...", "response": "...", "error": "..."} 这样的结构
         print("========== NET CHB RESPONSE =========")
         print(res)
         print("=====================================")
-        return res
     except Exception as e:
-        return {"status": "ERROR", "error": str(e), "response": None}
+        res = {"status": "ERROR", "error": str(e), "response": None}
+    emit(progress, "upload", status=res.get("status"), error=res.get("error"))
+
+    # 附上 entry JSON / XML，方便存入结果库
+    return {**res, "validation": issues, "entry_json": entry_json, "entry_xml": entry_xml}
+
+
+async def upload_entries(entry_jsons, concurrency=None, progress: Progress = None):
+    """
+    多票 entry（例如多柜 shipment 拆出来的）→ XML → 本地校验 → 并发上传 NET CHB
+    校验不通过的不上传；返回按输入顺序的结果列表
+    """
+    results = []
+    pending = []  # (结果下标, entry_xml)
+
+    for i, entry_json in enumerate(entry_jsons):
+        if isinstance(entry_json, dict):
+            entry_json = {k: v for k, v in entry_json.items() if k != "validation_errors"}
+        typed, errors = decode(EntryJson, entry_json)
+        entry_json = typed.model_dump()
+        try:
+            entry_xml = build_entry_upload_xml(entry_json)
+        except Exception as e:
+            results.append({"index": i, "status": "ERROR", "error": f"生成 XML 失败: {e}", "response": None})
+            continue
+
+        issues = validate_entry_xml(entry_xml) if NETCHB_PREVALIDATE else []
+        out = {"index": i, "decode_errors": errors, "validation": issues, "entry_xml": entry_xml}
+        if has_errors(issues):
+            out.update(status="INVALID", error=format_issues(issues), response=None)
+        else:
+            pending.append((len(results), entry_xml))
+        results.append(out)
+
+    emit(progress, "upload_start", total=len(entry_jsons), uploading=len(pending))
+    uploaded = await upload_many([x for _, x in pending], concurrency=concurrency)
+    for (pos, _), res in zip(pending, uploaded):
+        res.pop("index", None)
+        results[pos].update(res)
+    emit(progress, "upload_done", ok=sum(1 for r in results if r.get("status") == "OK"))
+
+    return results
@@ -0,0 +1,261 @@
+# app/integration/priority.py
+"""
+按截止日期排优先级的处理队列
+
+以前 worker 按 Gmail 返回的顺序（最新在前）认领，最后免柜日就是明天的到港通知也要排在一堆普通发票后面。
+这里在认领前给每封邮件打分，只用本地就能拿到的便宜信号（邮件头 + 摘要，不下载附件、不调用模型）：
+
+1) 日期：正文摘要 / 主题里 LFD（最后免柜日）和 ETA 后面的日期，离现在越近分越高，已过期按最紧急算；
+   纯数字日期（10/21、21/10/2026、21.10）月 / 日两种顺序都试，只有一种合法就用它，都合法取离收信日近的
+2) 发件人 SLA 等级：PRIORITY_SLA_TIERS = {"acme.com": "gold", ...}，按 PRIORITY_TIER_WEIGHTS 加分
+3) 单据类型：到港通知 / ISF / 更正件等关键词加分，普通发票不加
+4) 老化：有效分 = 分数 + 已等待小时 × PRIORITY_AGING_PER_HOUR，低优先级等得够久总会排到前面，不会饿死
+5) 指标：按优先级（urgent / high / normal）统计从收到邮件到开始处理 / 处理完的 p50 / p95，
+   见 GET /metrics/workers 的 "priority"
+"""
+
+import json
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from app import config
+from app.integration.accounting import customer_of
+
+PRIORITY_ENABLED = config.getenv_bool("PRIORITY_ENABLED", True)
+# 等待每小时加的分；默认 10 → 最低分的邮件最多等约 18 小时就排到最前
+PRIORITY_AGING_PER_HOUR = config.getenv_float("PRIORITY_AGING_PER_HOUR", 10)
+PRIORITY_SLA_TIERS: Dict[str, str] = json.loads(config.getenv("PRIORITY_SLA_TIERS", "{}") or "{}")
+PRIORITY_TIER_WEIGHTS: Dict[str, float] = {
+    "platinum": 40, "gold": 25, "silver": 10, "standard": 0,
+    **json.loads(config.getenv("PRIORITY_TIER_WEIGHTS", "{}") or "{}"),
+}
+LATENCY_SAMPLES = 500
+
+# (距离截止的小时数上限, 分数)，已过期按第一档
+LFD_SCORES = ((24, 100), (48, 70), (96, 40), (None, 10))
+ETA_SCORES = ((48, 50), (120, 25), (None, 0))
+ENTRY_TYPE_WEIGHTS = (
+    ("isf", re.compile(r"\bISF\b|10\s*\+\s*2", re.I), 40),
+    ("arrival_notice", re.compile(r"ARRIVAL\s*NOTICE|到港通知|到货通知", re.I), 30),
+    ("correction", re.compile(r"CORRECT|REVISED|AMEND|更正|修改", re.I), 10),
+)
+CLASSES = (("urgent", 90), ("high", 50), ("normal", None))
+
+_LFD_RE = re.compile(r"\bLFD\b|LAST\s*FREE\s*(?:DAY|DATE)|FREE\s*TIME\s*EXPIRE|免柜期|免堆期|最后免费日", re.I)
+_ETA_RE = re.compile(r"\bETA\b|ESTIMATED\s*(?:TIME\s*OF\s*)?ARRIVAL|预计到港|到港日", re.I)
+_MONTHS = ("JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC")
+_MON = "|".join(_MONTHS)
+_DATE_RES = (
+    ("ymd", re.compile(r"(\d{4})[-/.年](\d{1,2})[-/.月](\d{1,2})")),
+    ("dmy", re.compile(rf"(\d{{1,2}})[-\s]?({_MON})[A-Z]*\.?[-\s,]*(\d{{4}}|\d{{2}})?", re.I)),
+    ("mdy", re.compile(rf"({_MON})[A-Z]*\.?\s+(\d{{1,2}})(?:,?\s+(\d{{4}}))?", re.I)),
+    ("numeric", re.compile(r"(?<![\d/])(\d{1,2})/(\d{1,2})(?:/(\d{4}|\d{2}))?(?![\d/])")),
+    # 21.10.2026 / 21.10. / 10.20；不带年份时两段都要两位，"1.5 days" 这种小数不算日期
+    ("numeric", re.compile(r"(?<![\d.])(\d{1,2})\.(\d{1,2})\.(\d{4}|\d{2})(?![\d.])")),
+    ("numeric", re.compile(r"(?<![\d.])(\d{2})\.(\d{2})(?!\.?\d)")),
+    ("md_cn", re.compile(r"(\d{1,2})月(\d{1,2})[日号]")),
+)
+# 关键词后面多远以内找日期
+DATE_WINDOW = 40
+
+
+# ---------------------- 日期 ---------------------- #
+
+def _year(y: Optional[str]) -> Optional[int]:
+    if not y:
+        return None
+    y = int(y)
+    return y + 2000 if y < 100 else y
+
+
+def _build(y: Optional[int], m: int, d: int, ref: datetime) -> Optional[datetime]:
+    try:
+        if y is not None:
+            return datetime(y, m, d, 23, 59)
+        dt = datetime(ref.year, m, d, 23, 59)
+    except ValueError:
+        return None
+    # 没写年份：比收信日早半年以上的算明年（12 月收到 "1/5"）
+    if (ref - dt).days > 180:
+        dt = dt.replace(year=ref.year + 1)
+    return dt
+
+
+def _numeric(a: int, b: int, y: Optional[int], ref: datetime) -> Optional[datetime]:
+    """a/b 可能是 月/日（美式）也可能是 日/月（欧洲 / 亚洲货代常用）"""
+    found = [dt for dt in (_build(y, a, b, ref), _build(y, b, a, ref)) if dt is not None]
+    if not found:
+        return None
+    return min(found, key=lambda dt: abs((dt - ref).total_seconds()))
+
+
+def parse_date(text: str, ref: datetime) -> Optional[datetime]:
+    """text 开头附近的第一个日期（当天 23:59）"""
+    best: Optional[Tuple[int, datetime]] = None
+    for kind, rx in _DATE_RES:
+        m = rx.search(text)
+        if not m or (best is not None and m.start() >= best[0]):
+            continue
+        g = m.groups()
+        if kind == "ymd":
+            dt = _build(int(g[0]), int(g[1]), int(g[2]), ref)
+        elif kind == "dmy":
+            dt = _build(_year(g[2]), _MONTHS.index(g[1][:3].upper()) + 1, int(g[0]), ref)
+        elif kind == "mdy":
+            dt = _build(_year(g[2]), _MONTHS.index(g[0][:3].upper()) + 1, int(g[1]), ref)
+        elif kind == "numeric":
+            dt = _numeric(int(g[0]), int(g[1]), _year(g[2] if len(g) > 2 else None), ref)
+        else:
+            dt = _build(None, int(g[0]), int(g[1]), ref)
+        if dt is not None:
+            best = (m.start(), dt)
+    return best[1] if best else None
+
+
+def find_deadline(text: str, keyword: re.Pattern, ref: datetime) -> Optional[datetime]:
+    """关键词后 DATE_WINDOW 个字符内的日期；多处出现取最早的"""
+    found = []
+    for m in keyword.finditer(text):
+        dt = parse_date(text[m.end():m.end() + DATE_WINDOW], ref)
+        if dt is not None:
+            found.append(dt)
+    return min(found) if found else None
+
+
+def _deadline_score(deadline: Optional[datetime], now: float, table) -> float:
+    if deadline is None:
+        return 0
+    hours = (deadline.timestamp() - now) / 3600
+    for limit, score in table:
+        if limit is None or hours <= limit:
+            return score
+    return 0
+
+
+# ---------------------- 打分 ---------------------- #
+
+def score_message(meta: Optional[Dict[str, Any]], now: Optional[float] = None) -> Dict[str, Any]:
+    """
+    meta: fetch_message_meta 的返回（from / subject / snippet / received_at）
+    返回 {"score", "class", "signals": {...}}
+    """
+    now = time.time() if now is None else now
+    meta = meta or {}
+    text = f"{meta.get('subject') or ''}\n{meta.get('snippet') or ''}"
+    ref = datetime.fromtimestamp(meta.get("received_at") or now)
+    signals: Dict[str, Any] = {}
+
+    lfd = find_deadline(text, _LFD_RE, ref)
+    eta = find_deadline(text, _ETA_RE, ref)
+    score = _deadline_score(lfd, now, LFD_SCORES) + _deadline_score(eta, now, ETA_SCORES)
+    if lfd:
+        signals["lfd"] = lfd.date().isoformat()
+    if eta:
+        signals["eta"] = eta.date().isoformat()
+
+    customer = customer_of(meta) if meta.get("from") else None
+    tier = PRIORITY_SLA_TIERS.get(customer or "", "standard")
+    score += PRIORITY_TIER_WEIGHTS.get(tier, 0)
+    signals["tier"] = tier
+
+    types = [name for name, rx, _ in ENTRY_TYPE_WEIGHTS if rx.search(text)]
+    score += sum(w for name, _, w in ENTRY_TYPE_WEIGHTS if name in types)
+    if types:
+        signals["types"] = types
+
+    cls = next(name for name, floor in CLASSES if floor is None or score >= floor)
+    return {"score": score, "class": cls, "signals": signals}
+
+
+# ---------------------- 调度 ---------------------- #
+
+def _percentile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return round(samples[min(len(samples) - 1, int(len(samples) * q))], 1)
+
+
+class PriorityScheduler:
+    """
+    order(ids) → 按有效分排好序的 ids；started / finished 记录每封邮件的排队 / 完成延迟
+    describe(message id) → 邮件元数据（每封只取一次）；None 时所有邮件同分，只按等待时间排（先来先服务）
+    分数每次 order 都按当前时间重算：LFD 越来越近，分数跟着涨
+    """
+
+    def __init__(self, describe: Optional[Callable[[str], Dict[str, Any]]] = None,
+                 aging_per_hour: float = PRIORITY_AGING_PER_HOUR):
+        self.describe = describe
+        self.aging_per_hour = aging_per_hour
+        # message id → {"meta", "received_at", "score", "class", "signals"}
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._wait: Dict[str, Deque[float]] = {name: deque(maxlen=LATENCY_SAMPLES) for name, _ in CLASSES}
+        self._latency: Dict[str, Deque[float]] = {name: deque(maxlen=LATENCY_SAMPLES) for name, _ in CLASSES}
+        self._completed: Dict[str, int] = {name: 0 for name, _ in CLASSES}
+
+    def _meta(self, msg_id: str, now: float) -> Dict[str, Any]:
+        meta: Dict[str, Any] = {}
+        if self.describe is not None:
+            try:
+                meta = self.describe(msg_id) or {}
+            except Exception as e:
+                print(f"⚠ [Priority] 读取邮件头失败 {msg_id}: {e}")
+        return {"meta": meta, "received_at": meta.get("received_at") or now}
+
+    def effective(self, job: Dict[str, Any], now: float) -> float:
+        waited_h = max(0.0, now - job["received_at"]) / 3600
+        return job["score"] + waited_h * self.aging_per_hour
+
+    def order(self, ids: List[str]) -> List[str]:
+        now = time.time()
+        with self._lock:
+            # 已不在扫描范围里的（处理完 / 超出 WORKER_SCAN）不再跟踪
+            keep = set(ids)
+            for msg_id in [m for m in self._jobs if m not in keep]:
+                del self._jobs[msg_id]
+            new = [m for m in ids if m not in self._jobs]
+        fetched = {m: self._meta(m, now) for m in new}
+
+        with self._lock:
+            self._jobs.update(fetched)
+            ranked = []
+            for i, msg_id in enumerate(ids):
+                job = self._jobs[msg_id]
+                job.update(score_message(job["meta"], now))
+                ranked.append((self.effective(job, now), i, msg_id))
+        # 同分保持原顺序
+        ranked.sort(key=lambda r: (-r[0], r[1]))
+        return [m for _, _, m in ranked]
+
+    def started(self, msg_id: str):
+        with self._lock:
+            job = self._jobs.get(msg_id)
+            if job is not None:
+                job["started_at"] = time.time()
+                self._wait[job["class"]].append(job["started_at"] - job["received_at"])
+
+    def finished(self, msg_id: str):
+        with self._lock:
+            job = self._jobs.get(msg_id)
+            if job is not None:
+                self._latency[job["class"]].append(time.time() - job["received_at"])
+                self._completed[job["class"]] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            classes = {}
+            for name, _ in CLASSES:
+                wait, latency = list(self._wait[name]), list(self._latency[name])
+                classes[name] = {
+                    "completed": self._completed[name],
+                    "wait_p50_s": _percentile(wait, 0.5),
+                    "wait_p95_s": _percentile(wait, 0.95),
+                    "latency_p50_s": _percentile(latency, 0.5),
+                    "latency_p95_s": _percentile(latency, 0.95),
+                }
+            return {"aging_per_hour": self.aging_per_hour, "classes": classes}
@@ -0,0 +1,20 @@
+# app/integration/progress.py
+"""
+流水线进度回调
+
+progress(event: str, data: dict)，由调用方传入（例如 SSE 推送）；不传就是 no-op。
+回调里的异常一律吞掉，进度上报不能影响主流程。
+"""
+
+from typing import Any, Callable, Dict, Optional
+
+Progress = Optional[Callable[[str, Dict[str, Any]], None]]
+
+
+def emit(progress: Progress, event: str, **data):
+    if progress is None:
+        return
+    try:
+        progress(event, data)
+    except Exception:
+        pass
@@ -0,0 +1,299 @@
+# app/integration/prompt_templates.py
+"""
+Prompt 模板注册表
+
+所有静态内容（角色说明 + JSON schema + 规则）都放在 system 消息里，逐字节固定、带版本号；
+每票变化的内容（文本块 / 图片）只放在后面的 user 消息。
+
+OpenAI 只缓存 ≥ CACHE_MIN_TOKENS（1024）tokens 的「完全相同的前缀」。现在的几个模板单独都不到这个长度，
+本身不会命中缓存（approx_tokens / cacheable 见 list_templates）；vision_entry 后面紧跟的 user 文本块
+前缀一致时才可能一起命中，以实际 cached_tokens 为准。
+
+fingerprint = 名字 + version + system 的哈希；改模板内容时升 version，
+每次调用的日志（[OpenAI] ... prompt=名字@版本#fingerprint）里就能区分新旧模板、对比 cached_tokens。
+"""
+
+import hashlib
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+# OpenAI prompt cache 的最短前缀
+CACHE_MIN_TOKENS = 1024
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    name: str
+    version: str
+    system: str
+    fingerprint: str = field(default="", compare=False)
+
+    def __post_init__(self):
+        digest = hashlib.sha256(f"{self.name}@{self.version}\n{self.system}".encode("utf-8")).hexdigest()[:12]
+        object.__setattr__(self, "fingerprint", digest)
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}@{self.version}"
+
+    @property
+    def label(self) -> str:
+        """调用日志里用的标识"""
+        return f"{self.key}#{self.fingerprint}"
+
+    @property
+    def approx_tokens(self) -> int:
+        """粗估 token 数：ASCII 约 4 字符一个，中文约一字一个"""
+        ascii_chars = sum(1 for c in self.system if ord(c) < 128)
+        return ascii_chars // 4 + (len(self.system) - ascii_chars)
+
+    @property
+    def cacheable(self) -> bool:
+        return self.approx_tokens >= CACHE_MIN_TOKENS
+
+
+_REGISTRY: Dict[str, PromptTemplate] = {}
+# system 原文 → 模板，用来从 messages 反查本次调用用的是哪个模板
+_BY_SYSTEM: Dict[str, PromptTemplate] = {}
+
+
+def register_template(name: str, version: str, system: str) -> PromptTemplate:
+    tpl = PromptTemplate(name=name, version=version, system=system)
+    _REGISTRY[name] = tpl
+    _BY_SYSTEM[system] = tpl
+    return tpl
+
+
+def get_template(name: str) -> PromptTemplate:
+    if name not in _REGISTRY:
+        raise KeyError(f"未注册的 prompt 模板: {name}")
+    return _REGISTRY[name]
+
+
+def template_of(messages) -> Optional[PromptTemplate]:
+    """messages 的 system 消息对应的模板；不是 build_prefixed_messages 生成的返回 None"""
+    for m in messages or []:
+        if isinstance(m, dict) and m.get("role") == "system" and isinstance(m.get("content"), str):
+            return _BY_SYSTEM.get(m["content"])
+    return None
+
+
+def list_templates() -> List[Dict[str, Any]]:
+    return [
+        {
+            "name": t.name,
+            "version": t.version,
+            "fingerprint": t.fingerprint,
+            "approx_tokens": t.approx_tokens,
+            "cacheable": t.cacheable,
+        }
+        for t in _REGISTRY.values()
+    ]
+
+
+def build_prefixed_messages(name: str, user_content) -> List[Dict[str, Any]]:
+    """固定前缀（system）+ 可变内容（user）"""
+    tpl = get_template(name)
+    return [
+        {"role": "system", "content": tpl.system},
+        {"role": "user", "content": user_content},
+    ]
+
+
+# ---------------------- usage / cached_tokens ---------------------- #
+
+def _get(obj, name, default=None):
+    if obj is None:
+        return default
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+
+def extract_usage(resp) -> Dict[str, Any]:
+    """
+    从 chat.completions 响应中取 token 使用量。
+    cached_tokens 在 usage.prompt_tokens_details.cached_tokens（没有就是 0）。
+    """
+    usage = _get(resp, "usage")
+    details = _get(usage, "prompt_tokens_details")
+    prompt_tokens = _get(usage, "prompt_tokens", 0) or 0
+    cached_tokens = _get(details, "cached_tokens", 0) or 0
+    return {
+        "model": _get(resp, "model"),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": _get(usage, "completion_tokens", 0) or 0,
+        "total_tokens": _get(usage, "total_tokens", 0) or 0,
+        "cached_tokens": cached_tokens,
+        "cache_hit_ratio": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0,
+    }
+
+
+# ====================== 模板定义 ====================== #
+
+VISION_ENTRY_SYSTEM = (
+    "你是严谨的清关单据结构化专家，只能输出 JSON。\n"
+    "你是美国清关单据分析 AI，请从提单、发票、装箱单、到货通知中提取所有信息。\n"
+    "用户消息中会依次给出：若干「文本块」（PDF 文本 / Excel CSV），以及扫描件图片（每张图片前有一行说明）。\n"
+    "并严格按以下 JSON 结构返回（所有字段必须存在）：\n\n"
+    "{\n"
+    '  "summary": {\n'
+    '    "container_no": null,\n'
+    '    "seal_no": null,\n'
+    '    "bl_no": null,\n'
+    '    "firms_code": null,\n'
+    '    "consignee": null,\n'
+    '    "total_packages": null,\n'
+    '    "gross_weight_kg": 0,\n'
+    '    "volume_cbm": 0,\n'
+    '    "total_value_usd": 0\n'
+    "  },\n"
+    '  "bill_of_lading": {},\n'
+    '  "commercial_invoice": {"source": null, "items": []},\n'
+    '  "packing_list": {"source": null, "items": []},\n'
+    '  "arrival_notice": {}\n'
+    "}\n\n"
+    "字段说明：\n"
+    "- bill_of_lading 尽量包含 house_bl_no / master_bl_no / carrier_scac / port_of_entry / port_of_discharge / importer_no。\n"
+    "- commercial_invoice.items 每行尽量包含 description / hs_code / qty / uom / amount / origin / mid。\n"
+    "- packing_list.items 每行尽量包含 description / qty / gross_weight_kg / volume_cbm。\n"
+    "- 数字字段输出数字，不要带货币符号或千分位；找不到的字段填 null。\n"
+    "返回 **纯 JSON**，无解释。"
+)
+
+register_template("vision_entry", "v1", VISION_ENTRY_SYSTEM)
+
+
+DOC_CLASSIFY_SYSTEM = """
+You are an expert customs document analyzer.
+
+Given the document text in the user message, determine its type:
+- bill_of_lading
+- commercial_invoice
+- packing_list
+- arrival_notice
+- or unknown
+
+For every type, also extract these reference numbers when they appear
+(used to join documents of the same shipment):
+{
+    "container": string or list of strings or null,
+    "booking_number": string or null,
+    "bl_no": string or null,
+    "invoice_no": string or null
+}
+
+Then extract ONLY the following JSON fields depending on type:
+
+For bill_of_lading:
+{
+    "consignee": string or null,
+    "container": string or list of strings or null,
+    "booking_number": string or null,
+    "bl_no": string or null,
+    "packages": string or null
+}
+
+For commercial_invoice:
+{
+    "invoice_items": [
+        {
+            "english_desc": string,
+            "qty": number,
+            "hs_code": string or null,
+            "total_value": number or null
+        }
+    ],
+    "total_value": number or null
+}
+
+For packing_list:
+{
+    "packing_rows": [
+        {
+            "qty": number,
+            "gross_weight": number,
+            "volume": number or null
+        }
+    ],
+    "gross_weight_total": number or null
+}
+
+For arrival_notice:
+{
+    "firms_code": string or null
+}
+
+Return JSON:
+{
+    "doc_type": "...",
+    "data": { ... }
+}
+""".strip()
+
+register_template("doc_classify", "v1", DOC_CLASSIFY_SYSTEM)
+
+
+
+# 本地分类器（doc_classifier.py）已确定类型时用的单类型抽取模板：不再让模型判断类型，只抽该类型的字段
+DOC_REF_FIELDS = """{
+    "container": string or list of strings or null,
+    "booking_number": string or null,
+    "bl_no": string or null,
+    "invoice_no": string or null
+}"""
+
+DOC_EXTRACT_FIELDS = {
+    "bill_of_lading": """{
+    "consignee": string or null,
+    "packages": string or null
+}""",
+    "commercial_invoice": """{
+    "invoice_items": [
+        {
+            "english_desc": string,
+            "qty": number,
+            "hs_code": string or null,
+            "total_value": number or null
+        }
+    ],
+    "total_value": number or null
+}""",
+    "packing_list": """{
+    "packing_rows": [
+        {
+            "qty": number,
+            "gross_weight": number,
+            "volume": number or null
+        }
+    ],
+    "gross_weight_total": number or null
+}""",
+    "arrival_notice": """{
+    "firms_code": string or null
+}""",
+}
+
+for _doc_type, _fields in DOC_EXTRACT_FIELDS.items():
+    register_template(
+        f"doc_extract_{_doc_type}",
+        "v1",
+        f"""
+You are an expert customs document analyzer.
+
+The document in the user message is a {_doc_type}; its type is already known.
+
+Extract these reference numbers when they appear (used to join documents of the same shipment):
+{DOC_REF_FIELDS}
+
+and these {_doc_type} fields:
+{_fields}
+
+Put all of them in one object; use null when a field is not present.
+
+Return JSON:
+{{
+    "data": {{ ... }}
+}}
+""".strip(),
+    )
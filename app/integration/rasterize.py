@@ -0,0 +1,224 @@
+# app/integration/rasterize.py
+"""
+扫描页自适应光栅化 + 紧凑编码
+
+以前每页固定 220 dpi、宽度截到 2000px、无损 RGB PNG，黑白扫描件也是几 MB 的 base64。
+gpt-4o high detail 会先把图缩到 2048 以内、再把短边缩到 768，按 512px tile 计 token，
+超出这个尺寸的像素只会浪费字节和内存。这里：
+
+1) DPI 按页面尺寸算：让短边渲染后 ≈ RASTER_TARGET_SHORT_SIDE（默认 768）；
+   页面有文字层时，保证最小字号渲染后不低于 RASTER_MIN_GLYPH_PX；夹在 [MIN_DPI, MAX_DPI]
+2) 先用极低分辨率预览判断是否有颜色：无颜色直接按灰度渲染（内存 1/3）
+3) 灰度图裁掉空白边距（裁完再缩放，有效分辨率更高）
+4) 几乎只有黑白两色 → 1-bit PNG；否则 JPEG / WebP（RASTER_QUALITY）
+5) 长边不超过 RASTER_MAX_LONG_SIDE，逐页处理，像素缓冲用完立即释放
+"""
+
+import base64
+import io
+import math
+from typing import Any, Dict, Optional, Tuple
+
+from app import config
+
+RASTER_TARGET_SHORT_SIDE = config.getenv_int("RASTER_TARGET_SHORT_SIDE", 768)
+RASTER_MAX_LONG_SIDE = config.getenv_int("RASTER_MAX_LONG_SIDE", 2048)
+RASTER_MIN_DPI = config.getenv_int("RASTER_MIN_DPI", 72)
+RASTER_MAX_DPI = config.getenv_int("RASTER_MAX_DPI", 220)
+RASTER_MIN_GLYPH_PX = config.getenv_int("RASTER_MIN_GLYPH_PX", 10)
+RASTER_FORMAT = (config.getenv("RASTER_FORMAT", "jpeg") or "jpeg").lower()  # jpeg / webp
+RASTER_QUALITY = config.getenv_int("RASTER_QUALITY", 80)
+
+# 颜色判断：预览图上 |R-G|、|G-B| 的均值阈值
+COLOR_MEAN_DIFF = 6
+# 灰度直方图两端（<48 或 >208）占比超过该值 → 视为黑白文档
+BILEVEL_RATIO = 0.97
+# 亮度高于该值视为空白（裁边）
+BLANK_LEVEL = 245
+CROP_PADDING = 12
+
+PREVIEW_DPI = 18
+TILE = 512
+
+
+# ---------------------- DPI ---------------------- #
+
+def _min_text_height_pt(page) -> Optional[float]:
+    """文字层里最小的字号（pt）；扫描件没有文字层时返回 None"""
+    try:
+        d = page.get_text("dict")
+    except Exception:
+        return None
+    sizes = [
+        span.get("size", 0)
+        for block in d.get("blocks", [])
+        for line in block.get("lines", [])
+        for span in line.get("spans", [])
+        if span.get("text", "").strip()
+    ]
+    sizes = [s for s in sizes if s > 2]
+    return min(sizes) if sizes else None
+
+
+def choose_dpi(page) -> int:
+    rect = page.rect
+    short_in = max(min(rect.width, rect.height) / 72.0, 0.5)
+    long_in = max(rect.width, rect.height) / 72.0
+
+    dpi = RASTER_TARGET_SHORT_SIDE / short_in
+
+    text_pt = _min_text_height_pt(page)
+    if text_pt:
+        dpi = max(dpi, RASTER_MIN_GLYPH_PX * 72.0 / text_pt)
+
+    # 长边不超过上限
+    dpi = min(dpi, RASTER_MAX_LONG_SIDE / max(long_in, 0.5))
+    return int(max(RASTER_MIN_DPI, min(RASTER_MAX_DPI, dpi)))
+
+
+# ---------------------- 颜色 / 黑白判断 ---------------------- #
+
+def _is_colorful(img) -> bool:
+    from PIL import ImageChops, ImageStat
+
+    rgb = img.convert("RGB")
+    r, g, b = rgb.split()
+    rg = ImageStat.Stat(ImageChops.difference(r, g)).mean[0]
+    gb = ImageStat.Stat(ImageChops.difference(g, b)).mean[0]
+    return max(rg, gb) > COLOR_MEAN_DIFF
+
+
+def _is_bilevel(gray) -> bool:
+    hist = gray.histogram()
+    total = sum(hist) or 1
+    extremes = sum(hist[:48]) + sum(hist[208:])
+    return extremes / total >= BILEVEL_RATIO
+
+
+def _crop_margins(gray):
+    """只看灰度：比 BLANK_LEVEL 暗的像素的外接框"""
+    mask = gray.point(lambda p: 255 if p < BLANK_LEVEL else 0)
+    box = mask.getbbox()
+    if not box:
+        return gray
+    left, top, right, bottom = box
+    left = max(0, left - CROP_PADDING)
+    top = max(0, top - CROP_PADDING)
+    right = min(gray.width, right + CROP_PADDING)
+    bottom = min(gray.height, bottom + CROP_PADDING)
+    if (right - left) * (bottom - top) >= 0.95 * gray.width * gray.height:
+        return gray
+    return gray.crop((left, top, right, bottom))
+
+
+def _fit(img):
+    """按模型视角缩放：长边 ≤ MAX_LONG_SIDE，短边 ≤ TARGET_SHORT_SIDE 的 2 倍（留余量给裁边后的放大）"""
+    from PIL import Image
+
+    w, h = img.size
+    scale = min(
+        1.0,
+        RASTER_MAX_LONG_SIDE / max(w, h),
+        (RASTER_TARGET_SHORT_SIDE * 2) / min(w, h),
+    )
+    if scale < 1.0:
+        img = img.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+    return img
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """gpt-4o high detail 的 token 估算：85 + 170 × tile 数"""
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * math.ceil(w / TILE) * math.ceil(h / TILE)
+
+
+# ---------------------- 编码 ---------------------- #
+
+def encode_image(img, colorful: Optional[bool] = None) -> Tuple[bytes, str, str, Tuple[int, int]]:
+    """
+    PIL Image → (bytes, mime, mode, (width, height))
+    mode: color / gray / bilevel
+    colorful: 已知是否有颜色时传入，省一次全图统计
+    """
+    if colorful is None:
+        colorful = img.mode not in ("L", "1") and _is_colorful(img)
+
+    if colorful:
+        out = _fit(img.convert("RGB"))
+        mode = "color"
+    else:
+        gray = _crop_margins(img.convert("L"))
+        out = _fit(gray)
+        mode = "bilevel" if _is_bilevel(out) else "gray"
+
+    buf = io.BytesIO()
+    if mode == "bilevel":
+        out.convert("1", dither=0).save(buf, format="PNG", optimize=True)
+        mime = "image/png"
+    elif RASTER_FORMAT == "webp":
+        out.save(buf, format="WEBP", quality=RASTER_QUALITY, method=4)
+        mime = "image/webp"
+    else:
+        out.save(buf, format="JPEG", quality=RASTER_QUALITY, optimize=True)
+        mime = "image/jpeg"
+
+    return buf.getvalue(), mime, mode, out.size
+
+
+def _image_item(data: bytes, mime: str, mode: str, size, hint: str) -> Dict[str, Any]:
+    return {
+        "b64": base64.b64encode(data).decode(),
+        "mime": mime,
+        "hint": hint,
+        "mode": mode,
+        "width": size[0],
+        "height": size[1],
+        "bytes": len(data),
+        "est_tokens": estimate_image_tokens(*size),
+    }
+
+
+def render_pdf_page(page, hint: str) -> Dict[str, Any]:
+    """PyMuPDF page → image item（b64 + mime + 统计信息）"""
+    import fitz
+    from PIL import Image
+
+    # 1) 极低分辨率预览判断颜色
+    preview = page.get_pixmap(dpi=PREVIEW_DPI, alpha=False)
+    colorful = _is_colorful(Image.frombytes("RGB", (preview.width, preview.height), preview.samples))
+    del preview
+
+    # 2) 按自适应 DPI 渲染；无颜色直接灰度渲染
+    dpi = choose_dpi(page)
+    if colorful:
+        pix = page.get_pixmap(dpi=dpi, alpha=False)
+        img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    else:
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+        img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    del pix
+
+    data, mime, mode, size = encode_image(img, colorful)
+    del img
+
+    item = _image_item(data, mime, mode, size, hint)
+    item["dpi"] = dpi
+    return item
+
+
+def compact_image_file(path: str, hint: str) -> Dict[str, Any]:
+    """图片附件 → 同样的缩放 / 灰度 / 编码策略（手机拍照动辄 10MB）"""
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as im:
+        im.draft("RGB", (RASTER_MAX_LONG_SIDE, RASTER_MAX_LONG_SIDE))  # JPEG 解码时直接降采样
+        im = ImageOps.exif_transpose(im)
+        data, mime, mode, size = encode_image(im)
+    return _image_item(data, mime, mode, size, hint)
+
+
+def image_data_url(img: Dict[str, Any]) -> str:
+    return f"data:{img.get('mime', 'image/png')};base64,{img['b64']}"
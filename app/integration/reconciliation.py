@@ -0,0 +1,319 @@
+# app/integration/reconciliation.py
+"""
+数字对账 + 定向追问
+
+GPT 返回的 JSON 以前直接使用，金额 / 重量对不上要等报关员人工发现，
+修正只能整票重跑多图 prompt。这里：
+
+1) run_checks: 用 pandas 对发票行、装箱单行、summary 总额做向量化交叉校验
+   - 发票每行 qty × unit_price ≈ amount
+   - 发票行 amount 合计 ≈ summary.total_value_usd
+   - 装箱单毛重合计 ≈ summary.gross_weight_kg
+   - 装箱单体积合计 ≈ summary.volume_cbm
+   - 装箱单件数合计 ≈ summary.total_packages
+2) reask_fields: 只把不一致的字段 + 相关文本块发给小模型追问，按字段路径回填
+3) reconcile: 1 + 2 + 复查，结果附在 result["reconciliation"]
+"""
+
+import json
+import re
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from app import config
+
+if TYPE_CHECKING:
+    import pandas as pd
+from app.integration.prompt_templates import build_prefixed_messages, register_template
+from app.integration.rasterize import image_data_url
+
+RECONCILE_ENABLED = config.getenv_bool("RECONCILE_ENABLED", True)
+RECONCILE_MODEL = config.getenv("RECONCILE_MODEL", "gpt-4o-mini")
+RECONCILE_MAX_TOKENS = config.getenv_int("RECONCILE_MAX_TOKENS", 1024)
+# 相对误差容忍度
+RECONCILE_TOLERANCE = config.getenv_float("RECONCILE_TOLERANCE", 0.02)
+# 追问时最多带几个文本块 / 几张图片
+RECONCILE_MAX_CHUNKS = 3
+RECONCILE_MAX_IMAGES = 2
+
+# 字段别名（与 entry_schema.ALIASES 保持一致）
+AMOUNT_KEYS = ["amount", "total", "line_total", "total_value"]
+UNIT_PRICE_KEYS = ["unit_price", "price"]
+QTY_KEYS = ["qty", "quantity"]
+GW_KEYS = ["gross_weight_kg", "gross_weight", "gw"]
+VOLUME_KEYS = ["volume_cbm", "volume", "cbm"]
+PACKAGE_KEYS = ["cartons", "packages", "ctns"]
+
+INVOICE_HINTS = ["INVOICE", "UNIT PRICE", "AMOUNT", "USD", "发票", "invoice"]
+PACKING_HINTS = ["PACKING", "CARTON", "G.W", "GW", "CBM", "装箱单", "packing_list"]
+
+
+# ---------------------- 数值列 ---------------------- #
+
+def _to_numeric(s: "pd.Series") -> "pd.Series":
+    import pandas as pd
+
+    cleaned = s.astype(str).str.replace(r"[,$\s]|USD|KGS?|CBM|CTNS?|PCS|PKGS?", "", regex=True, flags=re.I)
+    return pd.to_numeric(cleaned, errors="coerce")
+
+
+def _column(df: "pd.DataFrame", keys: List[str]):
+    """按别名顺序取第一列存在的数值列，返回 (列名, Series) 或 (None, None)"""
+    for k in keys:
+        if k in df.columns:
+            col = _to_numeric(df[k])
+            if col.notna().any():
+                return k, col
+    return None, None
+
+
+def _num(v) -> Optional[float]:
+    import pandas as pd
+
+    if v is None or v == "":
+        return None
+    val = _to_numeric(pd.Series([v])).iloc[0]
+    return None if pd.isna(val) else float(val)
+
+
+def _items_frame(items) -> "pd.DataFrame":
+    """index 保持原列表下标，方便生成字段路径"""
+    import pandas as pd
+
+    pairs = [(i, it) for i, it in enumerate(items or []) if isinstance(it, dict)]
+    if not pairs:
+        return pd.DataFrame()
+    return pd.DataFrame([it for _, it in pairs], index=[i for i, _ in pairs])
+
+
+def _close(a: float, b: float, tol: float) -> bool:
+    return abs(a - b) <= tol * max(abs(a), abs(b), 1.0)
+
+
+# ---------------------- 1) 交叉校验 ---------------------- #
+
+def run_checks(result: Dict[str, Any], tol: float = RECONCILE_TOLERANCE) -> List[Dict[str, Any]]:
+    """
+    返回问题列表，每项：
+    {"check", "section", "fields": [字段路径], "expected", "actual", "message"}
+    """
+    issues: List[Dict[str, Any]] = []
+    if not isinstance(result, dict) or "error" in result:
+        return issues
+
+    import pandas as pd
+
+    summary = result.get("summary") or {}
+    inv = _items_frame((result.get("commercial_invoice") or {}).get("items"))
+    pl = _items_frame((result.get("packing_list") or {}).get("items"))
+
+    # ---------- 发票行：qty × unit_price ≈ amount ----------
+    amount_key, amount = _column(inv, AMOUNT_KEYS)
+    qty_key, qty = _column(inv, QTY_KEYS)
+    price_key, price = _column(inv, UNIT_PRICE_KEYS)
+
+    if amount is not None and qty is not None and price is not None:
+        expected = qty * price
+        diff = (expected - amount).abs()
+        scale = pd.concat([expected.abs(), amount.abs()], axis=1).max(axis=1).clip(lower=1.0)
+        bad = (diff > tol * scale) & expected.notna() & amount.notna()
+        for idx in bad[bad].index:
+            issues.append({
+                "check": "invoice_line_amount",
+                "section": "commercial_invoice",
+                "fields": [
+                    f"commercial_invoice.items[{idx}].{qty_key}",
+                    f"commercial_invoice.items[{idx}].{price_key}",
+                    f"commercial_invoice.items[{idx}].{amount_key}",
+                ],
+                "expected": round(float(expected[idx]), 2),
+                "actual": round(float(amount[idx]), 2),
+                "message": f"发票第 {idx + 1} 行 qty×unit_price={expected[idx]:.2f} ≠ amount={amount[idx]:.2f}",
+            })
+
+    # ---------- 发票合计 vs summary ----------
+    total_value = _num(summary.get("total_value_usd"))
+    if amount is not None and total_value:
+        s = float(amount.sum(skipna=True))
+        if not _close(s, total_value, tol):
+            issues.append({
+                "check": "invoice_total",
+                "section": "commercial_invoice",
+                "fields": ["summary.total_value_usd"] + [
+                    f"commercial_invoice.items[{i}].{amount_key}" for i in amount.index
+                ],
+                "expected": round(s, 2),
+                "actual": total_value,
+                "message": f"发票行合计 {s:.2f} ≠ summary.total_value_usd {total_value:.2f}",
+            })
+
+    # ---------- 装箱单合计 vs summary ----------
+    for check, keys, summary_key, label in [
+        ("packing_gross_weight", GW_KEYS, "gross_weight_kg", "毛重"),
+        ("packing_volume", VOLUME_KEYS, "volume_cbm", "体积"),
+        ("packing_packages", PACKAGE_KEYS, "total_packages", "件数"),
+    ]:
+        target = _num(summary.get(summary_key))
+        key, col = _column(pl, keys)
+        if col is None or not target:
+            continue
+        s = float(col.sum(skipna=True))
+        if not _close(s, target, tol):
+            issues.append({
+                "check": check,
+                "section": "packing_list",
+                "fields": [f"summary.{summary_key}"] + [
+                    f"packing_list.items[{i}].{key}" for i in col.index
+                ],
+                "expected": round(s, 3),
+                "actual": target,
+                "message": f"装箱单{label}合计 {s:.3f} ≠ summary.{summary_key} {target:.3f}",
+            })
+
+    return issues
+
+
+# ---------------------- 字段路径读写 ---------------------- #
+
+_PATH_RE = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+
+
+def _parse_path(path: str) -> List[Any]:
+    return [int(i) if i else k for k, i in _PATH_RE.findall(path)]
+
+
+def get_path(obj, path: str):
+    for part in _parse_path(path):
+        try:
+            obj = obj[part]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return obj
+
+
+def set_path(obj, path: str, value) -> bool:
+    parts = _parse_path(path)
+    for part in parts[:-1]:
+        try:
+            obj = obj[part]
+        except (KeyError, IndexError, TypeError):
+            return False
+    try:
+        obj[parts[-1]] = value
+        return True
+    except (IndexError, TypeError):
+        return False
+
+
+# ---------------------- 2) 定向追问 ---------------------- #
+
+RECONCILE_SYSTEM = (
+    "你是严谨的清关单据核对专家，只能输出 JSON。\n"
+    "用户会给出一份已抽取结果中数字对不上的字段（字段路径 + 当前值 + 校验说明），"
+    "以及相关单据的原文片段。\n"
+    "请只根据原文重新核对这些字段，返回：\n"
+    '{"fields": {"<字段路径>": <正确的数值或 null>}}\n'
+    "- 只返回给出的字段路径，不要新增字段。\n"
+    "- 数字不带货币符号或千分位。\n"
+    "- 原文确实如此（单据本身不平）时，原样返回当前值。\n"
+    "返回 **纯 JSON**，无解释。"
+)
+
+register_template("reconcile_fields", "v1", RECONCILE_SYSTEM)
+
+
+def _relevant_chunks(payload: Dict[str, Any], sections: List[str]) -> List[str]:
+    hints = []
+    if "commercial_invoice" in sections:
+        hints += INVOICE_HINTS
+    if "packing_list" in sections:
+        hints += PACKING_HINTS
+
+    scored = []
+    for chunk in payload.get("text_chunks") or []:
+        score = sum(1 for h in hints if h in chunk)
+        if score:
+            scored.append((score, chunk))
+    scored.sort(key=lambda x: -x[0])
+    return [c for _, c in scored[:RECONCILE_MAX_CHUNKS]]
+
+
+def build_reask_messages(result: Dict[str, Any], issues: List[Dict[str, Any]],
+                         payload: Dict[str, Any]):
+    fields = {}
+    for iss in issues:
+        for f in iss["fields"]:
+            fields[f] = get_path(result, f)
+
+    sections = sorted({iss["section"] for iss in issues})
+    chunks = _relevant_chunks(payload, sections)
+
+    user_content = [{
+        "type": "text",
+        "text": (
+            "==== 待核对字段 ====\n"
+            + json.dumps(fields, ensure_ascii=False, indent=1)
+            + "\n\n==== 校验问题 ====\n"
+            + "\n".join(iss["message"] for iss in issues)
+        ),
+    }]
+    for i, chunk in enumerate(chunks, start=1):
+        user_content.append({"type": "text", "text": f"==== 原文片段 {i} ====\n{chunk}"})
+
+    # 没有可用的文本原文（扫描件）→ 带少量图片
+    if not chunks:
+        for img in (payload.get("images") or [])[:RECONCILE_MAX_IMAGES]:
+            if img.get("b64"):
+                user_content.append({"type": "text", "text": img.get("hint", "")})
+                user_content.append({
+                    "type": "image_url",
+                    "image_url": {"url": image_data_url(img)},
+                })
+
+    return build_prefixed_messages("reconcile_fields", user_content), list(fields)
+
+
+def reask_fields(result: Dict[str, Any], issues: List[Dict[str, Any]],
+                 payload: Dict[str, Any]) -> List[str]:
+    """追问并回填，返回实际被修改的字段路径"""
+    from app.integration.analyze_vision import call_gpt_and_parse_json
+
+    messages, allowed = build_reask_messages(result, issues, payload)
+    answer = call_gpt_and_parse_json(messages, model=RECONCILE_MODEL, max_tokens=RECONCILE_MAX_TOKENS)
+    fields = answer.get("fields") if isinstance(answer, dict) else None
+    if not isinstance(fields, dict):
+        return []
+
+    changed = []
+    allowed_set = set(allowed)
+    for path, value in fields.items():
+        if path not in allowed_set:
+            continue
+        if get_path(result, path) != value and set_path(result, path, value):
+            changed.append(path)
+    return changed
+
+
+# ---------------------- 3) 主入口 ---------------------- #
+
+def reconcile(result: Dict[str, Any], payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    校验 → 有问题则定向追问一次 → 复查。
+    就地修改 result，并写入 result["reconciliation"]。
+    """
+    if not isinstance(result, dict) or "error" in result:
+        return result
+
+    issues = run_checks(result)
+    report: Dict[str, Any] = {"issues_before": [i["message"] for i in issues], "changed_fields": []}
+
+    if issues and RECONCILE_ENABLED:
+        try:
+            report["changed_fields"] = reask_fields(result, issues, payload)
+        except Exception as e:
+            report["error"] = f"追问失败: {e}"
+        issues = run_checks(result)
+
+    report["issues_after"] = [i["message"] for i in issues]
+    report["status"] = "OK" if not issues else "NEEDS_REVIEW"
+    result["reconciliation"] = report
+    return result
@@ -0,0 +1,352 @@
+# app/integration/resilience.py
+"""
+OpenAI 调用的韧性层：截止时间 / 对冲请求 / 熔断 / 备用模型
+
+gpt-4o 偶尔一挂就是几分钟，call_gpt_and_parse_json 没有超时也没有兜底，
+API 一降级，所有 worker 都被拖住，p99 由这几次调用决定。这里：
+
+1) 截止时间：deadline_scope(秒) 给整个流水线一个预算，每次调用的超时 = min(单次上限, 剩余预算)
+2) 对冲请求：非流式调用在 p95 延迟后还没返回，就再发一个相同请求（temperature=0，幂等），先回来的赢；
+   决出胜负 / 超时放弃后，其余调用收到 cancel 信号（还在排队的直接取消，流式调用在下一个 chunk 停下），
+   被放弃的调用不计入熔断样本；线程池里没有空闲槽时不发对冲，免得挤占别的请求
+3) 熔断：每个模型一个滑动窗口，失败率或慢调用率超过阈值就打开，冷却后放一个探测请求（half-open）
+4) 备用模型：主模型熔断 / 失败时换 OPENAI_FALLBACK_MODEL；都不可用 → CircuitOpenError，
+   调用方把这票标记为 DEFERRED，稍后再处理
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app import config
+from app.profiling import traced
+
+# 单次调用超时上限（秒）；流水线预算见 deadline_scope
+OPENAI_CALL_TIMEOUT = config.getenv_float("OPENAI_CALL_TIMEOUT", 120)
+OPENAI_FALLBACK_MODEL = config.getenv("OPENAI_FALLBACK_MODEL", "gpt-4o-mini")
+OPENAI_MAX_WORKERS = config.getenv_int("OPENAI_MAX_WORKERS", 16)
+
+HEDGE_ENABLED = config.getenv_bool("HEDGE_ENABLED", True)
+# 对冲延迟 = 该模型最近成功调用的 p95，夹在 [MIN, MAX]；样本不足时用 DEFAULT
+HEDGE_MIN_DELAY = config.getenv_float("HEDGE_MIN_DELAY", 5)
+HEDGE_MAX_DELAY = config.getenv_float("HEDGE_MAX_DELAY", 60)
+HEDGE_DEFAULT_DELAY = config.getenv_float("HEDGE_DEFAULT_DELAY", 30)
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 200
+
+BREAKER_WINDOW = config.getenv_int("BREAKER_WINDOW", 20)
+BREAKER_MIN_CALLS = config.getenv_int("BREAKER_MIN_CALLS", 5)
+BREAKER_FAILURE_RATE = config.getenv_float("BREAKER_FAILURE_RATE", 0.5)
+# 超过 BREAKER_SLOW_MS 的调用算慢调用
+BREAKER_SLOW_MS = config.getenv_int("BREAKER_SLOW_MS", 90000)
+BREAKER_SLOW_RATE = config.getenv_float("BREAKER_SLOW_RATE", 0.5)
+BREAKER_COOLDOWN = config.getenv_float("BREAKER_COOLDOWN", 30)
+
+
+class CircuitOpenError(RuntimeError):
+    """主模型和备用模型都熔断，调用方应推迟处理"""
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class AttemptCancelled(RuntimeError):
+    """对冲输掉 / 超时被放弃的调用，fn 看到 cancel 信号后抛出；sent=False 表示请求还没发出去"""
+
+    def __init__(self, message: str = "", sent: bool = True):
+        super().__init__(message)
+        self.sent = sent
+
+
+# ---------------------- 截止时间 ---------------------- #
+
+_deadline: ContextVar[Optional[float]] = ContextVar("openai_deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(seconds: float):
+    """嵌套时取更早的截止时间"""
+    new = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(min(new, current) if current else new)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def call_timeout() -> float:
+    """本次调用可用的超时（秒）；预算已用完 → DeadlineExceeded"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return OPENAI_CALL_TIMEOUT
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("请求预算已用完")
+    return min(OPENAI_CALL_TIMEOUT, left)
+
+
+# ---------------------- 熔断器 ---------------------- #
+
+class CircuitBreaker:
+    """closed → (失败率 / 慢调用率超限) → open → (冷却) → half_open → 探测成功 closed / 失败 open"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.trips = 0
+        self._window: deque = deque(maxlen=BREAKER_WINDOW)
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < BREAKER_COOLDOWN:
+                    return False
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record(self, ok: bool, latency_ms: int):
+        slow = latency_ms >= BREAKER_SLOW_MS
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_in_flight = False
+                if ok and not slow:
+                    self.state = "closed"
+                    self._window.clear()
+                else:
+                    self._open()
+                return
+            if self.state == "open":
+                return
+
+            self._window.append((ok, slow))
+            n = len(self._window)
+            if n < BREAKER_MIN_CALLS:
+                return
+            failures = sum(1 for o, _ in self._window if not o)
+            slows = sum(1 for _, s in self._window if s)
+            if failures / n >= BREAKER_FAILURE_RATE or slows / n >= BREAKER_SLOW_RATE:
+                self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self._window.clear()
+        print(f"[Breaker] {self.name} 熔断打开（第 {self.trips} 次），{BREAKER_COOLDOWN:g}s 后探测")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "trips": self.trips, "window": len(self._window)}
+
+
+# ---------------------- 每个模型的状态 ---------------------- #
+
+_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+_latencies: Dict[str, deque] = {}
+_counters: Dict[str, Dict[str, int]] = {}
+# 已提交到线程池、还没结束的调用数（含排队的）
+_inflight = 0
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=OPENAI_MAX_WORKERS, thread_name_prefix="openai")
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def _breaker(model: str) -> CircuitBreaker:
+    with _lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(model)
+            _latencies[model] = deque(maxlen=LATENCY_SAMPLES)
+            _counters[model] = {"calls": 0, "errors": 0, "hedges": 0, "hedge_wins": 0, "fallbacks": 0, "rejected": 0}
+        return _breakers[model]
+
+
+def _count(model: str, key: str):
+    with _lock:
+        _counters[model][key] += 1
+
+
+def _p95(model: str) -> Optional[float]:
+    with _lock:
+        samples = sorted(_latencies[model])
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    return samples[int(len(samples) * 0.95) - 1] / 1000.0
+
+
+def hedge_delay(model: str) -> float:
+    p95 = _p95(model)
+    if p95 is None:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, min(HEDGE_MAX_DELAY, p95))
+
+
+# ---------------------- 调用 ---------------------- #
+
+def _has_spare_worker() -> bool:
+    with _lock:
+        return _inflight < OPENAI_MAX_WORKERS
+
+
+def _attempt(model: str, fn: Callable[[str, float, threading.Event], Any], timeout: float,
+             cancel: threading.Event, on_attempt: Optional[Callable] = None):
+    """
+    在线程池里跑一次调用，完成时（无论输赢）记录延迟和熔断样本；被放弃的调用不记。
+    on_attempt(model, fut, ms) 在每次真正发出去的调用结束时回调（含对冲输家、超时、失败），用于记账
+    """
+    global _inflight
+    breaker = _breaker(model)
+    t0 = time.perf_counter()
+    _count(model, "calls")
+    with _lock:
+        _inflight += 1
+
+    def _done(fut):
+        global _inflight
+        with _lock:
+            _inflight -= 1
+        ms = int((time.perf_counter() - t0) * 1000)
+        if fut.cancelled():
+            return
+        err = fut.exception()
+        if on_attempt is not None and getattr(err, "sent", True):
+            try:
+                on_attempt(model, fut, ms)
+            except Exception as e:
+                print(f"⚠ [{model}] 调用记账回调失败:", e)
+        if isinstance(err, AttemptCancelled):
+            return
+        ok = fut.exception() is None
+        if ok:
+            with _lock:
+                _latencies[model].append(ms)
+        else:
+            _count(model, "errors")
+        breaker.record(ok, ms)
+
+    fut = _get_executor().submit(traced(fn), model, timeout, cancel)
+    fut.add_done_callback(_done)
+    return fut
+
+
+def _hedged(model: str, fn: Callable[[str, float, threading.Event], Any], hedge: bool,
+            on_attempt: Optional[Callable] = None):
+    timeout = call_timeout()
+    started = time.monotonic()
+    cancel = threading.Event()
+    futures = [_attempt(model, fn, timeout, cancel, on_attempt)]
+
+    try:
+        delay = hedge_delay(model)
+        if hedge and HEDGE_ENABLED and _breaker(model).state == "closed" and delay < timeout:
+            done, _ = wait(futures, timeout=delay)
+            if not done and _has_spare_worker():
+                _count(model, "hedges")
+                print(f"[Hedge] {model} {delay:.1f}s 未返回，发出对冲请求")
+                futures.append(_attempt(model, fn, timeout - delay, cancel, on_attempt))
+
+        pending = set(futures)
+        last_error: Optional[BaseException] = None
+        while pending:
+            left = timeout - (time.monotonic() - started)
+            if left <= 0:
+                break
+            done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    if len(futures) > 1 and fut is futures[1]:
+                        _count(model, "hedge_wins")
+                    return fut.result()
+                last_error = fut.exception()
+
+        if last_error is not None and not pending:
+            raise last_error
+        raise DeadlineExceeded(f"{model} 超过 {timeout:.1f}s 未返回")
+    finally:
+        # 输掉的 / 超时的调用不再占着线程池：排队中的直接取消，跑着的由 fn 看 cancel 自行停下
+        cancel.set()
+        for fut in futures:
+            fut.cancel()
+
+
+def call_model(model: str, fn: Callable[[str, float, threading.Event], Any],
+               hedge: bool = True, on_attempt: Optional[Callable] = None) -> Tuple[Any, str]:
+    """
+    fn(model, timeout, cancel) 发起一次实际调用（必须幂等）；cancel 被 set 表示结果已不需要，
+    能中途停下的（流式）应尽快抛 AttemptCancelled，不能的靠 timeout 兜底。
+    返回 (fn 的结果, 实际使用的模型)；主模型熔断 / 失败时依次尝试备用模型。
+    全部熔断 → CircuitOpenError；调用失败 → 抛出最后一次的异常。
+    on_attempt(model, fut, ms)：每次发出去的调用（主调用、对冲、备用模型，无论输赢）结束时回调，
+    在线程池线程里执行；call_model 返回时输掉的调用可能还没结束。
+    """
+    candidates: List[str] = [model]
+    if OPENAI_FALLBACK_MODEL and OPENAI_FALLBACK_MODEL != model:
+        candidates.append(OPENAI_FALLBACK_MODEL)
+
+    last_error: Optional[BaseException] = None
+    for i, candidate in enumerate(candidates):
+        if not _breaker(candidate).allow():
+            _count(candidate, "rejected")
+            continue
+        if i > 0:
+            _count(model, "fallbacks")
+            print(f"[Breaker] {model} 熔断或调用失败，改用备用模型 {candidate}")
+        try:
+            return _hedged(candidate, fn, hedge, on_attempt), candidate
+        except DeadlineExceeded as e:
+            # 预算用完就不再换模型
+            if _deadline.get() is not None and _deadline.get() <= time.monotonic():
+                raise
+            last_error = e
+        except Exception as e:
+            last_error = e
+
+    if last_error is None:
+        raise CircuitOpenError(f"{', '.join(candidates)} 均已熔断")
+    raise last_error
+
+
+def get_resilience_metrics() -> Dict[str, Any]:
+    out = {}
+    for model, breaker in list(_breakers.items()):
+        p95 = _p95(model)
+        with _lock:
+            counters = dict(_counters[model])
+        out[model] = {
+            **breaker.snapshot(),
+            **counters,
+            "p95_ms": int(p95 * 1000) if p95 is not None else None,
+            "hedge_delay_s": round(hedge_delay(model), 2),
+        }
+    return out
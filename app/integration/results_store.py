@@ -0,0 +1,761 @@
+# app/integration/results_store.py
+"""
+解析结果库（SQLite, WAL 模式）
+
+以前每次运行都覆盖 attachments/results/latest.json，历史丢失，并发运行还会互相覆盖。
+现在每封邮件一行 shipments：
+  GPT 原始输出 / 映射后的 entry JSON / entryUpload XML / NET CHB 返回
+
+检索用的 key 放在 shipment_refs(kind, value, shipment_id)：
+  kind = container / mbl / hbl / consignee
+一票多柜、多提单都能命中，(kind, value) 上有索引。
+分页用 keyset（id 倒序 + cursor），百万行也不会退化成 OFFSET 全表扫。
+
+只支持单机：WAL 靠共享内存（-shm）和文件锁协调，NFS / SMB 等网络文件系统上这两样都不可靠，
+多台机器共用一个库文件会损坏数据。RESULTS_DB 在网络文件系统上时拒绝启动；
+同一台机器上的多个进程（多个 worker / API 实例）共用一个本地库文件没有问题。
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app import config
+from app.integration.netchb_aggregator import CONTAINER_RE, _iter_values
+
+RESULTS_DB = config.getenv("RESULTS_DB", os.path.join("attachments", "results", "results.db"))
+
+# /proc/mounts 里这些文件系统类型视为网络文件系统
+NETWORK_FS_TYPES = {
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "lustre", "davfs",
+    "fuse.sshfs", "fuse.glusterfs", "fuse.cephfs", "fuse.s3fs", "fuse.gcsfuse", "fuse.rclone",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shipments (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id   TEXT,
+    thread_id    TEXT,
+    created_at   INTEGER NOT NULL,
+    sender       TEXT,
+    subject      TEXT,
+    status       TEXT,
+    files_json   TEXT,
+    raw_json     TEXT,
+    entry_json   TEXT,
+    entry_xml    TEXT,
+    netchb_json  TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_shipments_created ON shipments(created_at);
+CREATE INDEX IF NOT EXISTS idx_shipments_message ON shipments(message_id);
+CREATE INDEX IF NOT EXISTS idx_shipments_thread ON shipments(thread_id);
+-- 按状态查（DEFERRED / ERROR 重跑、GET /shipments?status=）+ id 倒序分页
+CREATE INDEX IF NOT EXISTS idx_shipments_status ON shipments(status, id);
+
+CREATE TABLE IF NOT EXISTS shipment_refs (
+    kind         TEXT NOT NULL,
+    value        TEXT NOT NULL,
+    shipment_id  INTEGER NOT NULL REFERENCES shipments(id) ON DELETE CASCADE,
+    PRIMARY KEY (kind, value, shipment_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_refs_shipment ON shipment_refs(shipment_id);
+
+-- 每次模型调用一行（见 accounting.py），按 message / customer / day 汇总
+CREATE TABLE IF NOT EXISTS usage_calls (
+    id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id         TEXT,
+    customer           TEXT,
+    day                TEXT NOT NULL,
+    created_at         INTEGER NOT NULL,
+    model              TEXT,
+    prompt_tokens      INTEGER NOT NULL DEFAULT 0,
+    cached_tokens      INTEGER NOT NULL DEFAULT 0,
+    completion_tokens  INTEGER NOT NULL DEFAULT 0,
+    images             INTEGER NOT NULL DEFAULT 0,
+    pixels             INTEGER NOT NULL DEFAULT 0,
+    latency_ms         INTEGER NOT NULL DEFAULT 0,
+    cost_usd           REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_usage_customer_day ON usage_calls(customer, day);
+CREATE INDEX IF NOT EXISTS idx_usage_day ON usage_calls(day);
+CREATE INDEX IF NOT EXISTS idx_usage_message ON usage_calls(message_id);
+
+-- 文档类型分类器的训练样本（见 doc_classifier.py）：sha = 文本哈希；source = gpt / manual，manual 优先
+CREATE TABLE IF NOT EXISTS doc_samples (
+    sha          TEXT PRIMARY KEY,
+    label        TEXT NOT NULL,
+    source       TEXT NOT NULL,
+    file_name    TEXT,
+    text         TEXT NOT NULL,
+    created_at   INTEGER NOT NULL
+);
+
+-- 单个附件的解析结果缓存（见 thread_merge.py）：sha = 文件内容哈希
+CREATE TABLE IF NOT EXISTS doc_extractions (
+    sha          TEXT PRIMARY KEY,
+    file_name    TEXT,
+    result_json  TEXT NOT NULL,
+    created_at   INTEGER NOT NULL
+);
+
+-- 供应商版式模板（见 layout_templates.py）：signature = 页面尺寸 + 页数；
+-- labels_json = 稳定的标签文字 + 位置，fields_json / tables_json = 学到的字段坐标（带确认次数）
+CREATE TABLE IF NOT EXISTS layout_templates (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    signature    TEXT NOT NULL,
+    labels_json  TEXT NOT NULL,
+    fields_json  TEXT NOT NULL,
+    tables_json  TEXT NOT NULL,
+    samples      INTEGER NOT NULL DEFAULT 0,
+    hits         INTEGER NOT NULL DEFAULT 0,
+    misses       INTEGER NOT NULL DEFAULT 0,
+    created_at   INTEGER NOT NULL,
+    updated_at   INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_layout_signature ON layout_templates(signature);
+
+-- 处理租约：key = gmail:<message id> / files:<发件人>:<附件哈希>
+-- running 且未过期 = 有进程正在处理；done = 已处理完（result_json 里是 shipment_id 等摘要）
+-- retry = 退避中；failed = worker 重试次数用完，不再自动认领；attempts = worker 认领次数
+CREATE TABLE IF NOT EXISTS leases (
+    key          TEXT PRIMARY KEY,
+    owner        TEXT NOT NULL,
+    status       TEXT NOT NULL,
+    expires_at   REAL,
+    updated_at   REAL NOT NULL,
+    result_json  TEXT,
+    attempts     INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def network_fs(path: str) -> Optional[str]:
+    """path 在网络文件系统上时返回文件系统类型（UNC 路径 → "unc"），否则 None；读不到挂载表时按本地处理"""
+    path = os.path.realpath(path)
+    if path.startswith("\\\\") or path.startswith("//"):
+        return "unc"
+    try:
+        with open("/proc/mounts", encoding="utf-8") as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return None
+    best, fstype = "", None
+    for parts in mounts:
+        if len(parts) < 3:
+            continue
+        mnt = parts[1].replace("\\040", " ")
+        if (path == mnt or path.startswith(mnt.rstrip("/") + "/")) and len(mnt) >= len(best):
+            best, fstype = mnt, parts[2]
+    if fstype and (fstype in NETWORK_FS_TYPES or fstype.startswith("nfs")):
+        return fstype
+    return None
+
+
+def _dumps(v) -> Optional[str]:
+    if v is None:
+        return None
+    if isinstance(v, str):
+        return v
+    return json.dumps(v, ensure_ascii=False, default=str)
+
+
+def _loads(v):
+    if v is None:
+        return None
+    try:
+        return json.loads(v)
+    except (TypeError, ValueError):
+        return v
+
+
+def norm_ref(kind: str, value) -> Optional[str]:
+    if value is None:
+        return None
+    v = str(value).strip().upper()
+    if kind == "consignee":
+        v = re.sub(r"\s+", " ", v)
+    else:
+        v = re.sub(r"[\s\-]", "", v)
+    return v or None
+
+
+def _first(*vals):
+    for v in vals:
+        if v:
+            return v
+    return None
+
+
+def _iter_refs(raw: Dict[str, Any], entry_json: Optional[Dict[str, Any]]) -> Iterable[Tuple[str, str]]:
+    """从 GPT 结果 + entry JSON 中取出检索 key"""
+    raw = raw if isinstance(raw, dict) else {}
+    entry_json = entry_json or {}
+    summary = raw.get("summary") or {}
+    bol = raw.get("bill_of_lading") or {}
+
+    # 柜号按 ISO 6346 提取（"MSCU 1234567" 是一个柜号，不能按空格拆开）；不符合格式的整段保留
+    containers = summary.get("container_no") or bol.get("container_no") or bol.get("container")
+    for part in _iter_values(containers):
+        found = [m.group(1) + m.group(2) for m in CONTAINER_RE.finditer(part.upper())]
+        for c in found or [part]:
+            yield "container", c
+
+    yield "mbl", _first(entry_json.get("mbl"), bol.get("master_bl_no"), bol.get("mbl"), summary.get("bl_no"))
+    yield "hbl", _first(entry_json.get("hbl"), bol.get("house_bl_no"), bol.get("hbl"))
+    yield "consignee", _first(summary.get("consignee"), bol.get("consignee"))
+
+
+def _migrate(conn: sqlite3.Connection):
+    """给旧库补上后来加的列（CREATE TABLE IF NOT EXISTS 不会改已有的表）"""
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(leases)")}
+    if "attempts" not in cols:
+        try:
+            conn.execute("ALTER TABLE leases ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError as e:
+            # 另一个进程刚加上
+            if "duplicate column" not in str(e):
+                raise
+
+
+class ResultsStore:
+    def __init__(self, path: str = RESULTS_DB):
+        self.path = path
+        self._local = threading.local()
+        self._all_conns: List[sqlite3.Connection] = []
+        # ":memory:" 每条连接各是一个空库；换成命名的共享缓存内存库，各线程的连接看到同一份数据
+        # （第一条连接一直留在 _all_conns 里，库不会被释放）
+        self._memory = path == ":memory:"
+        if self._memory:
+            self._uri = f"file:results_{uuid.uuid4().hex}?mode=memory&cache=shared"
+        else:
+            directory = os.path.dirname(os.path.abspath(path))
+            fstype = network_fs(directory)
+            if fstype:
+                raise RuntimeError(
+                    f"RESULTS_DB={path} 在网络文件系统（{fstype}）上：SQLite WAL 只支持单机本地磁盘，"
+                    f"请指向本机路径"
+                )
+            os.makedirs(directory, exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            _migrate(conn)
+
+    # ---------------------- 连接 ---------------------- #
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一条连接（sqlite3 连接不能跨线程共享）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self._memory:
+                conn = sqlite3.connect(self._uri, uri=True, timeout=30, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+            self._all_conns.append(conn)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """关闭所有线程打开的连接（仅在进程退出时调用）"""
+        while self._all_conns:
+            try:
+                self._all_conns.pop().close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    # ---------------------- 写入 ---------------------- #
+
+    def save_shipment(
+        self,
+        message: Optional[Dict[str, Any]],
+        raw: Any,
+        entry_json: Optional[Dict[str, Any]] = None,
+        entry_xml: Optional[str] = None,
+        netchb: Any = None,
+        status: Optional[str] = None,
+    ) -> int:
+        message = message or {}
+        if status is None:
+            if isinstance(raw, dict) and raw.get("deferred"):
+                # OpenAI 熔断，稍后重新处理
+                status = "DEFERRED"
+            elif isinstance(raw, dict) and "error" in raw:
+                status = "ERROR"
+            elif isinstance(netchb, dict):
+                status = netchb.get("status") or "UNKNOWN"
+            else:
+                status = "PARSED"
+
+        conn = self._conn()
+        with conn:
+            cur = conn.execute(
+                """INSERT INTO shipments
+                   (message_id, thread_id, created_at, sender, subject, status,
+                    files_json, raw_json, entry_json, entry_xml, netchb_json)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    message.get("id"),
+                    message.get("thread_id"),
+                    int(time.time()),
+                    message.get("from"),
+                    message.get("subject"),
+                    status,
+                    _dumps(message.get("files")),
+                    _dumps(raw),
+                    _dumps(entry_json),
+                    entry_xml,
+                    _dumps(netchb),
+                ),
+            )
+            sid = cur.lastrowid
+            refs = {
+                (kind, norm_ref(kind, value))
+                for kind, value in _iter_refs(raw, entry_json)
+                if norm_ref(kind, value)
+            }
+            conn.executemany(
+                "INSERT OR IGNORE INTO shipment_refs (kind, value, shipment_id) VALUES (?, ?, ?)",
+                [(k, v, sid) for k, v in refs],
+            )
+        return sid
+
+    # ---------------------- 记账 ---------------------- #
+
+    USAGE_COLUMNS = (
+        "message_id", "customer", "day", "created_at", "model", "prompt_tokens", "cached_tokens",
+        "completion_tokens", "images", "pixels", "latency_ms", "cost_usd",
+    )
+    USAGE_GROUPS = {"message": "message_id", "customer": "customer", "day": "day", "model": "model"}
+
+    def record_usage(self, rec: Dict[str, Any]):
+        cols = self.USAGE_COLUMNS
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                f"INSERT INTO usage_calls ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                [rec.get(c) for c in cols],
+            )
+
+    def customer_spend(self, customer: str, day: str) -> float:
+        row = self._conn().execute(
+            "SELECT COALESCE(SUM(cost_usd), 0) FROM usage_calls WHERE customer = ? AND day = ?",
+            (customer, day),
+        ).fetchone()
+        return float(row[0])
+
+    def usage_summary(
+        self,
+        group_by: str = "day",
+        customer: Optional[str] = None,
+        message_id: Optional[str] = None,
+        day_from: Optional[str] = None,
+        day_to: Optional[str] = None,
+        limit: int = 100,
+    ) -> List[Dict[str, Any]]:
+        """
+        group_by: message / customer / day / model（可逗号组合，如 "customer,day"）
+        day_from / day_to: YYYY-MM-DD，含
+        """
+        groups = [g.strip() for g in group_by.split(",") if g.strip()]
+        unknown = [g for g in groups if g not in self.USAGE_GROUPS]
+        if unknown or not groups:
+            raise ValueError(f"不支持的 group_by: {group_by}")
+        keys = [self.USAGE_GROUPS[g] for g in groups]
+
+        where: List[str] = []
+        params: List[Any] = []
+        for col, val in (("customer", customer), ("message_id", message_id)):
+            if val:
+                where.append(f"{col} = ?")
+                params.append(val)
+        if day_from:
+            where.append("day >= ?")
+            params.append(day_from)
+        if day_to:
+            where.append("day <= ?")
+            params.append(day_to)
+
+        sql = (
+            f"SELECT {', '.join(keys)}, COUNT(*) AS calls, "
+            "SUM(prompt_tokens) AS prompt_tokens, SUM(cached_tokens) AS cached_tokens, "
+            "SUM(completion_tokens) AS completion_tokens, SUM(images) AS images, SUM(pixels) AS pixels, "
+            "SUM(latency_ms) AS latency_ms, ROUND(SUM(cost_usd), 6) AS cost_usd "
+            "FROM usage_calls"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + f" GROUP BY {', '.join(keys)} ORDER BY cost_usd DESC LIMIT ?"
+        )
+        return [dict(r) for r in self._conn().execute(sql, params + [max(1, min(int(limit), 1000))])]
+
+    # ---------------------- 分类样本 ---------------------- #
+
+    def add_doc_sample(self, sha: str, label: str, source: str, text: str, file_name: Optional[str] = None):
+        """同一文本再次出现时更新标签；已人工标注（manual）的不会被 gpt 标签覆盖"""
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                """INSERT INTO doc_samples (sha, label, source, file_name, text, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(sha) DO UPDATE SET label = excluded.label, source = excluded.source
+                   WHERE excluded.source = 'manual' OR doc_samples.source != 'manual'""",
+                (sha, label, source, file_name, text, int(time.time())),
+            )
+
+    def list_doc_samples(self) -> List[Dict[str, Any]]:
+        rows = self._conn().execute("SELECT sha, label, source, file_name, text FROM doc_samples ORDER BY sha")
+        return [dict(r) for r in rows]
+
+    # ---------------------- 单文档解析缓存 ---------------------- #
+
+    def get_doc_extraction(self, sha: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT result_json FROM doc_extractions WHERE sha = ?", (sha,)).fetchone()
+        return _loads(row["result_json"]) if row else None
+
+    def save_doc_extraction(self, sha: str, file_name: Optional[str], result: Dict[str, Any]):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                """INSERT OR REPLACE INTO doc_extractions (sha, file_name, result_json, created_at)
+                   VALUES (?, ?, ?, ?)""",
+                (sha, file_name, _dumps(result), int(time.time())),
+            )
+
+    # ---------------------- 版式模板 ---------------------- #
+
+    def list_layout_templates(self, signature: Optional[str] = None) -> List[Dict[str, Any]]:
+        sql = "SELECT * FROM layout_templates"
+        params: List[Any] = []
+        if signature is not None:
+            sql += " WHERE signature = ?"
+            params.append(signature)
+        out = []
+        for r in self._conn().execute(sql + " ORDER BY id", params):
+            d = dict(r)
+            for k in ("labels", "fields", "tables"):
+                d[k] = _loads(d.pop(f"{k}_json"))
+            out.append(d)
+        return out
+
+    def layout_templates_version(self, signature: str) -> Tuple[int, int, int]:
+        """(模板数, 样本数之和, 最后更新时间)：任一进程学习过该 signature 的模板，这个值就会变"""
+        row = self._conn().execute(
+            """SELECT COUNT(*), COALESCE(SUM(samples), 0), COALESCE(MAX(updated_at), 0)
+               FROM layout_templates WHERE signature = ?""",
+            (signature,),
+        ).fetchone()
+        return int(row[0]), int(row[1]), int(row[2])
+
+    def save_layout_template(self, tpl: Dict[str, Any]) -> int:
+        """tpl 没有 id → 新建；返回 id"""
+        now = int(time.time())
+        values = (
+            tpl["signature"], _dumps(tpl["labels"]), _dumps(tpl["fields"]), _dumps(tpl["tables"]),
+            tpl.get("samples", 0), tpl.get("hits", 0), tpl.get("misses", 0),
+        )
+        conn = self._conn()
+        with conn:
+            if tpl.get("id") is None:
+                cur = conn.execute(
+                    """INSERT INTO layout_templates
+                       (signature, labels_json, fields_json, tables_json, samples, hits, misses, created_at, updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    values + (now, now),
+                )
+                return cur.lastrowid
+            conn.execute(
+                """UPDATE layout_templates SET signature = ?, labels_json = ?, fields_json = ?, tables_json = ?,
+                   samples = ?, hits = ?, misses = ?, updated_at = ? WHERE id = ?""",
+                values + (now, tpl["id"]),
+            )
+            return tpl["id"]
+
+    def count_layout_use(self, template_id: int, hit: bool):
+        col = "hits" if hit else "misses"
+        conn = self._conn()
+        with conn:
+            conn.execute(f"UPDATE layout_templates SET {col} = {col} + 1 WHERE id = ?", (template_id,))
+
+    # ---------------------- 租约 ---------------------- #
+
+    def acquire_lease(self, key: str, owner: str, ttl: float) -> Dict[str, Any]:
+        """
+        原子地抢租约，返回 {"acquired": bool, "status", "owner", "result"}。
+        不存在 / running 已过期（持有者崩溃）/ done 已过期 / retry（worker 退避中，手动触发不用等）/
+        failed（worker 放弃了，手动触发照样处理）→ 抢到；否则返回当前持有状态。
+        """
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM leases WHERE key = ?", (key,)).fetchone()
+            expired = row is not None and row["expires_at"] is not None and row["expires_at"] <= now
+            if row is None or expired or row["status"] in ("retry", "failed"):
+                conn.execute(
+                    """INSERT OR REPLACE INTO leases (key, owner, status, expires_at, updated_at, result_json)
+                       VALUES (?, ?, 'running', ?, ?, NULL)""",
+                    (key, owner, now + ttl, now),
+                )
+                return {"acquired": True, "status": "running", "owner": owner, "result": None}
+        return {
+            "acquired": False,
+            "status": row["status"],
+            "owner": row["owner"],
+            "result": _loads(row["result_json"]),
+        }
+
+    def renew_lease(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            cur = conn.execute(
+                "UPDATE leases SET expires_at = ?, updated_at = ? WHERE key = ? AND owner = ? AND status = 'running'",
+                (now + ttl, now, key, owner),
+            )
+        return cur.rowcount == 1
+
+    def complete_lease(self, key: str, owner: str, result: Any, keep: Optional[float] = None):
+        """标记 done；keep 秒后过期可重新处理（None = 永久）"""
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                """UPDATE leases SET status = 'done', expires_at = ?, updated_at = ?, result_json = ?
+                   WHERE key = ? AND owner = ?""",
+                (now + keep if keep else None, now, _dumps(result), key, owner),
+            )
+
+    def backoff_lease(self, key: str, owner: str, retry_after: float,
+                      max_attempts: Optional[int] = None) -> Optional[str]:
+        """
+        释放但 retry_after 秒内不让 claim_leases 再认领（worker 处理失败 / DEFERRED 后退避）。
+        已认领 max_attempts 次的标记 failed，不再自动认领。返回新状态（retry / failed），租约已不归 owner 时 None
+        """
+        now = time.time()
+        cap = max_attempts or 0
+        conn = self._conn()
+        with conn:
+            cur = conn.execute(
+                """UPDATE leases SET
+                       status = CASE WHEN ? > 0 AND attempts >= ? THEN 'failed' ELSE 'retry' END,
+                       expires_at = CASE WHEN ? > 0 AND attempts >= ? THEN NULL ELSE ? END,
+                       updated_at = ?
+                   WHERE key = ? AND owner = ? AND status = 'running'""",
+                (cap, cap, cap, cap, now + retry_after, now, key, owner),
+            )
+            if cur.rowcount != 1:
+                return None
+            return conn.execute("SELECT status FROM leases WHERE key = ?", (key,)).fetchone()["status"]
+
+    def release_lease(self, key: str, owner: str):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM leases WHERE key = ? AND owner = ? AND status = 'running'", (key, owner))
+
+    def claim_leases(self, keys: List[str], owner: str, ttl: float, limit: int) -> List[str]:
+        """
+        一个事务里按 keys 的顺序认领最多 limit 个空闲 key（不存在 / 已过期），返回认领到的 key。
+        done 且未过期（已处理完）、running 未过期（别人在处理）、retry 未到时间（退避中）、failed 的跳过。
+        每次认领 attempts + 1（过期的 done 重新处理时从 1 开始）
+        """
+        if not keys or limit <= 0:
+            return []
+        now = time.time()
+        conn = self._conn()
+        claimed: List[str] = []
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            marks = ",".join("?" * len(keys))
+            rows = {
+                r["key"]: r
+                for r in conn.execute(
+                    f"SELECT key, status, expires_at, attempts FROM leases WHERE key IN ({marks})", keys
+                )
+            }
+            for key in keys:
+                row = rows.get(key)
+                if key in claimed or (row is not None and (row["expires_at"] is None or row["expires_at"] > now)):
+                    continue
+                attempts = 1 if row is None or row["status"] == "done" else row["attempts"] + 1
+                conn.execute(
+                    """INSERT OR REPLACE INTO leases (key, owner, status, expires_at, updated_at, result_json, attempts)
+                       VALUES (?, ?, 'running', ?, ?, NULL, ?)""",
+                    (key, owner, now + ttl, now, attempts),
+                )
+                claimed.append(key)
+                if len(claimed) >= limit:
+                    break
+        return claimed
+
+    def renew_leases(self, keys: List[str], owner: str, ttl: float) -> List[str]:
+        """批量续约，返回仍由 owner 持有的 key（其余已被别人回收）"""
+        if not keys:
+            return []
+        now = time.time()
+        marks = ",".join("?" * len(keys))
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                f"""UPDATE leases SET expires_at = ?, updated_at = ?
+                    WHERE key IN ({marks}) AND owner = ? AND status = 'running'""",
+                (now + ttl, now, *keys, owner),
+            )
+            rows = conn.execute(
+                f"SELECT key FROM leases WHERE key IN ({marks}) AND owner = ? AND status = 'running'",
+                (*keys, owner),
+            ).fetchall()
+        return [r["key"] for r in rows]
+
+    def seed_lease(self, key: str, owner: str, result: Any) -> Any:
+        """
+        第一次调用时写入一条永久 done 的租约（result 存进 result_json），之后原样返回最早写入的那份。
+        多个节点同时启动时只有一个的值生效（worker 的起始时间用这个）
+        """
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                """INSERT OR IGNORE INTO leases (key, owner, status, expires_at, updated_at, result_json)
+                   VALUES (?, ?, 'done', NULL, ?, ?)""",
+                (key, owner, now, _dumps(result)),
+            )
+            row = conn.execute("SELECT result_json FROM leases WHERE key = ?", (key,)).fetchone()
+        return _loads(row["result_json"])
+
+    def delete_lease(self, key: str) -> bool:
+        """不论状态删掉租约（人工把放弃的邮件放回队列用）"""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("DELETE FROM leases WHERE key = ?", (key,))
+        return cur.rowcount == 1
+
+    def active_leases(self, prefix: str) -> List[Dict[str, Any]]:
+        """key 以 prefix 开头、status=running 且未过期的租约"""
+        rows = self._conn().execute(
+            """SELECT key, owner, expires_at, updated_at FROM leases
+               WHERE substr(key, 1, ?) = ? AND status = 'running' AND expires_at > ? ORDER BY key""",
+            (len(prefix), prefix, time.time()),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    def get_lease(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM leases WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        d = dict(row)
+        d["result"] = _loads(d.pop("result_json"))
+        return d
+
+    # ---------------------- 查询 ---------------------- #
+
+    def get_shipment(self, shipment_id: int) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM shipments WHERE id = ?", (shipment_id,)).fetchone()
+        if row is None:
+            return None
+        d = dict(row)
+        d["files"] = _loads(d.pop("files_json"))
+        d["raw"] = _loads(d.pop("raw_json"))
+        d["entry_json"] = _loads(d["entry_json"])
+        d["netchb"] = _loads(d.pop("netchb_json"))
+        d["refs"] = [
+            {"kind": r["kind"], "value": r["value"]}
+            for r in self._conn().execute(
+                "SELECT kind, value FROM shipment_refs WHERE shipment_id = ?", (shipment_id,)
+            )
+        ]
+        return d
+
+    def latest_thread_shipment(self, thread_id: str, exclude_message: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """同一 Gmail 线程里最近一次解析成功的 shipment（跳过 ERROR / DEFERRED）"""
+        row = self._conn().execute(
+            """SELECT id FROM shipments
+               WHERE thread_id = ? AND status NOT IN ('ERROR', 'DEFERRED') AND message_id IS NOT ?
+               ORDER BY id DESC LIMIT 1""",
+            (thread_id, exclude_message),
+        ).fetchone()
+        return self.get_shipment(row["id"]) if row else None
+
+    def query_shipments(
+        self,
+        container: Optional[str] = None,
+        mbl: Optional[str] = None,
+        hbl: Optional[str] = None,
+        consignee: Optional[str] = None,
+        date_from: Optional[int] = None,
+        date_to: Optional[int] = None,
+        status: Optional[str] = None,
+        limit: int = 50,
+        cursor: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        所有条件 AND；consignee 为前缀匹配（大小写不敏感）。
+        返回 {"items": [...], "next_cursor": id 或 None}
+        """
+        limit = max(1, min(int(limit), 500))
+        where: List[str] = []
+        params: List[Any] = []
+
+        for kind, value in (("container", container), ("mbl", mbl), ("hbl", hbl)):
+            v = norm_ref(kind, value)
+            if v:
+                where.append(
+                    "s.id IN (SELECT shipment_id FROM shipment_refs WHERE kind = ? AND value = ?)"
+                )
+                params += [kind, v]
+
+        c = norm_ref("consignee", consignee)
+        if c:
+            # 前缀范围查询，走 (kind, value) 主键索引
+            where.append(
+                "s.id IN (SELECT shipment_id FROM shipment_refs "
+                "WHERE kind = 'consignee' AND value >= ? AND value < ?)"
+            )
+            params += [c, c + "\uffff"]
+
+        if date_from is not None:
+            where.append("s.created_at >= ?")
+            params.append(int(date_from))
+        if date_to is not None:
+            where.append("s.created_at < ?")
+            params.append(int(date_to))
+        if status:
+            where.append("s.status = ?")
+            params.append(status)
+        if cursor is not None:
+            where.append("s.id < ?")
+            params.append(int(cursor))
+
+        sql = (
+            "SELECT s.id, s.message_id, s.thread_id, s.created_at, s.sender, s.subject, s.status "
+            "FROM shipments s"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " ORDER BY s.id DESC LIMIT ?"
+        )
+        rows = [dict(r) for r in self._conn().execute(sql, params + [limit + 1])]
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = rows[-1]["id"]
+
+        return {"items": rows, "next_cursor": next_cursor}
+
+
+_store: Optional[ResultsStore] = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> ResultsStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ResultsStore()
+    return _store
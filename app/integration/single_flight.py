@@ -0,0 +1,207 @@
+# app/integration/single_flight.py
+"""
+同一封邮件 / 同一组附件只处理一次（single-flight）
+
+/process-emails 被定时任务和人工同时触发时，两边都会拿到同一封最新邮件，
+各自跑一遍 vision 解析、各上传一份 NET CHB 草稿、各回一封信。这里：
+
+1) 进程内：同一个 key 正在跑时，后来的调用直接等它的 Future，共享同一个结果
+2) 跨进程 / 重启：结果库 leases 表里的租约（key = gmail:<message id> / files:<发件人>:<附件哈希>）
+   - 运行中定期续约；进程崩溃后租约过期，下一个调用者接手
+   - 处理完标记 done，再来的调用直接拿已有的 shipment，不重复上传 / 回信
+   - 失败或 DEFERRED 释放租约，允许重试
+3) 围栏：处理慢到租约过期时别的进程会接手，原来的线程不能再接着上传 / 回信。
+   有副作用的步骤之前调用 ensure_leases()，本线程持有的租约（含嵌套的）任何一个已不归本进程就抛 LeaseLost
+"""
+
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from app import config
+from app.integration.results_store import get_store
+
+LEASE_TTL = config.getenv_float("SINGLE_FLIGHT_LEASE_TTL", 120)
+# 其他进程持有租约时，最多等多久（秒）拿它的结果
+SINGLE_FLIGHT_WAIT = config.getenv_float("SINGLE_FLIGHT_WAIT", 600)
+POLL_INTERVAL = 1.0
+HASH_CHUNK = 1024 * 1024
+
+# 本进程的租约持有者标识
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+# 当前线程正在 run_claimed 里执行的租约 key（外层 gmail:<id>，内层 files:...）
+_held: ContextVar[Tuple[str, ...]] = ContextVar("single_flight_held", default=())
+
+
+class LeaseLost(RuntimeError):
+    """处理途中租约已被回收（别的进程可能已接手），不能再做有副作用的步骤"""
+
+
+def ensure_leases(stage: str):
+    """
+    上传 / 回信之前调用：确认本线程持有的租约都还归本进程（顺带续约），否则抛 LeaseLost。
+    不在 run_claimed 里（没有租约的直接调用）时什么都不做
+    """
+    keys = list(_held.get())
+    if not keys:
+        return
+    alive = set(get_store().renew_leases(keys, OWNER_ID, LEASE_TTL))
+    lost = [k for k in keys if k not in alive]
+    if lost:
+        print(f"⚠ [SingleFlight] {stage} 前发现租约已丢失，放弃: {lost}")
+        raise LeaseLost(f"{stage} 前租约已丢失: {', '.join(lost)}")
+
+
+def file_sha(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def files_digest(paths: Iterable[str]) -> str:
+    """附件内容哈希（与文件名 / 顺序无关）"""
+    digests = [file_sha(p) for p in paths]
+    return hashlib.sha256("\n".join(sorted(digests)).encode()).hexdigest()
+
+
+def _summary(result: Any) -> Dict[str, Any]:
+    """写进租约的结果摘要（完整结果在 shipments 表里）"""
+    if not isinstance(result, dict):
+        return {"status": "ok"}
+    return {k: result.get(k) for k in ("status", "shipment_id") if k in result}
+
+
+def _from_lease(key: str, lease: Dict[str, Any]) -> Dict[str, Any]:
+    """其他调用者已处理完：从结果库取回 shipment"""
+    summary = lease.get("result") or {}
+    out = {**summary, "coalesced": True, "lease": key}
+    sid = summary.get("shipment_id")
+    if sid is not None:
+        shipment = get_store().get_shipment(sid)
+        if shipment is not None:
+            out["result"] = shipment.get("raw")
+    return out
+
+
+def _heartbeat(key: str, stop: threading.Event):
+    store = get_store()
+    while not stop.wait(LEASE_TTL / 3):
+        try:
+            if not store.renew_lease(key, OWNER_ID, LEASE_TTL):
+                print(f"⚠ [SingleFlight] 租约已丢失: {key}")
+                return
+        except Exception as e:
+            print(f"⚠ [SingleFlight] 续约失败 {key}: {e}")
+
+
+def _wait_for_other(key: str, owner: str) -> Optional[Dict[str, Any]]:
+    """另一个进程持有租约：轮询到 done / 租约消失 / 超时"""
+    deadline = time.monotonic() + SINGLE_FLIGHT_WAIT
+    store = get_store()
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        lease = store.get_lease(key)
+        if lease is None or (lease["status"] == "running" and lease["expires_at"] <= time.time()):
+            return None
+        if lease["status"] == "done":
+            return _from_lease(key, lease)
+    return {"status": "in_progress", "coalesced": True, "lease": key, "owner": owner}
+
+
+def _run_with_lease(key: str, fn: Callable[[], Any], keep: Optional[float]) -> Any:
+    store = get_store()
+    while True:
+        lease = store.acquire_lease(key, OWNER_ID, LEASE_TTL)
+        if lease["acquired"]:
+            break
+        if lease["status"] == "done":
+            print(f"[SingleFlight] {key} 已处理过，复用结果")
+            return _from_lease(key, lease)
+        print(f"[SingleFlight] {key} 正在由 {lease['owner']} 处理，等待结果")
+        waited = _wait_for_other(key, lease["owner"])
+        if waited is not None:
+            return waited
+        # 持有者崩溃 / 放弃 → 重新抢
+
+    return run_claimed(key, fn, keep)
+
+
+def _release(key: str, retry_after: Optional[float], max_attempts: Optional[int]):
+    if retry_after:
+        get_store().backoff_lease(key, OWNER_ID, retry_after, max_attempts)
+    else:
+        get_store().release_lease(key, OWNER_ID)
+
+
+def run_claimed(key: str, fn: Callable[[], Any], keep: Optional[float] = None, heartbeat: bool = True,
+                retry_after: Optional[float] = None, max_attempts: Optional[int] = None) -> Any:
+    """
+    已持有 key 的租约时执行 fn：成功 → done（保留 keep 秒），失败 / DEFERRED → 释放租约允许重试
+    heartbeat=False：调用方自己续约（例如 worker 统一续约它认领的所有租约）
+    retry_after：失败后不直接释放，retry_after 秒内不再被 worker 认领（避免立刻重试同一封）
+    max_attempts：和 retry_after 一起用，认领满这么多次还失败就标记 failed，不再自动重试
+    fn 里可以调用 ensure_leases() 检查租约是否还在
+    """
+    store = get_store()
+    stop = threading.Event()
+    if heartbeat:
+        threading.Thread(target=_heartbeat, args=(key, stop), daemon=True).start()
+    token = _held.set(_held.get() + (key,))
+    try:
+        result = fn()
+    except BaseException:
+        stop.set()
+        _release(key, retry_after, max_attempts)
+        raise
+    finally:
+        _held.reset(token)
+    stop.set()
+
+    status = result.get("status") if isinstance(result, dict) else None
+    if status in ("deferred", "ERROR", "no email"):
+        _release(key, retry_after, max_attempts)
+    else:
+        store.complete_lease(key, OWNER_ID, _summary(result), keep)
+    return result
+
+
+def single_flight(key: str, fn: Callable[[], Any], keep: Optional[float] = None) -> Any:
+    """
+    key 相同的调用只真正执行一次 fn：
+    - 本进程内并发调用共享同一个 Future
+    - 跨进程 / 重启由结果库租约保证；done 的结果保留 keep 秒（None = 永久）
+    共享结果的调用方拿到的 dict 带 "coalesced": True
+    """
+    with _inflight_lock:
+        fut = _inflight.get(key)
+        owner = fut is None
+        if owner:
+            fut = Future()
+            _inflight[key] = fut
+
+    if not owner:
+        print(f"[SingleFlight] {key} 本进程正在处理，共享结果")
+        result = fut.result()
+        return {**result, "coalesced": True} if isinstance(result, dict) else result
+
+    try:
+        result = _run_with_lease(key, fn, keep)
+        fut.set_result(result)
+        return result
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
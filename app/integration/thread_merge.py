@@ -0,0 +1,270 @@
+# app/integration/thread_merge.py
+"""
+按 Gmail 线程增量重解析
+
+客户经常在同一个线程里只回一份更正后的发票。以前要么整套附件从头再解析，要么只看最新一封，
+前一封里的提单就丢了。这里按 thread_id 把同一票货串起来：
+
+1) 找到线程里上一次解析成功的 shipment（它的结果已经覆盖了当时的全部附件），
+   以及当时每个附件的内容哈希（result["thread"]["files"]；线程第一封按普通模式处理时按保存的附件路径重算）
+2) 本封附件按内容哈希比对：没变的直接沿用上次结果；新增 / 改过的逐个解析，
+   单文档结果按 sha 缓存在 doc_extractions 表，同一文件再次出现不再调用模型
+3) 新文档结果按顺序合并进上次结果：各段落里非空的标量覆盖；items 每行记下来源文件（source_file）
+   和单据号（source_doc），新文档只替换同名文件或同一单据号的行，其他发票的行保留；
+   分不清该替换哪些行时追加，并在 thread.warnings 里提示
+4) 合并结果重新跑一遍数字对账（reconcile），新发票和旧装箱单之间的交叉校验照常生效
+5) 合并结果照常走 entry 映射 / 上传；回信里带上 summary 等字段和 entry JSON 的变更列表
+6) 本封没有需要重新解析的附件（原样转发 / 只回了文字）：上次的 shipment 已经上传过、回过信，
+   返回 {"unchanged": True, ...}，调用方直接结束，不重复上传草稿、不重复回信
+"""
+
+import copy
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from app import config
+from app.integration.progress import Progress, emit
+from app.integration.results_store import get_store
+from app.integration.single_flight import file_sha
+
+THREAD_INCREMENTAL_ENABLED = config.getenv_bool("THREAD_INCREMENTAL_ENABLED", True)
+# 回信里最多列出的变更条数
+THREAD_MAX_CHANGES = config.getenv_int("THREAD_MAX_CHANGES", 50)
+
+SECTIONS = ("summary", "bill_of_lading", "commercial_invoice", "packing_list", "arrival_notice")
+# 每行的来源标记；对比变更时忽略
+ROW_FILE = "source_file"
+ROW_DOC = "source_doc"
+# 段落级单据号：同一单据号的新文档替换旧行
+DOC_NO_KEYS = ("invoice_no", "packing_list_no", "doc_no")
+
+
+def _ok(result: Any) -> bool:
+    return isinstance(result, dict) and "error" not in result
+
+
+def _empty(v) -> bool:
+    return v is None or v == "" or v == [] or v == {}
+
+
+# ---------------------- 哈希 ---------------------- #
+
+def _hashes(paths: List[str]) -> Dict[str, str]:
+    """文件名 → 内容哈希；文件已不在磁盘上的跳过"""
+    out = {}
+    for p in paths or []:
+        try:
+            out[os.path.basename(p)] = file_sha(p)
+        except OSError:
+            pass
+    return out
+
+
+def _base_files(shipment: Dict[str, Any]) -> Dict[str, str]:
+    raw = shipment.get("raw")
+    files = raw.get("thread", {}).get("files") if isinstance(raw, dict) else None
+    return dict(files) if files else _hashes(shipment.get("files"))
+
+
+def remember_files(result: Any, msg: Dict[str, Any]):
+    """普通模式解析的结果也记下附件哈希，线程里下一封就能按文件比对"""
+    if _ok(result) and msg.get("thread_id") and "thread" not in result:
+        result["thread"] = {"thread_id": msg["thread_id"], "files": _hashes(msg.get("files"))}
+
+
+# ---------------------- 合并 / 对比 ---------------------- #
+
+def _doc_no(section: Dict[str, Any]) -> Optional[str]:
+    for k in DOC_NO_KEYS:
+        v = section.get(k)
+        if not _empty(v):
+            return str(v).strip().upper()
+    return None
+
+
+def _merge_rows(old_sec: Dict[str, Any], new_sec: Dict[str, Any], key: str, file_name: Optional[str],
+                warnings: List[str], path: str) -> List[Any]:
+    """
+    old 里来自同一文件 / 同一单据号的行换成 new 的行，其余保留。
+    旧结果是整套附件一起解析的（行上没有来源标记）时，按段落单据号匹配；匹配不上就追加并提示
+    """
+    old_no, new_no = _doc_no(old_sec), _doc_no(new_sec)
+    new_rows = [
+        {**copy.deepcopy(r), ROW_FILE: file_name, ROW_DOC: new_no} if isinstance(r, dict) else r
+        for r in new_sec[key]
+    ]
+    kept, replaced, untagged = [], 0, 0
+    for r in old_sec.get(key) or []:
+        if not isinstance(r, dict):
+            kept.append(r)
+            continue
+        src = r.get(ROW_FILE)
+        doc = r.get(ROW_DOC) or (old_no if src is None else None)
+        if (file_name and src == file_name) or (new_no and doc == new_no):
+            replaced += 1
+            continue
+        if src is None:
+            untagged += 1
+        kept.append(r if src is not None or doc is None else {**r, ROW_DOC: doc})
+    if kept and untagged and not replaced:
+        warnings.append(
+            f"{path}: {file_name or '新文档'} 的 {len(new_rows)} 行已追加，"
+            f"无法确定是否替换原有 {untagged} 行（缺少单据号），请人工核对"
+        )
+    return kept + new_rows
+
+
+def merge_results(base: Dict[str, Any], update: Dict[str, Any], file_name: Optional[str] = None,
+                  warnings: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    update（file_name 这一份附件的解析结果）合并进 base：
+    各段落的非空标量覆盖；行列表只替换同一文件 / 同一单据号的行（见 _merge_rows）
+    """
+    warnings = [] if warnings is None else warnings
+    merged = copy.deepcopy(base)
+    for sec in SECTIONS:
+        new = update.get(sec)
+        if not isinstance(new, dict):
+            continue
+        if not isinstance(merged.get(sec), dict):
+            merged[sec] = {}
+        old = dict(merged[sec])
+        for k, v in new.items():
+            if _empty(v):
+                continue
+            if isinstance(v, list) and all(isinstance(r, dict) for r in v):
+                merged[sec][k] = _merge_rows(old, new, k, file_name, warnings, f"{sec}.{k}")
+            else:
+                merged[sec][k] = copy.deepcopy(v)
+    return merged
+
+
+def _untagged(v: Any) -> Any:
+    if isinstance(v, dict):
+        return {k: _untagged(x) for k, x in v.items() if k not in (ROW_FILE, ROW_DOC)}
+    if isinstance(v, list):
+        return [_untagged(x) for x in v]
+    return v
+
+
+def diff(old: Any, new: Any, path: str = "") -> List[Dict[str, Any]]:
+    """[{"path": "commercial_invoice.items[0].amount", "old": ..., "new": ...}]"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        out = []
+        for k in list(old) + [k for k in new if k not in old]:
+            out += diff(old.get(k), new.get(k), f"{path}.{k}" if path else str(k))
+        return out
+    if isinstance(old, list) and isinstance(new, list):
+        out = []
+        for i in range(max(len(old), len(new))):
+            out += diff(old[i] if i < len(old) else None, new[i] if i < len(new) else None, f"{path}[{i}]")
+        return out
+    if old == new or (_empty(old) and _empty(new)):
+        return []
+    return [{"path": path, "old": old, "new": new}]
+
+
+def format_changes(changes: List[Dict[str, Any]]) -> str:
+    lines = [f"- {c['path']}: {c['old']!r} → {c['new']!r}" for c in changes[:THREAD_MAX_CHANGES]]
+    if len(changes) > THREAD_MAX_CHANGES:
+        lines.append(f"- ……另有 {len(changes) - THREAD_MAX_CHANGES} 处")
+    return "\n".join(lines)
+
+
+# ---------------------- 增量解析 ---------------------- #
+
+def _extract_document(path: str, sha: str, progress: Progress) -> Tuple[Dict[str, Any], bool]:
+    """单个附件的解析结果，返回 (结果, 是否命中缓存)"""
+    from app.integration.analyze_vision import analyze_with_vision
+
+    store = get_store()
+    cached = store.get_doc_extraction(sha)
+    if cached is not None:
+        return cached, True
+    result = analyze_with_vision([path], progress)
+    if _ok(result):
+        store.save_doc_extraction(sha, os.path.basename(path), result)
+    return result, False
+
+
+def _reconcile(merged: Dict[str, Any], msg: Dict[str, Any], base: Dict[str, Any]) -> Dict[str, Any]:
+    """合并后重新对账；追问用的文本块来自本封附件 + 上次还在磁盘上的附件"""
+    from app.integration.analyze_vision import build_file_payloads
+    from app.integration.reconciliation import reconcile
+
+    paths = list(msg.get("files") or [])
+    names = {os.path.basename(p) for p in paths}
+    for p in base.get("files") or []:
+        if os.path.basename(p) not in names and os.path.exists(p):
+            paths.append(p)
+    try:
+        payload = build_file_payloads(paths)
+    except Exception as e:
+        print(f"⚠ [Thread] 对账文本读取失败，只做校验不追问: {e}")
+        payload = {"text_chunks": [], "images": []}
+    return reconcile(merged, payload)
+
+
+def analyze_incremental(msg: Dict[str, Any], progress: Progress = None) -> Optional[Dict[str, Any]]:
+    """
+    线程里已有解析成功的 shipment 时做增量解析，返回合并后的结果；
+    没有 thread_id / 线程里是第一封 / 未开启时返回 None，调用方走普通的整套解析
+    结果里 "thread" = {thread_id, base_shipment_id, files, reused, extracted, changes}
+    没有附件需要重新解析时返回 {"unchanged": True, "base_shipment_id", "reused"}（见模块说明第 6 条）
+    """
+    thread_id = msg.get("thread_id")
+    if not THREAD_INCREMENTAL_ENABLED or not thread_id:
+        return None
+    base = get_store().latest_thread_shipment(thread_id, exclude_message=msg.get("id"))
+    if base is None or not _ok(base.get("raw")):
+        return None
+
+    files = _base_files(base)
+    merged = base["raw"]
+    reused, extracted, warnings = [], [], []
+    for path in msg.get("files") or []:
+        name = os.path.basename(path)
+        sha = file_sha(path)
+        if sha in files.values():
+            reused.append(name)
+            continue
+        result, cached = _extract_document(path, sha, progress)
+        if not _ok(result):
+            # 某个新附件解析失败（含熔断 deferred）：整封按失败处理，不拿半套结果覆盖上次的
+            return result
+        merged = merge_results(merged, result, name, warnings)
+        files[name] = sha
+        extracted.append({"file": name, "cached": cached})
+
+    if not extracted:
+        emit(progress, "thread_merge", base_shipment_id=base["id"], reused=reused, extracted=[], changes=0)
+        print(f"[Thread] {thread_id}: 附件都解析过（沿用 {len(reused)} 个），沿用 shipment #{base['id']}，不重复上传 / 回信")
+        return {"unchanged": True, "base_shipment_id": base["id"], "reused": reused}
+
+    merged = _reconcile(merged, msg, base)
+    changes = diff(
+        _untagged({s: base["raw"].get(s) for s in SECTIONS}),
+        _untagged({s: merged.get(s) for s in SECTIONS}),
+    )
+    merged["thread"] = {
+        "thread_id": thread_id,
+        "base_shipment_id": base["id"],
+        "files": files,
+        "reused": reused,
+        "extracted": extracted,
+        "changes": changes,
+        "warnings": warnings,
+    }
+    emit(progress, "thread_merge", base_shipment_id=base["id"], reused=reused,
+         extracted=[e["file"] for e in extracted], changes=len(changes))
+    print(f"[Thread] {thread_id}: 沿用 {len(reused)} 个附件，重新解析 {len(extracted)} 个，变更 {len(changes)} 处")
+    return merged
+
+
+def entry_changes(result: Any, entry_json: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """增量结果：新 entry JSON 相对线程上一次 shipment 的变更"""
+    base_id = result.get("thread", {}).get("base_shipment_id") if isinstance(result, dict) else None
+    if base_id is None or entry_json is None:
+        return []
+    base = get_store().get_shipment(base_id)
+    return diff((base or {}).get("entry_json") or {}, entry_json)
@@ -0,0 +1,391 @@
+# app/integration/worker.py
+"""
+多节点 worker：按租约认领 Gmail 邮件
+
+以前每个实例都去拿"最新一封"，多部署几台只会重复处理同一封。这里每个节点：
+
+1) 列出还没处理的邮件：WORKER_QUERY + after:<起始时间> + 排除 WORKER_DONE_LABEL / WORKER_FAILED_LABEL 标签，
+   自动翻页，最多 WORKER_SCAN 封。处理完的邮件打上标签后不再出现在列表里，
+   积压再多也能一页页往后处理到，不会只盯着最新的几十封
+   - 起始时间：WORKER_SINCE（YYYY-MM-DD 或 epoch 秒）显式配置时从那里开始补处理；
+     否则取第一个节点第一次启动的时间（记在 leases 表 worker:cutover），上线时不会回头处理历史邮件
+2) 在结果库 leases 表里一个事务认领空闲的 gmail:<message id>（最多填满 WORKER_CONCURRENCY 个槽）
+   - done（已处理）和别人 running 未过期的跳过 → 各节点处理的邮件互不相交
+   - 节点崩溃后租约过期，其他节点下一轮扫描时回收
+3) 一个心跳线程统一续约本节点持有的所有租约，外加 node:<owner> 租约（/metrics/workers 看到存活节点）；
+   处理中租约丢了（卡太久被别人回收）时，上传 NET CHB / 回信之前的 ensure_leases() 会中止这次处理
+4) 处理完标记 done（永久）并打 WORKER_DONE_LABEL；失败 / DEFERRED 退避 WORKER_RETRY_BACKOFF 秒后任何节点都可以重试，
+   认领满 WORKER_MAX_ATTEMPTS 次仍失败 → failed，打 WORKER_FAILED_LABEL，不再自动重试
+   （修好后 `python -m app.integration.worker requeue <message id>` 放回队列）；
+   --once 同一轮里不重复处理同一封
+5) 认领顺序按 priority.py 的打分（LFD / ETA / SLA 等级 / 单据类型 + 老化），不再按到达顺序
+
+节点 = 同一台机器上的多个 worker 进程，共用本机磁盘上的同一个 RESULTS_DB。
+SQLite WAL 不能放在网络文件系统上给多台机器共用（ResultsStore 检测到会拒绝启动）；
+要跨机器扩展得先把 ResultsStore 换成服务端数据库（认领只用到标准 SQL：事务 + INSERT OR REPLACE / UPDATE ... WHERE owner）。
+
+命令行：
+    python -m app.integration.worker run [--concurrency 4] [--once]
+    python -m app.integration.worker requeue <message id> [...]                       # 放弃的邮件放回队列
+    python -m app.integration.worker simulate --nodes 4 --messages 400 --work-ms 50   # 本地替身，多进程模拟多节点
+"""
+
+import argparse
+import calendar
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from app import config
+from app.integration.priority import PRIORITY_ENABLED, PriorityScheduler
+from app.integration.results_store import get_store
+from app.integration.single_flight import LEASE_TTL, OWNER_ID, run_claimed
+
+WORKER_ENABLED = config.getenv_bool("WORKER_ENABLED", False)
+WORKER_QUERY = config.getenv("WORKER_QUERY", "has:attachment")
+# 每轮最多列出的未处理邮件数（自动翻页）
+WORKER_SCAN = config.getenv_int("WORKER_SCAN", 500)
+# 只处理这之后收到的邮件：YYYY-MM-DD 或 epoch 秒；空 = 第一个节点第一次启动的时间
+WORKER_SINCE = config.getenv("WORKER_SINCE", "")
+WORKER_DONE_LABEL = config.getenv("WORKER_DONE_LABEL", "customs-processed")
+WORKER_FAILED_LABEL = config.getenv("WORKER_FAILED_LABEL", "customs-failed")
+# 同一封邮件最多认领几次（失败 / DEFERRED 都算），用完标记 failed
+WORKER_MAX_ATTEMPTS = config.getenv_int("WORKER_MAX_ATTEMPTS", 10)
+WORKER_CONCURRENCY = config.getenv_int("WORKER_CONCURRENCY", 2)
+# 没认领到新邮件时的轮询间隔（秒）
+WORKER_POLL_INTERVAL = config.getenv_float("WORKER_POLL_INTERVAL", 15)
+# 失败 / DEFERRED / 读不到的邮件多久后再认领（秒）：不然下一轮扫描立刻重新下载、重新存一条 DEFERRED
+WORKER_RETRY_BACKOFF = config.getenv_float("WORKER_RETRY_BACKOFF", 300)
+
+NODE_KEY = f"node:{OWNER_ID}"
+CUTOVER_KEY = "worker:cutover"
+
+_since: Optional[int] = None
+
+
+def _parse_since(value: str) -> Optional[int]:
+    value = (value or "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    return calendar.timegm(time.strptime(value, "%Y-%m-%d"))
+
+
+def worker_since() -> int:
+    """只处理这个时间（epoch 秒）之后收到的邮件，见模块说明"""
+    global _since
+    if _since is None:
+        since = _parse_since(WORKER_SINCE)
+        if since is None:
+            since = int(get_store().seed_lease(CUTOVER_KEY, OWNER_ID, {"since": int(time.time())})["since"])
+        _since = since
+    return _since
+
+
+def _gmail_ids() -> List[str]:
+    from app.integration.gmail_reader import list_message_ids
+    query = f"{WORKER_QUERY} after:{worker_since()} -label:{WORKER_DONE_LABEL} -label:{WORKER_FAILED_LABEL}"
+    return list_message_ids(query, max_results=WORKER_SCAN)
+
+
+def _gmail_mark(msg_id: str, outcome: str):
+    from app.integration.gmail_reader import set_label
+    set_label(msg_id, WORKER_DONE_LABEL if outcome == "done" else WORKER_FAILED_LABEL)
+
+
+def _gmail_meta(msg_id: str) -> Dict[str, Any]:
+    from app.integration.gmail_reader import fetch_message_meta
+    return fetch_message_meta(msg_id)
+
+
+def _process_gmail(msg_id: str) -> Any:
+    from app.integration.gmail_auto_reply import process_message_id
+    from app.integration.gmail_reader import ATTACH_DIR
+    return process_message_id(msg_id, attach_dir=os.path.join(ATTACH_DIR, msg_id))
+
+
+class Worker:
+    """
+    list_ids() → 候选 message id（未处理的，新的在前）；process(message id) → 结果 dict；
+    describe(message id) → 邮件头 / 摘要，用来排优先级（None：只按等待时间排）
+    mark(message id, "done" / "failed") → 处理完 / 放弃后打标记，让 list_ids 不再列出（None：不打）
+    默认是 Gmail + process_message_id，simulate 用本地替身
+    """
+
+    def __init__(self, list_ids: Callable[[], List[str]] = _gmail_ids,
+                 process: Callable[[str], Any] = _process_gmail,
+                 concurrency: int = WORKER_CONCURRENCY, poll_interval: float = WORKER_POLL_INTERVAL,
+                 describe: Optional[Callable[[str], Dict[str, Any]]] = _gmail_meta,
+                 mark: Optional[Callable[[str, str], Any]] = _gmail_mark):
+        self.list_ids = list_ids
+        self.process = process
+        self.mark = mark
+        self.scheduler = PriorityScheduler(describe if PRIORITY_ENABLED else None)
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.store = get_store()
+        self.held: Dict[str, float] = {}
+        # 本次 run 已尝试过的 key（once 模式不再认领）
+        self.attempted: Set[str] = set()
+        self._held_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._once = False
+        self.stats = {"claimed": 0, "processed": 0, "failed": 0, "released": 0, "gave_up": 0,
+                      "lost": 0, "scans": 0}
+
+    # ---------------------- 心跳 ---------------------- #
+
+    def _heartbeat(self):
+        while not self._stop.wait(LEASE_TTL / 3):
+            with self._held_lock:
+                keys = list(self.held)
+            try:
+                alive = set(self.store.renew_leases(keys + [NODE_KEY], OWNER_ID, LEASE_TTL))
+            except Exception as e:
+                print(f"⚠ [Worker] 续约失败: {e}")
+                continue
+            if NODE_KEY not in alive:
+                self.store.acquire_lease(NODE_KEY, OWNER_ID, LEASE_TTL)
+            lost = [k for k in keys if k not in alive]
+            if lost:
+                self.stats["lost"] += len(lost)
+                print(f"⚠ [Worker] 租约已被回收（处理超时？）: {lost}")
+
+    # ---------------------- 认领 / 处理 ---------------------- #
+
+    def _claim(self, n: int) -> List[str]:
+        self.stats["scans"] += 1
+        try:
+            ids = self.list_ids()
+        except Exception as e:
+            print(f"❌ [Worker] 读取邮件列表失败: {e}")
+            return []
+        ids = self.scheduler.order(ids)
+        keys = [f"gmail:{i}" for i in ids]
+        if self._once:
+            keys = [k for k in keys if k not in self.attempted]
+        keys = self.store.claim_leases(keys, OWNER_ID, LEASE_TTL, n)
+        if self._once:
+            self.attempted.update(keys)
+        with self._held_lock:
+            for k in keys:
+                self.held[k] = time.time()
+        self.stats["claimed"] += len(keys)
+        return keys
+
+    def _mark(self, msg_id: str, outcome: str):
+        if self.mark is None:
+            return
+        try:
+            self.mark(msg_id, outcome)
+        except Exception as e:
+            # 租约状态才是准的，标记失败只是下一轮还会列出来（认领时跳过）
+            print(f"⚠ [Worker] 标记 {msg_id} {outcome} 失败: {e}")
+
+    def _after_release(self, key: str, msg_id: str):
+        """失败释放后：重试次数已用完（租约变成 failed）的打上放弃标记"""
+        lease = self.store.get_lease(key)
+        if lease is not None and lease["status"] == "failed" and lease["owner"] == OWNER_ID:
+            self.stats["gave_up"] += 1
+            print(f"❌ [Worker] {key} 已尝试 {lease['attempts']} 次仍失败，不再自动重试")
+            self._mark(msg_id, "failed")
+
+    def _run(self, key: str) -> Any:
+        msg_id = key.split(":", 1)[1]
+        self.scheduler.started(msg_id)
+        try:
+            result = run_claimed(key, lambda: self.process(msg_id), heartbeat=False,
+                                 retry_after=WORKER_RETRY_BACKOFF, max_attempts=WORKER_MAX_ATTEMPTS)
+        except Exception as e:
+            self.stats["failed"] += 1
+            print(f"❌ [Worker] {key} 处理失败，已释放租约: {e}")
+            self._after_release(key, msg_id)
+            return None
+        finally:
+            with self._held_lock:
+                self.held.pop(key, None)
+        status = result.get("status") if isinstance(result, dict) else None
+        if status in ("deferred", "ERROR", "no email"):
+            self.stats["released"] += 1
+            self._after_release(key, msg_id)
+        else:
+            self.stats["processed"] += 1
+            self.scheduler.finished(msg_id)
+            self._mark(msg_id, "done")
+        return result
+
+    def run(self, once: bool = False):
+        """once=True：处理完当前所有能认领的邮件就返回（定时任务 / 测试用），每封最多尝试一次"""
+        self._once = once
+        self.store.acquire_lease(NODE_KEY, OWNER_ID, LEASE_TTL)
+        hb = threading.Thread(target=self._heartbeat, name="worker-heartbeat", daemon=True)
+        hb.start()
+        print(f"[Worker] {OWNER_ID} 启动，并发 {self.concurrency}")
+        running = set()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="worker") as pool:
+                while not self._stop.is_set():
+                    free = self.concurrency - len(running)
+                    keys = self._claim(free) if free > 0 else []
+                    running.update(pool.submit(self._run, k) for k in keys)
+                    if not running:
+                        if once:
+                            break
+                        self._stop.wait(self.poll_interval)
+                        continue
+                    # 有槽位空出来就再认领
+                    _, running = wait(running, return_when=FIRST_COMPLETED)
+        finally:
+            self._stop.set()
+            self.store.release_lease(NODE_KEY, OWNER_ID)
+            print(f"[Worker] {OWNER_ID} 停止: {self.stats}")
+
+    def stop(self):
+        self._stop.set()
+
+
+# ---------------------- 应用内后台 worker（WORKER_ENABLED=1） ---------------------- #
+
+_worker: Optional[Worker] = None
+_thread: Optional[threading.Thread] = None
+
+
+def start_background_worker():
+    global _worker, _thread
+    if _worker is not None:
+        return
+    _worker = Worker()
+    _thread = threading.Thread(target=_worker.run, name="gmail-worker", daemon=True)
+    _thread.start()
+
+
+def stop_background_worker(timeout: float = 30):
+    global _worker, _thread
+    if _worker is None:
+        return
+    _worker.stop()
+    _thread.join(timeout)
+    _worker = _thread = None
+
+
+def requeue(msg_id: str) -> bool:
+    """把放弃（failed）的邮件放回队列：删掉租约、去掉放弃标记，下一轮扫描重新认领"""
+    removed = get_store().delete_lease(f"gmail:{msg_id}")
+    from app.integration.gmail_reader import set_label
+    set_label(msg_id, WORKER_FAILED_LABEL, add=False)
+    return removed
+
+
+def get_worker_metrics() -> Dict[str, Any]:
+    """存活节点、每个节点正在处理的邮件数，以及本进程 worker 的计数"""
+    store = get_store()
+    nodes = store.active_leases("node:")
+    running: Dict[str, int] = {}
+    for lease in store.active_leases("gmail:"):
+        running[lease["owner"]] = running.get(lease["owner"], 0) + 1
+    return {
+        "owner": OWNER_ID,
+        "since": _since,
+        "nodes": [
+            {"owner": n["owner"], "running": running.get(n["owner"], 0), "heartbeat_at": n["updated_at"]}
+            for n in nodes
+        ],
+        "orphaned": {o: c for o, c in running.items() if o not in {n["owner"] for n in nodes}},
+        "local": dict(_worker.stats) if _worker is not None else None,
+        "priority": _worker.scheduler.snapshot() if _worker is not None else None,
+    }
+
+
+# ---------------------- 本地替身：多进程模拟多节点 ---------------------- #
+
+def _simulate_node(out_path: str, messages: int, work_ms: int, concurrency: int):
+    # 子进程：RESULTS_DB 已在环境变量里指向共享的临时库，OWNER_ID 各不相同
+    processed: List[str] = []
+    lock = threading.Lock()
+
+    def process(msg_id: str):
+        time.sleep(work_ms / 1000.0)
+        with lock:
+            processed.append(msg_id)
+        return {"status": "ok"}
+
+    ids = [f"sim-{i:05d}" for i in range(messages)]
+    Worker(lambda: ids, process, concurrency=concurrency, poll_interval=0, describe=None, mark=None).run(once=True)
+    with open(out_path, "w") as f:
+        json.dump({"owner": OWNER_ID, "processed": processed}, f)
+
+
+def simulate(nodes: int, messages: int, work_ms: int, concurrency: int) -> Dict[str, Any]:
+    import multiprocessing as mp
+
+    tmp = tempfile.mkdtemp(prefix="worker_sim_")
+    db = os.path.join(tmp, "results.db")
+    os.environ["RESULTS_DB"] = db
+    ctx = mp.get_context("spawn")
+    t0 = time.perf_counter()
+    procs = []
+    for n in range(nodes):
+        p = ctx.Process(target=_simulate_node, args=(os.path.join(tmp, f"node{n}.json"), messages, work_ms, concurrency))
+        p.start()
+        procs.append(p)
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - t0
+
+    per_node = {}
+    seen: Dict[str, int] = {}
+    for n in range(nodes):
+        with open(os.path.join(tmp, f"node{n}.json")) as f:
+            data = json.load(f)
+        per_node[data["owner"]] = len(data["processed"])
+        for m in data["processed"]:
+            seen[m] = seen.get(m, 0) + 1
+    return {
+        "nodes": nodes,
+        "messages": messages,
+        "processed": len(seen),
+        "duplicates": sum(c - 1 for c in seen.values()),
+        "per_node": per_node,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_s": round(len(seen) / elapsed, 1) if elapsed else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="多节点 Gmail worker（租约认领）")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_run = sub.add_parser("run", help="认领并处理邮件")
+    p_run.add_argument("--concurrency", type=int, default=WORKER_CONCURRENCY)
+    p_run.add_argument("--once", action="store_true", help="只跑一轮")
+
+    p_rq = sub.add_parser("requeue", help="把重试次数用完（failed）的邮件放回队列")
+    p_rq.add_argument("message_ids", nargs="+")
+
+    p_sim = sub.add_parser("simulate", help="本地替身：多进程共享一个临时库，检查是否有重复处理")
+    p_sim.add_argument("--nodes", type=int, default=4)
+    p_sim.add_argument("--messages", type=int, default=400)
+    p_sim.add_argument("--work-ms", type=int, default=50)
+    p_sim.add_argument("--concurrency", type=int, default=2)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "run":
+        worker = Worker(concurrency=args.concurrency)
+        try:
+            worker.run(once=args.once)
+        except KeyboardInterrupt:
+            worker.stop()
+    elif args.cmd == "requeue":
+        for msg_id in args.message_ids:
+            print(msg_id, "已放回队列" if requeue(msg_id) else "没有租约记录（已去掉放弃标记）")
+    else:
+        print(json.dumps(simulate(args.nodes, args.messages, args.work_ms, args.concurrency), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# app/lifecycle.py
+"""
+启动预热 / 就绪探针 / 优雅关闭
+
+部署后第一个请求要付的冷启动成本：
+  OpenAI client、Gmail 凭证（读 token / 刷新）、NET CHB WSDL、PyMuPDF / pandas 首次 import。
+这里在 FastAPI lifespan 里并行预热，/ready 报告每个依赖的状态，关闭时统一释放。
+"""
+
+import asyncio
+import inspect
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app import config
+
+# 预热超时（秒），超时的依赖标记为 error，但不阻塞启动
+WARMUP_TIMEOUT = config.getenv_float("WARMUP_TIMEOUT", 60)
+# /ready 必须全部 ok 的依赖（逗号分隔）；其余只报告状态
+READY_REQUIRED = [
+    x.strip() for x in config.getenv("READY_REQUIRED", "openai,pdf,excel,results_store").split(",") if x.strip()
+]
+
+
+# ---------------------- 各依赖的预热 / 关闭 ---------------------- #
+
+def _warm_openai():
+    from app.integration.analyze_vision import get_openai_client
+    # 建立 TLS 连接池；models.list 很便宜
+    get_openai_client().models.list()
+
+
+def _close_openai():
+    from app.integration.analyze_vision import close_openai_client
+    from app.integration.resilience import shutdown_executor
+    shutdown_executor()
+    close_openai_client()
+
+
+def _warm_gmail():
+    # 只预热进程内共享的凭证（不会走浏览器授权，没有 token 直接报错）；
+    # Gmail service 按线程缓存，在预热线程里建了请求线程也用不上，这里只把 googleapiclient import 进来
+    from app.Gmail_Authen.gmail_oauth import get_credentials
+    import googleapiclient.discovery  # noqa: F401
+    get_credentials()
+
+
+def _close_gmail():
+    from app.Gmail_Authen.gmail_oauth import close_gmail_services
+    close_gmail_services()
+
+
+def _warm_netchb():
+    from app.integration.netchb_client import get_async_client, get_client
+    get_client()
+    # AsyncClient 的 WSDL 是同步加载的，放在预热线程里，别让第一次上传卡住事件循环
+    get_async_client()
+
+
+async def _close_netchb():
+    from app.integration.netchb_client import close_async_client, close_client
+    close_client()
+    await close_async_client()
+
+
+def _warm_entry_xsd():
+    from app.integration.entry_validation import load_schema
+    if load_schema() is None:
+        raise RuntimeError("entryUpload XSD 未加载（缺 lxml 或文件），只做业务规则校验")
+
+
+def _warm_pdf():
+    import fitz  # noqa: F401
+    from PIL import Image  # noqa: F401
+
+
+def _warm_excel():
+    import pandas  # noqa: F401
+
+
+def _warm_ocr():
+    from app.integration.ocr import OCR_ENABLED, ocr_available
+    if OCR_ENABLED and not ocr_available():
+        raise RuntimeError("OCR_ENABLED=1 但未找到 pytesseract / tesseract")
+
+
+def _close_ocr():
+    from app.integration.ocr import shutdown_pool
+    shutdown_pool()
+
+
+def _warm_results_store():
+    from app.integration.results_store import get_store
+    get_store()
+
+
+def _close_results_store():
+    from app.integration.results_store import get_store
+    get_store().close()
+
+
+# name → (warm, close)
+DEPENDENCIES: Dict[str, Tuple[Callable[[], Any], Optional[Callable[[], Any]]]] = {
+    "openai": (_warm_openai, _close_openai),
+    "gmail": (_warm_gmail, _close_gmail),
+    "netchb": (_warm_netchb, _close_netchb),
+    "entry_xsd": (_warm_entry_xsd, None),
+    "pdf": (_warm_pdf, None),
+    "excel": (_warm_excel, None),
+    "ocr": (_warm_ocr, _close_ocr),
+    "results_store": (_warm_results_store, _close_results_store),
+}
+
+_state: Dict[str, Dict[str, Any]] = {
+    name: {"status": "pending"} for name in DEPENDENCIES
+}
+
+
+# ---------------------- 预热 ---------------------- #
+
+async def _warm_one(name: str):
+    warm, _ = DEPENDENCIES[name]
+    t0 = time.perf_counter()
+    _state[name] = {"status": "warming"}
+    try:
+        await asyncio.wait_for(asyncio.to_thread(warm), timeout=WARMUP_TIMEOUT)
+        _state[name] = {"status": "ok", "ms": int((time.perf_counter() - t0) * 1000)}
+    except Exception as e:
+        _state[name] = {
+            "status": "error",
+            "error": f"{type(e).__name__}: {e}",
+            "ms": int((time.perf_counter() - t0) * 1000),
+        }
+    print(f"[Startup] {name}: {_state[name]}")
+
+
+async def warm_up():
+    await asyncio.gather(*(_warm_one(name) for name in DEPENDENCIES))
+
+
+def readiness() -> Tuple[bool, Dict[str, Any]]:
+    ready = all(_state[name]["status"] == "ok" for name in READY_REQUIRED if name in _state)
+    return ready, {"ready": ready, "required": READY_REQUIRED, "dependencies": dict(_state)}
+
+
+# ---------------------- 关闭 ---------------------- #
+
+async def shutdown():
+    for name, (_, close) in DEPENDENCIES.items():
+        if close is None or _state[name]["status"] != "ok":
+            continue
+        try:
+            res = close()
+            if inspect.isawaitable(res):
+                await res
+        except Exception as e:
+            print(f"[Shutdown] {name} 关闭失败: {e}")
+        _state[name] = {"status": "closed"}
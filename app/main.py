@@ -1,10 +1,134 @@
 # main.py
-from fastapi import FastAPI
-from app.integration.gmail_auto_reply import process_latest_email_and_reply
+import asyncio
+import os
+from contextlib import asynccontextmanager
 
-app = FastAPI(title="Customs AI Gateway v3 - Vision Edition")
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse
 
-@app.get("/process-emails")
-async def trigger():
-    result = await process_latest_email_and_reply()
-    return result
\ No newline at end of file
+from app import lifecycle
+from app.profiling import new_job_id, profile_authorized, profile_path, profiling_requested, run_profiled
+from app.integration.admission import get_memory_metrics
+from app.integration.gmail_auto_reply import process_latest_email_and_reply, run_latest_email_pipeline
+from app.integration.model_cascade import get_cascade_metrics
+from app.integration.resilience import get_resilience_metrics
+from app.integration.worker import WORKER_ENABLED, get_worker_metrics, start_background_worker, stop_background_worker
+from app.analyze_api import router as analyze_router
+from app.entries_api import router as entries_router
+from app.results_api import router as results_router
+from app.sse import sse_pipeline_response
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 并行预热 OpenAI / Gmail / NET CHB / PyMuPDF / pandas / 结果库
+    await lifecycle.warm_up()
+    # WORKER_ENABLED=1：本实例同时作为 worker 按租约认领邮件（见 app/integration/worker.py）
+    if WORKER_ENABLED:
+        start_background_worker()
+    yield
+    await asyncio.to_thread(stop_background_worker)
+    await lifecycle.shutdown()
+
+
+def create_app() -> FastAPI:
+    app = FastAPI(
+        title="Customs AI Gateway v3 - Vision Edition",
+        version="0.3.0",
+        lifespan=lifespan,
+    )
+
+    # CORS
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # ------------------------------
+    # 测试 Root API
+    # ------------------------------
+    @app.get("/")
+    def root():
+        return {"message": "Customs AI Gateway is running."}
+
+    # ------------------------------
+    # 就绪探针：负载均衡只把流量切到预热完成的实例
+    # ------------------------------
+    @app.get("/ready")
+    def ready():
+        ok, detail = lifecycle.readiness()
+        return JSONResponse(detail, status_code=200 if ok else 503)
+
+    # ------------------------------
+    # 主业务：处理最新邮件 → 下载附件 → 分析 → 聚合 → 自动回复
+    # ------------------------------
+    @app.get("/process-emails")
+    async def process_emails(request: Request):
+        """
+        主流程：只处理最新邮件 + 自动回信
+        带 X-Profile: 1 或 ?profile=1（及管理员 X-Profile-Key）时剖析这次运行（见 app/profiling.py）
+        """
+        if profiling_requested(request):
+            return await asyncio.to_thread(run_profiled, new_job_id(), True, run_latest_email_pipeline)
+        return await process_latest_email_and_reply()
+
+    @app.get("/process-emails/stream")
+    async def process_emails_stream(request: Request):
+        """
+        同 /process-emails，但以 SSE 推送每个阶段的进度和中间结果：
+        download / admission / extract / payload / gpt_start / gpt_delta / gpt_done / reconcile /
+        mapping / xml / upload / stored / reply / result / done
+        """
+        run = run_latest_email_pipeline
+        if profiling_requested(request):
+            job_id = new_job_id()
+
+            def run(progress):
+                return run_profiled(job_id, True, run_latest_email_pipeline, progress)
+
+        return sse_pipeline_response(run)
+
+    @app.get("/profiles/{job_id}/{kind}")
+    def get_profile(job_id: str, kind: str, request: Request):
+        """
+        kind = speedscope（拖进 https://www.speedscope.app）/ alloc（峰值内存 + 分配点）
+        和开启剖析一样要带 X-Profile-Key
+        """
+        if not profile_authorized(request):
+            raise HTTPException(status_code=403, detail="需要有效的 X-Profile-Key")
+        path = profile_path(job_id, kind)
+        if path is None:
+            raise HTTPException(status_code=404, detail="profile not found")
+        return FileResponse(path, media_type="application/json", filename=os.path.basename(path))
+
+    @app.get("/metrics/cascade")
+    def cascade_metrics():
+        """模型级联：各 tier 调用次数 / 平均延迟 / 升级率"""
+        return get_cascade_metrics()
+
+    @app.get("/metrics/memory")
+    def memory_metrics():
+        """准入控制：当前 RSS / 已预留 / 预算 / 运行中与排队作业数"""
+        return get_memory_metrics()
+
+    @app.get("/metrics/workers")
+    def worker_metrics():
+        """存活的 worker 节点 / 各节点正在处理的邮件数 / 本实例 worker 的认领与处理计数 / 各优先级延迟"""
+        return get_worker_metrics()
+
+    @app.get("/metrics/openai")
+    def openai_metrics():
+        """每个模型的熔断状态 / p95 延迟 / 对冲次数与胜出次数 / 备用模型切换次数"""
+        return get_resilience_metrics()
+
+    app.include_router(analyze_router)
+    app.include_router(results_router)
+    app.include_router(entries_router)
+    return app
+
+
+app = create_app()
@@ -0,0 +1,318 @@
+# app/profiling.py
+"""
+按请求开启的性能剖析
+
+某个客户的单据特别慢时，看不到时间花在 PyMuPDF / pandas / JSON 哪里。
+请求带 `X-Profile: 1` 头或 `?profile=1` 时，这一次运行：
+- 采样剖析：后台线程每 PROFILE_INTERVAL_MS 采一次这个作业的线程的调用栈（sys._current_frames），
+  写成 speedscope 格式（https://www.speedscope.app 直接打开），每个线程一个 profile。
+  作业的线程 = 发起剖析的请求线程 + 它通过 traced() 交给线程池（OpenAI / OCR）的任务正在跑的线程；
+  并发的其它请求不会混进来
+- tracemalloc：记录峰值内存和按代码行汇总的前 PROFILE_TOP_ALLOC 个分配点
+文件按 job_id 存到 PROFILE_DIR，GET /profiles/{job_id}/speedscope 或 /alloc 下载，只保留最近 PROFILE_KEEP 个。
+
+tracemalloc 是进程级的、会拖慢整个进程，所以只有管理员能开：
+开启和下载都要带 `X-Profile-Key: <PROFILE_ADMIN_KEY>`；PROFILE_ADMIN_KEY 没配置时剖析整体关闭。
+导出的文件名只保留项目内的相对路径 / 第三方包内的路径，不暴露部署目录。
+没开启时只多一次 header / query 判断。同一时间只剖析一个运行。
+"""
+
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app import config
+
+PROFILE_DIR = config.getenv("PROFILE_DIR", os.path.join("attachments", "profiles"))
+PROFILE_INTERVAL_MS = config.getenv_float("PROFILE_INTERVAL_MS", 5)
+PROFILE_TOP_ALLOC = config.getenv_int("PROFILE_TOP_ALLOC", 25)
+PROFILE_TRACEMALLOC_FRAMES = config.getenv_int("PROFILE_TRACEMALLOC_FRAMES", 8)
+PROFILE_ADMIN_KEY = config.getenv("PROFILE_ADMIN_KEY", "")
+# PROFILE_DIR 里最多保留的剖析数（每个 job 两个文件），超出删最旧的
+PROFILE_KEEP = config.getenv_int("PROFILE_KEEP", 50)
+# 单个线程最多保留的样本数（约 PROFILE_INTERVAL_MS × 该值 的时长）
+MAX_SAMPLES_PER_THREAD = 200_000
+
+_profile_lock = threading.Lock()
+# 当前上下文所属的正在剖析的采样器；traced() 据此把线程池任务挂到对应作业上
+_active: ContextVar[Optional["_Sampler"]] = ContextVar("profiling_sampler", default=None)
+
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_STDLIB_DIR = os.path.dirname(os.__file__)
+
+
+def profile_authorized(request) -> bool:
+    """X-Profile-Key 是否等于 PROFILE_ADMIN_KEY；没配置 key 时谁都不行"""
+    key = request.headers.get("x-profile-key") or ""
+    return bool(PROFILE_ADMIN_KEY) and hmac.compare_digest(key.encode(), PROFILE_ADMIN_KEY.encode())
+
+
+def profiling_requested(request) -> bool:
+    """请求要求剖析时检查管理员 key，不对抛 403"""
+    flag = request.headers.get("x-profile") or request.query_params.get("profile") or ""
+    if flag.strip().lower() not in ("1", "true", "yes", "on"):
+        return False
+    if not profile_authorized(request):
+        from fastapi import HTTPException
+
+        raise HTTPException(status_code=403, detail="剖析需要有效的 X-Profile-Key")
+    return True
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+
+def _public_path(filename: str) -> str:
+    """导出用的文件名：项目内 → 相对路径，第三方包 → site-packages 之后的部分，标准库 → <stdlib>/..."""
+    path = filename
+    for marker in ("site-packages" + os.sep, "dist-packages" + os.sep):
+        if marker in path:
+            return path.rsplit(marker, 1)[1]
+    if path.startswith(_PROJECT_ROOT + os.sep):
+        return os.path.relpath(path, _PROJECT_ROOT)
+    if path.startswith(_STDLIB_DIR + os.sep):
+        return "<stdlib>/" + os.path.relpath(path, _STDLIB_DIR)
+    return os.path.basename(path)
+
+
+def traced(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    交给线程池之前包一下：当前上下文在剖析中时，任务运行期间它所在的线程也被采样。
+    没在剖析时原样返回 fn
+    """
+    sampler = _active.get()
+    if sampler is None:
+        return fn
+
+    def run(*args, **kwargs):
+        ident = threading.get_ident()
+        sampler.track(ident)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sampler.untrack(ident)
+
+    return run
+
+
+# ---------------------- 采样器 ---------------------- #
+
+class _Sampler(threading.Thread):
+    def __init__(self, interval: float, owner: int):
+        super().__init__(name="profiler-sampler", daemon=True)
+        self.interval = interval
+        # 要采样的线程 ident → 正在跑的本作业任务数
+        self._tracked: Dict[int, int] = {owner: 1}
+        self._tracked_lock = threading.Lock()
+        self._halt = threading.Event()
+        self.frames: List[Dict[str, Any]] = []
+        self._frame_index: Dict[Tuple[str, str, int], int] = {}
+        # thread ident → {"name", "samples", "weights"}
+        self.threads: Dict[int, Dict[str, Any]] = {}
+        self.started_at = 0.0
+        self.ended_at = 0.0
+
+    def track(self, ident: int):
+        with self._tracked_lock:
+            self._tracked[ident] = self._tracked.get(ident, 0) + 1
+
+    def untrack(self, ident: int):
+        with self._tracked_lock:
+            n = self._tracked.get(ident, 0) - 1
+            if n > 0:
+                self._tracked[ident] = n
+            else:
+                self._tracked.pop(ident, None)
+
+    def _frame_id(self, code, lineno: int) -> int:
+        key = (code.co_name, code.co_filename, lineno)
+        idx = self._frame_index.get(key)
+        if idx is None:
+            idx = len(self.frames)
+            self._frame_index[key] = idx
+            self.frames.append({"name": code.co_name, "file": _public_path(code.co_filename), "line": lineno})
+        return idx
+
+    def run(self):
+        self.started_at = last = time.perf_counter()
+        while not self._halt.wait(self.interval):
+            now = time.perf_counter()
+            weight = (now - last) * 1000
+            last = now
+            with self._tracked_lock:
+                tracked = set(self._tracked)
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident not in tracked:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_id(frame.f_code, frame.f_lineno))
+                    frame = frame.f_back
+                stack.reverse()
+                t = self.threads.setdefault(ident, {"name": names.get(ident, str(ident)), "samples": [], "weights": []})
+                if len(t["samples"]) < MAX_SAMPLES_PER_THREAD:
+                    t["samples"].append(stack)
+                    t["weights"].append(round(weight, 3))
+        self.ended_at = time.perf_counter()
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+    def speedscope(self, name: str) -> Dict[str, Any]:
+        wall = (self.ended_at - self.started_at) * 1000
+        profiles = [
+            {
+                "type": "sampled",
+                "name": t["name"],
+                "unit": "milliseconds",
+                "startValue": 0,
+                "endValue": round(wall, 3),
+                "samples": t["samples"],
+                "weights": t["weights"],
+            }
+            for t in sorted(self.threads.values(), key=lambda t: -len(t["samples"]))
+        ]
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "customs-gateway",
+            "shared": {"frames": self.frames},
+            "profiles": profiles,
+        }
+
+
+# ---------------------- 入口 ---------------------- #
+
+def _top_allocations(snapshot, limit: int) -> List[Dict[str, Any]]:
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ))
+    return [
+        {
+            "site": f"{_public_path(s.traceback[0].filename)}:{s.traceback[0].lineno}",
+            "size_kb": round(s.size / 1024, 1),
+            "count": s.count,
+        }
+        for s in snapshot.statistics("lineno")[:limit]
+    ]
+
+
+@contextmanager
+def profile_run(job_id: str, enabled: bool = True):
+    """
+    with profile_run(job_id, enabled) as report: ...
+    退出后 report 里是剖析摘要；enabled=False 或已有剖析在跑时 report 为空 dict / {"skipped": ...}
+    """
+    report: Dict[str, Any] = {}
+    if not enabled:
+        yield report
+        return
+    if not _profile_lock.acquire(blocking=False):
+        report["skipped"] = "已有一个剖析在运行"
+        yield report
+        return
+
+    started_tracing = not tracemalloc.is_tracing()
+    sampler = _Sampler(PROFILE_INTERVAL_MS / 1000.0, threading.get_ident())
+    token = _active.set(sampler)
+    try:
+        if started_tracing:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        sampler.start()
+        try:
+            yield report
+        finally:
+            sampler.stop()
+            wall_ms = int((time.perf_counter() - t0) * 1000)
+            current, peak = tracemalloc.get_traced_memory()
+            top = _top_allocations(tracemalloc.take_snapshot(), PROFILE_TOP_ALLOC)
+            report.update(_write(job_id, sampler, wall_ms, current, peak, top))
+    finally:
+        _active.reset(token)
+        if started_tracing:
+            tracemalloc.stop()
+        _profile_lock.release()
+
+
+def _write(job_id: str, sampler: _Sampler, wall_ms: int, current: int, peak: int,
+           top: List[Dict[str, Any]]) -> Dict[str, Any]:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    speedscope_path = os.path.join(PROFILE_DIR, f"{job_id}.speedscope.json")
+    alloc_path = os.path.join(PROFILE_DIR, f"{job_id}.alloc.json")
+
+    with open(speedscope_path, "w", encoding="utf-8") as f:
+        json.dump(sampler.speedscope(job_id), f, separators=(",", ":"))
+
+    summary = {
+        "job_id": job_id,
+        "wall_ms": wall_ms,
+        "samples": sum(len(t["samples"]) for t in sampler.threads.values()),
+        "threads": len(sampler.threads),
+        "mem_current_kb": round(current / 1024, 1),
+        "mem_peak_kb": round(peak / 1024, 1),
+        "top_allocations": top,
+    }
+    with open(alloc_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    print(f"[Profile] {job_id}: {wall_ms}ms, peak {summary['mem_peak_kb']}KB → {speedscope_path}")
+    _prune()
+    return {
+        **summary,
+        "top_allocations": top[:10],
+        "speedscope": f"/profiles/{job_id}/speedscope",
+        "allocations": f"/profiles/{job_id}/alloc",
+    }
+
+
+def _prune():
+    """PROFILE_DIR 只留最近 PROFILE_KEEP 个剖析，按 alloc 文件的修改时间删最旧的"""
+    try:
+        jobs = [
+            (e.stat().st_mtime, e.name[: -len(".alloc.json")])
+            for e in os.scandir(PROFILE_DIR)
+            if e.name.endswith(".alloc.json")
+        ]
+    except OSError:
+        return
+    jobs.sort(reverse=True)
+    for _, job_id in jobs[max(0, PROFILE_KEEP):]:
+        for suffix in (".alloc.json", ".speedscope.json"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, job_id + suffix))
+            except OSError:
+                pass
+
+
+def run_profiled(job_id: str, enabled: bool, fn: Callable[..., Any], *args, **kwargs):
+    """同步调用 fn，开启时返回值（dict）附上 "profile" 摘要"""
+    with profile_run(job_id, enabled) as report:
+        result = fn(*args, **kwargs)
+    if report and isinstance(result, dict):
+        result = {**result, "profile": report}
+    return result
+
+
+def profile_path(job_id: str, kind: str) -> Optional[str]:
+    """kind: speedscope / alloc；job_id 只允许十六进制，防止路径穿越"""
+    if not job_id or any(c not in "0123456789abcdef" for c in job_id):
+        return None
+    suffix = {"speedscope": ".speedscope.json", "alloc": ".alloc.json"}.get(kind)
+    if suffix is None:
+        return None
+    path = os.path.join(PROFILE_DIR, job_id + suffix)
+    return path if os.path.exists(path) else None
@@ -0,0 +1,85 @@
+# app/results_api.py
+import time
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query
+
+from app.integration.accounting import budget_for
+from app.integration.results_store import get_store
+
+router = APIRouter()
+
+
+# ------------------------------
+# 结果库查询（分页：next_cursor 传回 cursor 即可翻下一页）
+# ------------------------------
+@router.get("/shipments")
+def list_shipments(
+    container: Optional[str] = None,
+    mbl: Optional[str] = None,
+    hbl: Optional[str] = None,
+    consignee: Optional[str] = Query(None, description="前缀匹配，大小写不敏感"),
+    date_from: Optional[int] = Query(None, description="unix 秒，含"),
+    date_to: Optional[int] = Query(None, description="unix 秒，不含"),
+    status: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[int] = None,
+):
+    return get_store().query_shipments(
+        container=container,
+        mbl=mbl,
+        hbl=hbl,
+        consignee=consignee,
+        date_from=date_from,
+        date_to=date_to,
+        status=status,
+        limit=limit,
+        cursor=cursor,
+    )
+
+
+# ------------------------------
+# 模型调用费用汇总（见 accounting.py）
+# ------------------------------
+@router.get("/usage")
+def usage_summary(
+    group_by: str = Query("day", description="message / customer / day / model，可逗号组合"),
+    customer: Optional[str] = None,
+    message_id: Optional[str] = None,
+    day_from: Optional[str] = Query(None, description="YYYY-MM-DD，含"),
+    day_to: Optional[str] = Query(None, description="YYYY-MM-DD，含"),
+    limit: int = Query(100, ge=1, le=1000),
+):
+    try:
+        rows = get_store().usage_summary(
+            group_by=group_by,
+            customer=customer,
+            message_id=message_id,
+            day_from=day_from,
+            day_to=day_to,
+            limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"group_by": group_by, "items": rows}
+
+
+@router.get("/usage/budgets/{customer}")
+def customer_budget(customer: str):
+    budget = budget_for(customer)
+    spent = get_store().customer_spend(customer, time.strftime("%Y-%m-%d", time.gmtime()))
+    return {"customer": customer, "budget": budget, "spent_today_usd": round(spent, 6)}
+
+
+@router.get("/layout-templates")
+def layout_templates():
+    from app.integration.layout_templates import list_templates
+    return {"items": list_templates()}
+
+
+@router.get("/shipments/{shipment_id}")
+def get_shipment(shipment_id: int):
+    shipment = get_store().get_shipment(shipment_id)
+    if shipment is None:
+        raise HTTPException(status_code=404, detail="shipment not found")
+    return shipment
@@ -0,0 +1,83 @@
+# app/sse.py
+"""
+Server-Sent Events：把同步流水线的 progress 回调推给客户端
+
+流水线在线程里跑，progress(event, data) 通过 call_soon_threadsafe 投递到 asyncio.Queue，
+这里逐条写成 `event: ...\\ndata: {...}\\n\\n`。
+- 每 SSE_HEARTBEAT 秒没有事件就发一行注释心跳，防止代理空闲超时
+- 最后一条是 `result`（完整返回值）或 `error`，然后 `done`
+- 客户端断开不会中断后台流水线：已发出的模型调用照样跑完、结果照常入库 / 回信，钱不会白花。
+  但断开后重连（或重试）会开始新的一轮，不会接回原来的流；同一封邮件不被重复处理靠的是
+  single_flight 的 gmail:<message id> 租约（见 single_flight.py），不是这里
+"""
+
+import asyncio
+import json
+import time
+from typing import Any, Callable, Dict
+
+from fastapi.responses import StreamingResponse
+
+from app import config
+
+SSE_HEARTBEAT = config.getenv_float("SSE_HEARTBEAT", 15)
+
+_DONE = object()
+# 后台流水线任务的强引用，避免客户端断开后 task 被 GC
+_running_tasks = set()
+
+
+def _format(event: str, data: Dict[str, Any], seq: int) -> str:
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f"id: {seq}\nevent: {event}\ndata: {payload}\n\n"
+
+
+def sse_pipeline_response(run: Callable[[Callable[[str, Dict[str, Any]], None]], Any]) -> StreamingResponse:
+    """
+    run(progress) 是同步函数，返回最终结果；progress(event, data) 会被推送成 SSE 事件。
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    t0 = time.perf_counter()
+
+    def progress(event: str, data: Dict[str, Any]):
+        data = {**data, "elapsed_ms": int((time.perf_counter() - t0) * 1000)}
+        loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+
+    async def worker():
+        try:
+            result = await asyncio.to_thread(run, progress)
+            progress("result", {"result": result})
+        except Exception as e:
+            progress("error", {"error": f"{type(e).__name__}: {e}"})
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, _DONE)
+
+    task = asyncio.ensure_future(worker())
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+
+    async def stream():
+        seq = 0
+        yield _format("start", {"elapsed_ms": 0}, seq)
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            seq += 1
+            if item is _DONE:
+                yield _format("done", {"elapsed_ms": int((time.perf_counter() - t0) * 1000)}, seq)
+                break
+            event, data = item
+            yield _format(event, data, seq)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # nginx 不要缓冲
+        },
+    )